@@ -54,16 +54,18 @@ def many(req, **args):
     text = "{0}".format(args)
     return Response(body=text, status=200)
 
+app.add_filter('list', lambda var: var.split(','))
+
 @app.get('/dict/<list:var>')
 def filter_dict(req, var):
-    print type(var)
-    print (var)
+    print(type(var))
+    print(var)
     return Response(body='OK', status=200)
 
 
 @app.post('/post')
 def posted(req):
-    print req.body.read()
+    print(req.body.read())
     return Response(body='got post', status=200)
 
 if __name__ == '__main__':
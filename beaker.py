@@ -1,16 +1,45 @@
 import re
 import os
+import io
+import base64
+import time
+import tempfile
+import threading
+import queue
+import asyncio
+import functools
+import bisect
+import json
+import gzip
+import zlib
+import hashlib
+import mmap
+from email.utils import formatdate
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from urllib.parse import parse_qsl
 from collections import defaultdict
+from collections import OrderedDict
+from collections import deque
 import pprint
 
 
+class RouteError(Exception):
+    """
+    Raised for a route that can't be registered or compiled, i.e. one with an unknown filter
+    or one that clashes with a route of another endpoint.
+    """
+    pass
+
+
 def check_var(path_part):
     """
     Check if this part of the path is a variable.
-    Anything surrounding by angle brackets '<var>' is a variable.
+    A whole path segment in angle brackets '<var>' is a variable.
     """
-    match = re.search('<(.*)>', path_part)
-    return match.group(1) if match else None
+    if path_part.startswith('<') and path_part.endswith('>'):
+        return path_part[1:-1]
+    return None
 
 
 def path_to_list(path):
@@ -28,20 +57,701 @@ def list_to_path(path_list):
     return '/'.join(path_list)
 
 
+def read_blocks(file_obj, block_size):
+    """
+    Iterate over a file in blocks, closing it when done or when the iterator is closed.
+    Used when the WSGI server has no wsgi.file_wrapper.
+    """
+    try:
+        while True:
+            block = file_obj.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        file_obj.close()
+
+
+def encode_blocks(body):
+    """
+    Encode each block of a streamed response body to bytes as it is produced.
+    The body is closed when done, or when this iterator is closed.
+    """
+    try:
+        for block in body:
+            if not isinstance(block, bytes):
+                block = block.encode('utf-8')
+            yield block
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def buffer_blocks(buffers, block_size):
+    """
+    Iterate over a list of buffers, i.e. memoryview slices of an mmap, in blocks of bytes.
+    Only the block being sent is copied out of a buffer.
+    """
+    for buffer in buffers:
+        for i in range(0, len(buffer), block_size):
+            yield bytes(buffer[i:i + block_size])
+
+
+async def encode_blocks_async(body):
+    """
+    encode_blocks for async iterables, i.e. async generators. Only AsyncServer can send these.
+    """
+    async for block in body:
+        if not isinstance(block, bytes):
+            block = block.encode('utf-8')
+        yield block
+
+
+def parse_query(query):
+    """
+    Parse a query string into a MultiDict.
+    Values are percent-decoded, '+' is a space, 'a=b=c' sets a to 'b=c' and a bare 'flag' is ''.
+    """
+    if not query:
+        return MultiDict()
+    return MultiDict(parse_qsl(query, keep_blank_values=True, errors='replace'))
+
+
+@functools.lru_cache(maxsize=256)
+def choose_encoding(accept_encoding):
+    """
+    Pick the Content-Encoding for an Accept-Encoding header, 'gzip', 'deflate' or None.
+    Codings with q=0 are refused, '*' stands for both and gzip wins a tie.
+    Clients send the same few headers over and over, so the answers are cached.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        weight = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    default = weights.get('*', 0.0)
+    gzip_weight = weights.get('gzip', weights.get('x-gzip', default))
+    deflate_weight = weights.get('deflate', default)
+    if gzip_weight <= 0 and deflate_weight <= 0:
+        return None
+    return 'gzip' if gzip_weight >= deflate_weight else 'deflate'
+
+
+def compress(data, encoding, level=6):
+    """
+    Compress bytes for a Content-Encoding, 'gzip' or 'deflate'.
+    """
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zlib.compress(data, level)
+
+
+# Maps header names to their WSGI environ keys, i.e. 'Accept-Encoding' -> 'HTTP_ACCEPT_ENCODING'.
+_ENVIRON_KEYS = {}
+
+
+def environ_key(name):
+    """
+    The WSGI environ key of a request header. Header names repeat, so the keys are cached.
+    """
+    key = _ENVIRON_KEYS.get(name)
+    if key is None:
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if len(_ENVIRON_KEYS) < 1024:
+            _ENVIRON_KEYS[name] = key
+    return key
+
+
+def environ_headers(environ):
+    """
+    Collect the request headers in a WSGI environ into a dict, i.e. HTTP_ACCEPT -> 'Accept'.
+    """
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers[key[5:].replace('_', '-').title()] = value
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+    if environ.get('CONTENT_LENGTH'):
+        headers['Content-Length'] = environ['CONTENT_LENGTH']
+    return headers
+
+
+def body_digest(data):
+    """
+    A short hash of a response body, to tell replayed responses from captured ones.
+    """
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def encoded_etag(etag, encoding):
+    """
+    The ETag of a compressed copy of a body, which must differ from the ETag of the body.
+    """
+    return etag[:-1] + '-' + encoding + '"' if etag.endswith('"') else etag + '-' + encoding
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header against an ETag, with weak comparison as RFC 7232 asks.
+    """
+    if if_none_match.strip() == '*':
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def parse_http_date(value):
+    """
+    Parse an HTTP date, i.e. 'Sun, 06 Nov 1994 08:49:37 GMT', to a timestamp. None if it is invalid.
+    """
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def parse_range(value, size):
+    """
+    Parse a Range header, i.e. 'bytes=0-499, -500', for a representation of size bytes.
+    Returns a list of (start, end) pairs, end exclusive, with the ranges that can be satisfied.
+    The list is empty if none can be. Returns None if the header is invalid, has more than
+    Beaker._MAX_RANGES ranges or overlapping ones, and should be ignored.
+    """
+    unit, _, ranges_spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+    specs = ranges_spec.split(',')
+    if len(specs) > Beaker._MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.partition('-')
+        first = first.strip()
+        last = last.strip()
+        if (not dash or not (first or last) or (first and not first.isdigit())
+                or (last and not last.isdigit())):
+            return None
+        if not first:
+            # A suffix range, the last bytes of the representation.
+            start, end = max(0, size - int(last)), size
+        elif last:
+            start, end = int(first), min(size, int(last) + 1)
+            if int(last) < start:
+                return None
+        else:
+            start, end = int(first), size
+        if start < end:
+            ranges.append((start, end))
+    ranges.sort()
+    for i in range(1, len(ranges)):
+        if ranges[i][0] < ranges[i - 1][1]:
+            return None
+    return ranges
+
+
+class MultiDict(dict):
+    """
+    A dict of query arguments that keeps every value of a repeated key.
+    args[key] is the last value given for key, args.getlist(key) is all of them in order.
+    """
+
+    def __init__(self, pairs=()):
+        dict.__init__(self)
+        self._lists = {}
+        for key, value in pairs:
+            self.add(key, value)
+
+    def add(self, key, value):
+        """
+        Add a value for key, keeping the ones already there.
+        """
+        self._lists.setdefault(key, []).append(value)
+        dict.__setitem__(self, key, value)
+
+    def getlist(self, key):
+        """
+        All values for key, an empty list if there are none.
+        """
+        return list(self._lists.get(key, ()))
+
+    def lists(self):
+        """
+        (key, list of values) pairs.
+        """
+        return [(key, list(values)) for key, values in self._lists.items()]
+
+    def __setitem__(self, key, value):
+        self._lists[key] = [value]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        del self._lists[key]
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._lists.pop(key, None)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._lists.pop(key, None)
+        return key, value
+
+    def clear(self):
+        self._lists.clear()
+        dict.clear(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        """
+        Replace the values of the keys given, like dict.update.
+        Another MultiDict's keys keep all their values.
+        """
+        for other in args + (kwargs, ):
+            if isinstance(other, MultiDict):
+                for key, values in other.lists():
+                    self._lists[key] = values
+                    dict.__setitem__(self, key, values[-1])
+                continue
+            pairs = other
+            if hasattr(other, 'keys'):
+                pairs = ((key, other[key]) for key in other.keys())
+            for key, value in pairs:
+                self[key] = value
+
+    def __ior__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = self.copy()
+        merged.update(other)
+        return merged
+
+    def copy(self):
+        return MultiDict((key, value) for key, values in self._lists.items() for value in values)
+
+
+class BodyError(Exception):
+    """
+    Raised for a request body that can't be parsed. Beaker answers it with status,
+    400 for a malformed body or 413 for one over a BodyParser limit.
+    """
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or 'Malformed request body.')
+        self.status = status
+
+
+# A parameter of a header like Content-Type, i.e. '; charset="utf-8"'.
+_HEADER_PARAM = re.compile(r';\s*([^\s;=]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+def parse_options_header(value):
+    """
+    Split a header like Content-Type into its lowercased value and a dict of parameters,
+    i.e. 'multipart/form-data; boundary="x"' -> ('multipart/form-data', {'boundary': 'x'}).
+    """
+    if not value:
+        return '', {}
+    main, _, rest = value.partition(';')
+    params = {}
+    for name, param in _HEADER_PARAM.findall(';' + rest):
+        param = param.strip()
+        if param.startswith('"') and param.endswith('"') and len(param) > 1:
+            param = param[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+        params[name.lower()] = param
+    return main.strip().lower(), params
+
+
+class UploadedFile:
+    """
+    A file part of a multipart/form-data body.
+    name:         form field name
+    filename:     file name sent by the client, not safe to use as a path
+    content_type: Content-Type of the part
+    file:         binary file object holding the contents, at position 0.
+                  Kept in memory up to the spool size, in a temporary file after that.
+    size:         bytes in the file
+    """
+
+    def __init__(self, name, filename, content_type, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def save(self, path, block_size=64 * 1024):
+        """
+        Copy the contents to path, a block at a time.
+        """
+        self.file.seek(0)
+        with open(path, 'wb') as out:
+            while True:
+                block = self.file.read(block_size)
+                if not block:
+                    break
+                out.write(block)
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+
+class _BodyReader:
+    """
+    Buffered reads from wsgi.input that never go past the body's Content-Length.
+    """
+
+    def __init__(self, stream, length, block_size):
+        self.stream = stream
+        self.remaining = length
+        self.block_size = block_size
+        self.buffer = bytearray()
+
+    def fill(self):
+        """
+        Read one more block into the buffer. Returns False at the end of the body.
+        """
+        size = self.block_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if size <= 0:
+                return False
+        data = self.stream.read(size)
+        if not data:
+            return False
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def read_until(self, delimiter, limit):
+        """
+        Return the bytes before delimiter and drop both from the buffer.
+        Raises BodyError if the body ends first, or nothing is found within limit bytes.
+        """
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(delimiter)]
+                return data
+            if len(self.buffer) > limit:
+                raise BodyError(400, 'Multipart headers too long.')
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            if not self.fill():
+                raise BodyError(400, 'Truncated multipart body.')
+
+    def copy_until(self, delimiter, write, limit):
+        """
+        Pass the bytes before delimiter to write as they arrive, and drop the delimiter.
+        Returns the number of bytes written. Raises BodyError over limit bytes, None for no limit.
+        """
+        written = 0
+        keep = len(delimiter) - 1
+        while True:
+            index = self.buffer.find(delimiter)
+            if index >= 0:
+                written += index
+                if limit is not None and written > limit:
+                    raise BodyError(413, 'Multipart part too large.')
+                write(bytes(self.buffer[:index]))
+                del self.buffer[:index + len(delimiter)]
+                return written
+            if len(self.buffer) > keep:
+                # Everything but a possible start of the delimiter is part of the body.
+                count = len(self.buffer) - keep
+                written += count
+                if limit is not None and written > limit:
+                    raise BodyError(413, 'Multipart part too large.')
+                write(bytes(self.buffer[:count]))
+                del self.buffer[:count]
+            if not self.fill():
+                raise BodyError(400, 'Truncated multipart body.')
+
+    def read_exactly(self, size):
+        while len(self.buffer) < size:
+            if not self.fill():
+                raise BodyError(400, 'Truncated multipart body.')
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class BodyParser:
+    """
+    Parses request bodies into Request.form, Request.files and Request.json.
+    The body is read from the stream as it is parsed, it is never read whole
+    except for urlencoded and JSON bodies, which are capped.
+    spool_size:     bytes of an uploaded file kept in memory before it moves to a temporary file
+    max_field_size: largest multipart field that is not a file, and largest urlencoded body
+    max_file_size:  largest uploaded file, None for no limit
+    max_json_size:  largest JSON body, None for no limit
+    max_parts:      most parts in a multipart body
+    json_loads:     function that decodes JSON from bytes, i.e. a faster library's loads
+
+    form_parsers maps mimetypes to functions called as parser(body_parser, stream, length, params),
+    which return the tuple (form, files) of MultiDicts. Replace or add to it, i.e. to plug in
+    a faster multipart parser.
+    """
+
+    def __init__(self, spool_size=1024 * 1024, max_field_size=1024 * 1024, max_file_size=None,
+                 max_json_size=16 * 1024 * 1024, max_parts=1000, json_loads=json.loads,
+                 block_size=64 * 1024):
+        self.spool_size = spool_size
+        self.max_field_size = max_field_size
+        self.max_file_size = max_file_size
+        self.max_json_size = max_json_size
+        self.max_parts = max_parts
+        self.json_loads = json_loads
+        self.block_size = block_size
+        self.form_parsers = {
+                'application/x-www-form-urlencoded': parse_urlencoded_body,
+                'multipart/form-data': parse_multipart_body,
+        }
+
+    def parse_form(self, stream, content_type, length):
+        """
+        Parse a form body. Returns the tuple (form, files), both empty for other content types.
+        """
+        mimetype, params = parse_options_header(content_type)
+        parser = self.form_parsers.get(mimetype)
+        if parser is None or stream is None:
+            return MultiDict(), MultiDict()
+        return parser(self, stream, length, params)
+
+    def parse_json(self, stream, content_type, length):
+        """
+        Parse a JSON body. Returns None if the body is not JSON.
+        """
+        mimetype, params = parse_options_header(content_type)
+        if stream is None or not (mimetype == 'application/json' or mimetype.endswith('+json')):
+            return None
+        data = self.read_body(stream, length, self.max_json_size)
+        if not data:
+            return None
+        try:
+            return self.json_loads(data)
+        except ValueError:
+            raise BodyError(400, 'Malformed JSON body.')
+
+    def read_body(self, stream, length, limit):
+        """
+        Read a whole body of at most limit bytes, None for no limit.
+        """
+        if length is not None and limit is not None and length > limit:
+            raise BodyError(413, 'Request body too large.')
+        if length is not None:
+            return stream.read(length)
+        data = stream.read() if limit is None else stream.read(limit + 1)
+        if limit is not None and len(data) > limit:
+            raise BodyError(413, 'Request body too large.')
+        return data
+
+
+def parse_urlencoded_body(body_parser, stream, length, params):
+    """
+    Form parser for application/x-www-form-urlencoded bodies.
+    """
+    data = body_parser.read_body(stream, length, body_parser.max_field_size)
+    charset = params.get('charset', 'utf-8')
+    try:
+        return parse_query(data.decode(charset, 'replace')), MultiDict()
+    except LookupError:
+        raise BodyError(400, 'Unknown charset {0}.'.format(charset))
+
+
+def parse_multipart_body(body_parser, stream, length, params):
+    """
+    Form parser for multipart/form-data bodies, reading one part at a time.
+    File parts go to SpooledTemporaryFiles, other parts are decoded into form.
+    """
+    boundary = params.get('boundary')
+    if not boundary or len(boundary) > 200:
+        raise BodyError(400, 'Missing multipart boundary.')
+    boundary = boundary.encode('latin-1')
+    reader = _BodyReader(stream, length, body_parser.block_size)
+    form = MultiDict()
+    files = MultiDict()
+    # The first boundary may start the body, every later one follows a line break.
+    reader.read_until(b'--' + boundary, body_parser.max_field_size)
+    delimiter = b'\r\n--' + boundary
+    parts = 0
+    while True:
+        if reader.read_exactly(2) == b'--':
+            break
+        parts += 1
+        if parts > body_parser.max_parts:
+            raise BodyError(413, 'Too many multipart parts.')
+        head = reader.read_until(b'\r\n\r\n', 16 * 1024).decode('utf-8', 'replace')
+        headers = {}
+        for line in head.split('\r\n'):
+            name, colon, value = line.partition(':')
+            if colon:
+                headers[name.strip().lower()] = value.strip()
+        disposition, options = parse_options_header(headers.get('content-disposition'))
+        name = options.get('name')
+        if disposition != 'form-data' or name is None:
+            raise BodyError(400, 'Multipart part without a form-data name.')
+        if 'filename' in options:
+            spooled = tempfile.SpooledTemporaryFile(max_size=body_parser.spool_size)
+            size = reader.copy_until(delimiter, spooled.write, body_parser.max_file_size)
+            spooled.seek(0)
+            content_type = headers.get('content-type', 'application/octet-stream')
+            files.add(name, UploadedFile(name, options['filename'], content_type, spooled, size))
+        else:
+            chunks = []
+            reader.copy_until(delimiter, chunks.append, body_parser.max_field_size)
+            charset = parse_options_header(headers.get('content-type'))[1].get('charset', 'utf-8')
+            try:
+                form.add(name, b''.join(chunks).decode(charset, 'replace'))
+            except LookupError:
+                raise BodyError(400, 'Unknown charset {0}.'.format(charset))
+    return form, files
+
+
+default_body_parser = BodyParser()
+
+# Request.json before the body is parsed, None is a valid JSON body.
+_UNPARSED = object()
+
+
 class Request:
     """
     Request objects describe HTTP requests with...
     method: REST Verb, i.e. 'GET'
     path:   URI, i.e. '/this/path'
     query:  args, i.e. 'foo=bar&this=that'
+    args:   query parsed into a MultiDict, only when it is first used
     body:   payload
+    headers: dict of request headers, i.e. {'Accept-Encoding': 'gzip'},
+             built from environ when it is first used
+    environ: the WSGI environ, for requests that came in through the WSGI interface
+    form:   MultiDict of the fields of a urlencoded or multipart/form-data body
+    files:  MultiDict of UploadedFiles in a multipart/form-data body
+    json:   the decoded JSON body, None if the body is not JSON
+            form, files and json are parsed from body when one of them is first used,
+            by body_parser. A malformed body raises BodyError, which Beaker answers with a 400.
+    Requests are made for every call, so they have fixed __slots__ and no other attributes.
     """
+
+    __slots__ = ('method', 'path', 'query', '_args', 'body', '_headers', 'environ', 'timer',
+                 'body_parser', '_form', '_files', '_json')
     
-    def __init__(self, method, path, query=None, body=None):
+    def __init__(self, method, path, query=None, body=None, headers=None, environ=None,
+                 body_parser=None):
         self.method = method
         self.path = path
         self.query = query
+        self._args = None
         self.body = body
+        self._headers = headers
+        self.environ = environ
+        self.body_parser = body_parser
+        self._form = None
+        self._files = None
+        self._json = _UNPARSED
+        # RequestTimer for this request while stats are enabled, otherwise None.
+        self.timer = None
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = parse_query(self.query)
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        self._args = args
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = environ_headers(self.environ) if self.environ is not None else {}
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._parse_form()
+        return self._form
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._parse_form()
+        return self._files
+
+    @property
+    def json(self):
+        if self._json is _UNPARSED:
+            parser = self.body_parser or default_body_parser
+            self._json = parser.parse_json(self.body, self.header('Content-Type'), self._content_length())
+        return self._json
+
+    def _parse_form(self):
+        parser = self.body_parser or default_body_parser
+        self._form, self._files = parser.parse_form(self.body, self.header('Content-Type'),
+                                                    self._content_length())
+
+    def _content_length(self):
+        """
+        The body's Content-Length, None if it has none, i.e. it is chunked.
+        """
+        length = self.header('Content-Length')
+        if not length:
+            return None
+        try:
+            return int(length)
+        except ValueError:
+            raise BodyError(400, 'Malformed Content-Length.')
+
+    def header(self, name, default=None):
+        """
+        One request header. Read straight from the environ, unless req.headers has been built.
+        """
+        if self._headers is None and self.environ is not None:
+            return self.environ.get(environ_key(name), default)
+        return self.headers.get(name.title(), default)
 
 
 class Response:
@@ -50,12 +760,766 @@ class Response:
     status:   HTTP status code, i.e. 200
     body:     The requested data
     mimetype: The type of data, i.e. 'text/html'
+              The body may also be any iterable of strings, i.e. a generator, to stream it.
+    file:     An open binary file to stream instead of body, closed once it is sent
+    headers:  Extra response headers, i.e. {'Content-Encoding': 'gzip'}, made when first used
     """
 
-    def __init__(self, status, body, mimetype='text/plain'):
+    __slots__ = ('status', 'body', 'mimetype', 'file', '_headers', '_variants', '_encoded')
+
+    def __init__(self, status, body, mimetype='text/plain', file=None, headers=None):
         self.status = status
         self.body = body
         self.mimetype = mimetype
+        self.file = file
+        self._headers = headers
+        # The compressed copies of the response cache entry this response is, if it is one.
+        self._variants = None
+        # True when the static cache settled the body's encoding, so it is sent as it is.
+        self._encoded = False
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = {}
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+
+class StaticCache:
+    """
+    Bounded LRU cache for static file contents, keyed by request path.
+    max_bytes:  total size of cached file data, least recently used files are evicted first
+    ttl:        seconds an entry lives before it is read from disk again, None for no limit
+    revalidate: seconds between os.stat checks of a cached file's mtime and size,
+                0 checks on every hit, None never checks
+    Files bigger than max_file_bytes are served but never cached.
+    Each entry keeps the response headers of the file, i.e. its ETag, and may also hold
+    compressed variants of it with their own headers, i.e. {'gzip': (data, headers)}.
+    Variants count towards max_bytes and are dropped with the entry.
+    Any object with the same get, due, put, invalidate and clear methods can replace it.
+    All methods are safe to call from concurrent request threads.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_bytes=None, ttl=None, revalidate=1.0):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_bytes if max_file_bytes is None else max_file_bytes
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps key -> [data, mimetype, full_path, mtime, size, expires, checked, variants, headers]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, encoding=None):
+        """
+        Return the tuple (data, mimetype, headers) for key, or None on a miss.
+        If encoding is given and the entry has a variant in it, that variant and its
+        headers are returned, otherwise the raw data is. headers may be None.
+        Stale, expired and changed files count as misses and are dropped.
+        """
+        with self._lock:
+            return self._get(key, encoding)
+
+    def _get(self, key, encoding):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if (entry[5] is not None and now >= entry[5]) or not self._is_fresh(entry, now):
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if encoding is not None and entry[7] and encoding in entry[7]:
+            variant, headers = entry[7][encoding]
+            return variant, entry[1], headers
+        return entry[0], entry[1], entry[8]
+
+    def due(self, key):
+        """
+        Whether get(key) would check the file behind the entry with os.stat.
+        """
+        entry = self._entries.get(key)
+        return (entry is not None and self.revalidate is not None
+                and time.monotonic() - entry[6] >= self.revalidate)
+
+    def put(self, key, full_path, data, mimetype, stat, variants=None, headers=None):
+        """
+        Cache data read from full_path. stat is the os.stat result taken when it was read.
+        variants maps content encodings to (compressed copy of data, headers) tuples.
+        headers are the response headers to send with data.
+        """
+        with self._lock:
+            self._put(key, full_path, data, mimetype, stat, variants, headers)
+
+    def _put(self, key, full_path, data, mimetype, stat, variants, headers):
+        size = len(data)
+        if variants:
+            size += sum(len(variant[0]) for variant in variants.values())
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_file_bytes:
+            return
+        now = time.monotonic()
+        expires = now + self.ttl if self.ttl is not None else None
+        self._entries[key] = [data, mimetype, full_path, stat.st_mtime, stat.st_size, expires, now,
+                              variants, headers]
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drop key from the cache if it is there.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return a dict of cache counters.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.size}
+
+    def _is_fresh(self, entry, now):
+        """
+        Check the file behind this entry still has the mtime and size it was cached with.
+        """
+        if self.revalidate is None or now - entry[6] < self.revalidate:
+            return True
+        try:
+            stat = os.stat(entry[2])
+        except OSError:
+            return False
+        entry[6] = now
+        return stat.st_mtime == entry[3] and stat.st_size == entry[4]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry[0])
+        if entry[7]:
+            self.size -= sum(len(variant[0]) for variant in entry[7].values())
+
+
+class StaticIndex:
+    """
+    In-memory index of the files in the static directory, so requests for paths that
+    match no route are answered without touching the filesystem.
+    refresh:     seconds before the index is rebuilt, in a background thread, None never
+    max_files:   most files indexed. A bigger directory is not indexed, and lookups go to
+                 the filesystem, with missing paths kept in a negative cache.
+    max_missing: most paths kept in the negative cache, which is emptied on every refresh
+    Call refresh() to rebuild the index at once, i.e. after deploying new files.
+    """
+
+    def __init__(self, refresh=5.0, max_files=100000, max_missing=10000):
+        self.refresh_interval = refresh
+        self.max_files = max_files
+        self.max_missing = max_missing
+        self.directory = None
+        self.hits = 0
+        self.misses = 0
+        # (complete, files): files is a frozenset of the relative path of every file, None until
+        # built or when there are too many files. Replaced whole, so find reads both at once.
+        self._state = (False, None)
+        self._built = None
+        self._missing = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def find(self, path):
+        """
+        Map a request path to the path of a file in the directory, or None if there is none.
+        Paths that are not plain relative paths, i.e. with '..' segments, are never found.
+        """
+        rel_path = path.strip('/')
+        if not rel_path or '\\' in rel_path or '\0' in rel_path:
+            return None
+        for part in rel_path.split('/'):
+            if part in ('', '.', '..'):
+                return None
+        built = self._built
+        if built is None:
+            self.refresh()
+        elif (self.refresh_interval is not None and not self._refreshing
+                and time.monotonic() - built >= self.refresh_interval):
+            self._refresh_in_background()
+        complete, files = self._state
+        if complete:
+            found = rel_path in files
+        elif rel_path in self._missing:
+            found = False
+        else:
+            found = os.path.isfile(os.path.join(self.directory, rel_path))
+            if not found:
+                with self._lock:
+                    self._missing[rel_path] = True
+                    if len(self._missing) > self.max_missing:
+                        self._missing.popitem(last=False)
+        if found:
+            self.hits += 1
+            return os.path.join(self.directory, rel_path)
+        self.misses += 1
+        return None
+
+    def in_memory(self):
+        """
+        Whether find answers from memory, without touching the filesystem.
+        """
+        return self._built is not None and self._state[0]
+
+    def refresh(self):
+        """
+        Rebuild the index from the directory now.
+        """
+        files = set()
+        complete = True
+        directory = self.directory
+        if directory is not None and os.path.isdir(directory):
+            for root, dirs, names in os.walk(directory):
+                rel_root = os.path.relpath(root, directory)
+                for name in names:
+                    files.add(name if rel_root == '.' else
+                              os.path.join(rel_root, name).replace(os.sep, '/'))
+                if len(files) > self.max_files:
+                    files = None
+                    complete = False
+                    break
+        with self._lock:
+            self._state = (complete, frozenset(files) if files is not None else None)
+            self._missing.clear()
+            self._built = time.monotonic()
+            self._refreshing = False
+
+    def clear(self):
+        """
+        Drop the index, it is rebuilt on the next lookup.
+        """
+        with self._lock:
+            self._state = (False, None)
+            self._missing.clear()
+            self._built = None
+
+    def stats(self):
+        """
+        Return a dict of index counters.
+        """
+        with self._lock:
+            complete, files = self._state
+            return {'hits': self.hits, 'misses': self.misses, 'complete': complete,
+                    'files': len(files) if files is not None else None,
+                    'missing': len(self._missing)}
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        refresher = threading.Thread(target=self.refresh)
+        refresher.daemon = True
+        refresher.start()
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of endpoint responses, for GET endpoints registered with cache=True.
+    Keys are (func_name, route, URL variables, query args) tuples, where route is the path
+    the endpoint was registered with and the URL variables are sorted (name, value) pairs of
+    their converted values, so equal requests share an entry.
+    Each entry may also hold compressed copies of its response, keyed by content encoding,
+    so a cache hit is not compressed again.
+    max_entries: most responses kept, least recently used ones are evicted first
+    ttl:         seconds a response lives unless its route sets its own, None for no limit
+    All methods are safe to call from concurrent request threads.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps key -> (status, body, mimetype, headers, expires, variants)
+        self._entries = OrderedDict()
+        # Maps func_name -> set of its keys, for invalidation by endpoint.
+        self._keys = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, encoding=None):
+        """
+        Return a new Response for key, or None on a miss. Expired entries count as misses.
+        If encoding is given and the entry has a copy in it, that copy is returned.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            status, body, mimetype, headers, expires, variants = entry
+            if expires is not None and time.monotonic() >= expires:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if encoding is not None and encoding in variants:
+                body, headers = variants[encoding]
+                return Response(status=status, body=body, mimetype=mimetype, headers=dict(headers))
+        res = Response(status=status, body=body, mimetype=mimetype, headers=dict(headers))
+        res._variants = variants
+        return res
+
+    def put(self, key, res, ttl=None):
+        """
+        Cache res under key for ttl seconds, or the cache's ttl if None.
+        Only responses with a str or bytes body can be cached.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        res._variants = {}
+        entry = (res.status, res.body, res.mimetype, dict(res.headers), expires, res._variants)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._keys[key[0]].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def add_variant(self, res, encoding):
+        """
+        Keep the body of res, a response get or put returned, compressed with encoding,
+        with the entry it came from.
+        """
+        with self._lock:
+            res._variants[encoding] = (res.body, dict(res.headers))
+
+    def invalidate(self, func_name, url_vars=None):
+        """
+        Drop the responses of endpoint func_name, only those for url_vars if it is given.
+        """
+        with self._lock:
+            for key in list(self._keys.get(func_name, ())):
+                if url_vars is None or key[2] == url_vars:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self):
+        """
+        Return a dict of cache counters.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries)}
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys[key[0]]
+
+
+class ConcurrencyLimit:
+    """
+    Admission control for the whole app, or for one endpoint.
+    max_in_flight: requests handled at once
+    max_queue:     requests waiting for a slot, any more are refused at once
+    queue_timeout: seconds a request waits for a slot before it is refused, None for no limit
+    Refused requests get a 503, so latency stays bounded instead of the queue growing.
+    All methods are safe to call from concurrent request threads.
+    Requests on an event loop queue with acquire_async, on futures instead of threads,
+    and a released slot goes to them first.
+    """
+
+    def __init__(self, max_in_flight, max_queue=0, queue_timeout=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._cond = threading.Condition()
+        # (loop, future) of each request queued by acquire_async, in arrival order.
+        self._waiters = deque()
+
+    def try_acquire(self):
+        """
+        Take a slot if one is free right now. Returns whether it did.
+        """
+        with self._cond:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Take a slot, queueing for one if the queue has room.
+        Returns False if the request is refused.
+        """
+        with self._cond:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: self.in_flight < self.max_in_flight,
+                                           self.queue_timeout):
+                    self.timed_out += 1
+                    return False
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    async def acquire_async(self):
+        """
+        Awaitable acquire. A queued request waits on a future that release resolves,
+        so it holds no executor thread the running requests may need.
+        """
+        with self._cond:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+            self.waiting += 1
+        try:
+            await asyncio.wait_for(waiter[1], self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            if self._dequeue(waiter):
+                with self._cond:
+                    self.timed_out += 1
+                return False
+            # The slot was handed over as the wait timed out.
+            return True
+        except asyncio.CancelledError:
+            if not self._dequeue(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._cond:
+            # Hand the slot straight to the first waiter on an event loop that is still running.
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                self.waiting -= 1
+                try:
+                    loop.call_soon_threadsafe(ConcurrencyLimit._wake, future)
+                except RuntimeError:
+                    continue
+                self.admitted += 1
+                return
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def _dequeue(self, waiter):
+        """
+        Take a waiter of acquire_async off the queue. Returns False if release already
+        handed it a slot.
+        """
+        with self._cond:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return False
+            self.waiting -= 1
+            return True
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(True)
+
+    def stats(self):
+        """
+        Return a dict of admission counters.
+        """
+        with self._cond:
+            return {'in_flight': self.in_flight, 'waiting': self.waiting, 'admitted': self.admitted,
+                    'rejected': self.rejected, 'timed_out': self.timed_out}
+
+
+class RequestTimer:
+    """
+    Times the stages of one request.
+    mark(stage) charges the time since the previous mark to stage.
+    route is the name of the endpoint that handled the request, if any.
+    """
+
+    __slots__ = ('start', 'last', 'stages', 'route', 'error')
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.stages = {}
+        self.route = None
+        self.error = False
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+
+class RequestStats:
+    """
+    Aggregated request timings, collected while stats are enabled with Beaker.enable_stats.
+    Keeps the total time spent in each stage, and a latency histogram for each route.
+    Routes are endpoint function names, 'static' for static files and
+    'unmatched' for everything else.
+    """
+
+    # Upper bounds of the latency histogram buckets, in milliseconds.
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            # stage -> [count, seconds]
+            self._stages = {}
+            # route -> [count, errors, seconds, max seconds, {status: count}, bucket counts]
+            self._routes = {}
+
+    def record(self, timer, status):
+        """
+        Add a finished request's timer to the totals.
+        """
+        elapsed = time.perf_counter() - timer.start
+        bucket = bisect.bisect_left(RequestStats.BUCKETS, elapsed * 1000)
+        route = timer.route or 'unmatched'
+        with self._lock:
+            self.requests += 1
+            for stage, seconds in timer.stages.items():
+                totals = self._stages.get(stage)
+                if totals is None:
+                    totals = self._stages[stage] = [0, 0.0]
+                totals[0] += 1
+                totals[1] += seconds
+            totals = self._routes.get(route)
+            if totals is None:
+                totals = self._routes[route] = [0, 0, 0.0, 0.0, {}, [0] * (len(RequestStats.BUCKETS) + 1)]
+            totals[0] += 1
+            totals[1] += timer.error
+            totals[2] += elapsed
+            totals[3] = max(totals[3], elapsed)
+            totals[4][status] = totals[4].get(status, 0) + 1
+            totals[5][bucket] += 1
+
+    def snapshot(self):
+        """
+        Return the stats as a dict of plain types, ready for json.dumps. Times are in milliseconds.
+        """
+        labels = [str(bound) for bound in RequestStats.BUCKETS] + ['+Inf']
+        with self._lock:
+            stages = {}
+            for stage, (count, seconds) in self._stages.items():
+                stages[stage] = {'count': count, 'total_ms': seconds * 1000,
+                                 'mean_ms': seconds * 1000 / count}
+            routes = {}
+            for route, (count, errors, seconds, longest, statuses, buckets) in self._routes.items():
+                routes[route] = {
+                        'count': count,
+                        'errors': errors,
+                        'mean_ms': seconds * 1000 / count,
+                        'max_ms': longest * 1000,
+                        'statuses': dict((str(status), n) for status, n in statuses.items()),
+                        'histogram': dict((label, n) for label, n in zip(labels, buckets) if n)
+                }
+            return {'requests': self.requests, 'stages': stages, 'routes': routes}
+
+
+class TrafficCapture:
+    """
+    Records the requests an app gets at its WSGI interface, for replay_beaker.py to replay.
+    Each request is one line of JSON, with the keys
+    t: arrival, in seconds since the capture started   m: method   p: path   q: query
+    h: headers   b: body, base64, left out when empty   s: response status
+    n: response body length and d: its digest, null for streamed bodies
+    e: seconds the app took to make the response
+    Files whose name ends in .gz are written gzipped.
+    Requests with chunked bodies or bodies over max_body are not recorded, only counted.
+    The headers in CREDENTIALS are left out unless keep_credentials is set.
+    Requests only put their record on a bounded queue, a background thread encodes and
+    writes them. Records that arrive while max_queue are waiting are dropped and counted.
+    """
+
+    CREDENTIALS = frozenset(['authorization', 'cookie', 'proxy-authorization'])
+
+    def __init__(self, file_name, max_body=1024 * 1024, keep_credentials=False, max_queue=10000):
+        self.file_name = file_name
+        self.max_body = max_body
+        self.keep_credentials = keep_credentials
+        self.captured = 0
+        self.skipped = 0
+        self.dropped = 0
+        if file_name.endswith('.gz'):
+            self._file = gzip.open(file_name, 'wt', encoding='utf-8')
+        else:
+            self._file = open(file_name, 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._closed = False
+        self._started = time.monotonic()
+        self._records = queue.Queue(max_queue)
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def start(self, req):
+        """
+        Begin recording req, before the app handles it. The body is read into memory,
+        and req.body replaced with a copy, so the app still reads it.
+        Returns the partial record, or None if req is not recorded.
+        """
+        try:
+            length = req._content_length()
+        except BodyError:
+            length = None
+        if length is None and req.header('Transfer-Encoding') is not None or \
+                length is not None and length > self.max_body:
+            with self._lock:
+                self.skipped += 1
+            return None
+        body = req.body.read(length) if length and req.body is not None else b''
+        if length:
+            req.body = io.BytesIO(body)
+        headers = dict(req.headers)
+        if not self.keep_credentials:
+            headers = {name: value for name, value in headers.items()
+                       if name.lower() not in TrafficCapture.CREDENTIALS}
+        entry = {'t': round(time.monotonic() - self._started, 6), 'm': req.method,
+                 'p': req.path, 'q': req.query or '', 'h': headers}
+        if body:
+            entry['b'] = base64.b64encode(body).decode('ascii')
+        entry['e'] = time.monotonic()
+        return entry
+
+    def record(self, entry, res):
+        """
+        Finish recording a request with the response the app made for it. Never blocks.
+        """
+        entry['e'] = round(time.monotonic() - entry['e'], 6)
+        entry['s'] = res.status
+        entry['n'], entry['d'] = TrafficCapture.summarize(res)
+        if self._closed:
+            return
+        try:
+            self._records.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self):
+        """
+        Write every queued record, stop the writer thread and close the capture file.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._records.put(None)
+        self._writer.join()
+        self._file.close()
+
+    def stats(self):
+        """
+        Return a dict of capture counters.
+        """
+        return {'captured': self.captured, 'skipped': self.skipped, 'dropped': self.dropped}
+
+    def _write(self):
+        """
+        Writer thread loop. Writes whatever records are queued at once, until it gets None.
+        """
+        while True:
+            batch = [self._records.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._records.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                lines = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in batch)
+                try:
+                    self._file.write(lines)
+                    self.captured += len(batch)
+                except (OSError, ValueError):
+                    with self._lock:
+                        self.dropped += len(batch)
+            if stop:
+                return
+
+    @staticmethod
+    def summarize(res):
+        """
+        The (length, digest) of a response's body, (None, None) if it is streamed.
+        """
+        body = res.body
+        if res.file is not None:
+            return None, None
+        if body is None:
+            body = b''
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            return None, None
+        return len(body), body_digest(body)
 
 
 class Beaker:
@@ -83,11 +1547,33 @@ class Beaker:
 
     _VALID_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
 
+    # Mimetypes compressed by default, see set_compression.
+    _COMPRESSIBLE = ('text/html', 'text/css', 'text/javascript', 'application/json')
+
+    # Content-Type headers by mimetype, so each response reuses the same tuple.
+    # Bounded, since multipart/byteranges mimetypes are different every time.
+    _CONTENT_TYPES = {}
+    _MAX_CONTENT_TYPES = 1024
+
+    # Most ranges served for one Range header, a longer list is ignored.
+    _MAX_RANGES = 16
+
+    # Block size used to stream files through the WSGI interface.
+    _BLOCK_SIZE = 64 * 1024
+
+    # Largest body request_async compresses on the event loop, bigger ones go to the executor.
+    _LOOP_COMPRESS_SIZE = 16 * 1024
+
     _HTTP_CODES = {
             200: '200 OK',
+            206: '206 PARTIAL CONTENT',
+            304: '304 NOT MODIFIED',
             400: '400 BAD REQUEST',
             404: '404 NOT FOUND',
-            500: '500 INTERNAL SERVER ERROR'
+            413: '413 PAYLOAD TOO LARGE',
+            416: '416 RANGE NOT SATISFIABLE',
+            500: '500 INTERNAL SERVER ERROR',
+            503: '503 SERVICE UNAVAILABLE'
     }
 
     def __init__(self, name='default'):
@@ -119,95 +1605,330 @@ class Beaker:
         self._error_handlers = {
                 400: (lambda m: Response(status=400, body=m), Beaker._MIMETYPES['text']),
                 404: (lambda m: Response(status=404, body=m), Beaker._MIMETYPES['text']),
-                500: (lambda m: Response(status=500, body=m), Beaker._MIMETYPES['text'])
+                413: (lambda m: Response(status=413, body=m), Beaker._MIMETYPES['text']),
+                416: (lambda m: Response(status=416, body=m), Beaker._MIMETYPES['text']),
+                500: (lambda m: Response(status=500, body=m), Beaker._MIMETYPES['text']),
+                503: (lambda m: Response(status=503, body=m), Beaker._MIMETYPES['text'])
         }
 
-        # Default static path. This is effectively the root server directory.
-        # Files in this directory are visible from the / route. 
-        self._static_path = '/static'
+        # Default static path. This is effectively the root server directory.
+        # Files in this directory are visible from the / route. 
+        self._static_path = '/static'
+
+        # Directory static resources are found in, fixed when the app is made rather than
+        # following the process's working directory.
+        self._root = os.path.realpath('.')
+
+        # Index of the static directory, answers requests for unknown paths in memory.
+        self._static_index = StaticIndex()
+        self._static_index.directory = self._static_dir()
+
+        # Static file cache, keyed by request path. Bounded, and revalidated against the file on disk.
+        self._static_cache = StaticCache()
+
+        # Static files at least this many bytes are streamed from disk instead of read and cached.
+        self._stream_threshold = 256 * 1024
+
+        # Response compression. Bodies of a compressible mimetype and at least
+        # self._compress_min_size bytes are compressed for clients that accept it.
+        # A min size of None turns compression off.
+        self._compress_min_size = 1024
+        self._compress_level = 6
+        self._compress_types = frozenset(Beaker._COMPRESSIBLE)
+
+        # Cache-Control header sent with static files, None to send none.
+        # no-cache lets clients keep files, but they check them with a conditional request first.
+        self._static_cache_control = 'no-cache'
+
+        # Limits on query strings, checked before the request is dispatched.
+        self._max_query_args = 256
+        self._max_query_length = 8192
+
+        # Request hooks, registered with the before_request and after_request decorators.
+        self._before_request = []
+        self._after_request = []
+
+        # Admission control, ConcurrencyLimits for the whole app and for endpoints by function name.
+        self._limit = None
+        self._route_limits = {}
+
+        # Parses request bodies for req.form, req.files and req.json.
+        self._body_parser = default_body_parser
+
+        # Cached GET endpoints, registered with get(cache=True).
+        # Maps function names to (ttl, query args in the key).
+        self._cache_policies = {}
+        self._response_cache = ResponseCache()
+
+        # RequestStats while stats are enabled. None keeps the request path free of timing.
+        self._stats = None
+
+        # TrafficCapture while requests are being captured, see start_capture.
+        self._capture = None
+
+        # self._dispatch is the compiled, per-method form of self._routes.
+        # Built on first use by self._compile_routes and reset whenever a route is added.
+        self._dispatch = None
+
+    def __call__(self, *args, **kwargs):
+        """
+        WSGI standard requires an app to be callable.
+        """
+        return self._wsgi_interface(*args, **kwargs)
+
+    def get(self, path, mimetype='text/plain', cache=False, cache_ttl=None, cache_args=()):
+        """
+        Register a GET endpoint.
+        With cache, its responses are kept in the response cache for cache_ttl seconds,
+        keyed by its URL variables and the query args named in cache_args.
+        """
+        register = self.register(path, 'GET', mimetype)
+        if not cache:
+            return register
+
+        def decorator(func):
+            self._cache_policies[func.__name__] = (cache_ttl, tuple(cache_args))
+            return register(func)
+        return decorator
+
+    def post(self, path, mimetype='text/plain'):
+        """
+        Register a POST endpoint.
+        """
+        return self.register(path, 'POST', mimetype)
+    
+    def put(self, path, mimetype='text/plain'):
+        """
+        Register a PUT endpoint.
+        """
+        return self.register(path, 'PUT', mimetype)
+
+    def delete(self, path, mimetype='text/plain'):
+        """
+        Register a DELETE endpoint.
+        """
+        return self.register(path, 'DELETE', mimetype)
+
+    def register(self, path, method='GET', mimetype='text/plain'):
+        """
+        Register a general endpoint.
+        """
+        def decorator(func):
+            self._funcs[func.__name__] = func
+            self._add_route_func(path, method, func.__name__, mimetype)
+            return func
+        return decorator
+    
+    def add_filter(self, name, filter_func):
+        """
+        Add a new URL variable filter function to this app.
+        """
+        self._filters[name] = filter_func
+
+    def static(self, resource, mimetype='text/plain'):
+        """
+        Define a static resource in the static location.
+        """
+        self._static[os.path.join(self._static_path, resource)] = (resource, mimetype)
+
+    def static_page(self, path, resource, mimetype='text/html'):
+        """
+        Associate a static URL with a static resource.
+        """
+        self._static[path] = (resource, mimetype)
+
+    def set_static_path(self, path):
+        """
+        Set the static resource location. This is the 'base' directory for the app.
+        """
+        self._static_path = path
+        self._static_index.directory = self._static_dir()
+        self._static_index.clear()
+
+    def set_root(self, path):
+        """
+        Set the directory static resources and the static path are relative to.
+        Defaults to the working directory when the app was made.
+        """
+        self._root = os.path.realpath(path)
+        self._static_index.directory = self._static_dir()
+        self._static_index.clear()
+        self._static_cache.clear()
+
+    def set_static_index(self, index):
+        """
+        Replace the static directory index, i.e. with a StaticIndex with another refresh interval.
+        """
+        index.directory = self._static_dir()
+        self._static_index = index
+
+    def refresh_static_index(self):
+        """
+        Rebuild the static directory index now, i.e. after new files are deployed.
+        """
+        self._static_index.refresh()
+
+    def set_static_cache(self, cache):
+        """
+        Replace the static file cache, i.e. with a StaticCache of a different size.
+        """
+        self._static_cache = cache
+
+    def set_static_cache_control(self, value):
+        """
+        Set the Cache-Control header of static files, i.e. 'public, max-age=3600'. None sends none.
+        """
+        self._static_cache_control = value
+        self._static_cache.clear()
+
+    def set_concurrency_limit(self, max_in_flight, max_queue=0, queue_timeout=None):
+        """
+        Limit the requests the app handles at once. Up to max_queue more wait, for at most
+        queue_timeout seconds, for a slot. Other requests get a 503 at once.
+        None for max_in_flight removes the limit.
+        """
+        self._limit = None if max_in_flight is None else \
+                ConcurrencyLimit(max_in_flight, max_queue, queue_timeout)
+        return self._limit
+
+    def set_route_limit(self, func_name, max_in_flight, max_queue=0, queue_timeout=None):
+        """
+        Limit the requests one endpoint handles at once, like set_concurrency_limit.
+        Responses from the response cache don't count.
+        """
+        if func_name not in self._funcs:
+            raise RouteError('No endpoint function {0}.'.format(func_name))
+        if max_in_flight is None:
+            self._route_limits.pop(func_name, None)
+            return None
+        limit = self._route_limits[func_name] = ConcurrencyLimit(max_in_flight, max_queue, queue_timeout)
+        return limit
 
-        # Static file cache. Static resources are read from disk only once.
-        self._static_cache = {}
+    def set_body_parser(self, parser):
+        """
+        Replace the request body parser, i.e. with a BodyParser with other limits.
+        """
+        self._body_parser = parser
 
-    def __call__(self, *args, **kwargs):
+    def set_response_cache(self, cache):
         """
-        WSGI standard requires an app to be callable.
+        Replace the endpoint response cache, i.e. with a ResponseCache of a different size.
         """
-        return self._wsgi_interface(*args, **kwargs)
+        self._response_cache = cache
 
-    def get(self, path, mimetype='text/plain'):
+    def invalidate_cache(self, func_name, **kwargs):
         """
-        Register a GET endpoint.
+        Drop the cached responses of an endpoint.
+        Given URL variables in kwargs, only the responses for those values are dropped,
+        on every route of the endpoint.
         """
-        return self.register(path, 'GET', mimetype)
+        url_vars = Beaker._cache_url_vars(kwargs) if kwargs else None
+        self._response_cache.invalidate(func_name, url_vars)
 
-    def post(self, path, mimetype='text/plain'):
+    def set_stream_threshold(self, size):
         """
-        Register a POST endpoint.
+        Set the file size in bytes at which static files are streamed instead of cached.
         """
-        return self.register(path, 'POST', mimetype)
+        self._stream_threshold = size
     
-    def put(self, path, mimetype='text/plain'):
+    def set_compression(self, min_size=1024, level=6, mimetypes=None):
         """
-        Register a PUT endpoint.
+        Set the smallest body in bytes worth compressing, None to turn compression off,
+        the zlib compression level, and the mimetypes to compress.
         """
-        return self.register(path, 'PUT', mimetype)
+        self._compress_min_size = min_size
+        self._compress_level = level
+        self._compress_types = frozenset(Beaker._COMPRESSIBLE if mimetypes is None else mimetypes)
+        self._static_cache.clear()
 
-    def delete(self, path, mimetype='text/plain'):
+    def set_query_limits(self, max_args=256, max_length=8192):
         """
-        Register a DELETE endpoint.
+        Set the most URL parameters, and the longest query string, a request may have.
+        Requests over either limit get a 400 response.
         """
-        return self.register(path, 'DELETE', mimetype)
+        self._max_query_args = max_args
+        self._max_query_length = max_length
 
-    def register(self, path, method='GET', mimetype='text/plain'):
+    def error(self, error_code, mimetype='text/plain'):
         """
-        Register a general endpoint.
+        Use the 'error' decorator to define error functions.
         """
-        def decorator(func):
-            self._funcs[func.__name__] = func
-            self._add_route_func(path, method, func.__name__, mimetype)
-            return func
+        def decorator(error_func):
+            self._error_handlers[error_code] = (error_func, mimetype)
+            return error_func
         return decorator
-    
-    def add_filter(self, name, filter_func):
+
+    def before_request(self, func):
         """
-        Add a new URL variable filter function to this app.
+        Decorator for a function called with each request before it is dispatched.
+        If it returns a Response, that is the response and the request is not dispatched.
         """
-        self._filters[name] = filter_func
+        self._before_request.append(func)
+        return func
 
-    def static(self, resource, mimetype='text/plain'):
+    def after_request(self, func):
         """
-        Define a static resource in the static location.
+        Decorator for a function called with each request and its response.
+        It returns the response to send, usually the one it was given.
         """
-        self._static[os.path.join(self._static_path, resource)] = (resource, mimetype)
+        self._after_request.append(func)
+        return func
 
-    def static_page(self, path, resource, mimetype='text/html'):
+    def enable_stats(self, path=None):
         """
-        Associate a static URL with a static resource.
+        Start timing requests. Returns the RequestStats collecting them.
+        If path is given, a GET endpoint there serves the stats as JSON, or a 404 while stats
+        are disabled.
         """
-        self._static[path] = (resource, mimetype)
+        self._stats = RequestStats()
+        if path is not None:
+            def beaker_stats(req):
+                stats = self._stats
+                if stats is None:
+                    return self._create_error_response(404, 'File not found.')
+                return Response(status=200, body=json.dumps(stats.snapshot(), sort_keys=True))
+            self.get(path, mimetype='application/json')(beaker_stats)
+        return self._stats
 
-    def set_static_path(self, path):
+    def disable_stats(self):
         """
-        Set the static resource location. This is the 'base' directory for the app.
+        Stop timing requests.
         """
-        self._static_path = path
-    
-    def error(self, error_code, mimetype='text/plain'):
+        self._stats = None
+
+    def start_capture(self, file_name, max_body=1024 * 1024, keep_credentials=False):
         """
-        Use the 'error' decorator to define error functions.
+        Start recording every request that comes in through the WSGI interface to file_name.
+        Returns the TrafficCapture recording them. Replay the file with replay_beaker.py.
+        Authorization, Cookie and Proxy-Authorization headers are left out unless
+        keep_credentials is set.
         """
-        def decorator(error_func):
-            self._error_handlers[error_code] = (error_func, mimetype)
-            return error_func
-        return decorator
+        self.stop_capture()
+        self._capture = TrafficCapture(file_name, max_body, keep_credentials)
+        return self._capture
+
+    def stop_capture(self):
+        """
+        Stop recording requests and close the capture file.
+        """
+        capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.close()
 
     def redirect(self, path, req):
         """
         Redirect this request to the given path.
+        The request has already been admitted and is timed as one, so it skips both,
+        and it is already running through the request hooks, so it only dispatches:
+        the returned Response is finished along with the original request.
         """
         req.path = path
-        return self.request(req)
+        res = self._check_request(req)
+        if res is not None:
+            return res
+        if req.path in self._static:
+            return self._handle_static_request(req)
+        return self._handle_endpoint_request(req)
 
     def url_for(self, func_name, **kwargs):
         """
@@ -226,63 +1947,203 @@ class Beaker:
                 url_paths.append(paths[i])
         return list_to_path(url_paths)
 
+    def freeze(self):
+        """
+        Build everything that is otherwise built on the first request, i.e. the dispatch table.
+        Called by pygi before it serves, so a bad route fails at startup with a RouteError,
+        and forked workers share the table instead of each building their own.
+        """
+        if self._dispatch is None:
+            self._dispatch = self._compile_routes()
+        self._static_index.refresh()
+
+    def route_table(self):
+        """
+        Return every route as a [method, path, func_name, mimetype] list, sorted.
+        The table is plain JSON, and load_route_table registers it again.
+        """
+        table = []
+        self._collect_routes(self._routes, table)
+        return sorted(table)
+
+    def load_route_table(self, table, funcs=None):
+        """
+        Register the routes of a table from route_table.
+        Endpoint functions are looked up by name in funcs, then in the functions registered already.
+        """
+        funcs = funcs or {}
+        for method, path, func_name, mimetype in table:
+            func = funcs.get(func_name, self._funcs.get(func_name))
+            if func is None:
+                raise RouteError('No function {0} for route {1} {2}.'.format(func_name, method, path))
+            self._funcs[func_name] = func
+            self._add_route_func(path, method, func_name, mimetype)
+
+    def _collect_routes(self, routes, table):
+        for key, value in routes.items():
+            if isinstance(key, tuple) and key[0] == Beaker._FUNC_KEY:
+                func_name, mimetype, route_vars, path = value
+                table.append([key[1], path, func_name, mimetype])
+            elif isinstance(value, dict):
+                self._collect_routes(value, table)
+
     def _add_route_func(self, path, method, func_name, mimetype):
         """
         Recursively breaks down the path into dictionaries, like a filesystem folder structure.
         Stores a mapping to the endpoint function at the end of the path.
         """
-        paths = self._replace_path_vars(path, method, func_name)
-        self._func_routes[func_name] = paths
+        if method not in Beaker._VALID_METHODS:
+            raise RouteError('Invalid HTTP method {0} for route {1}.'.format(method, path))
+        paths, route_vars = self._replace_path_vars(path)
         routes = self._routes
         func_signature = (Beaker._FUNC_KEY, method)
-        for i in range(len(paths)):
-            key = paths[i]
-            if key not in routes:
-                routes[key] = {}
-            routes = routes[key]
-        routes[func_signature] = (func_name, mimetype)
+        for key in paths:
+            routes = routes.setdefault(key, {})
+        existing = routes.get(func_signature)
+        if existing is not None and existing[0] != func_name:
+            raise RouteError('Route {0} {1} for {2} clashes with {3} {4} for {5}.'.format(
+                    method, path, func_name, method, existing[3], existing[0]))
+        routes[func_signature] = (func_name, mimetype, route_vars, path)
+        self._func_routes[func_name] = paths
+        self._func_vars[func_name] = [(filter_name, var) for index, filter_name, var in route_vars]
+        self._dispatch = None
 
-    def _find_route_func(self, path, method):
+    def _compile_routes(self):
         """
-        Walks the route tree.
-        Return the tuple (func, mimetype, func_route) or None.
+        Compile the route tree into a dispatch table, one entry per method.
+        Each entry is a tuple (static, root):
+        static: maps fully literal paths to endpoints, a single dict lookup.
+        root:   a trie of (children, var_child, endpoint) tuples for paths with URL variables.
+        Endpoints are (func, mimetype, route_vars, path) tuples, where route_vars holds a
+        (path index, filter function, name) tuple for each URL variable, and path is the
+        route as it was registered.
+        Raises RouteError for a route with an unknown filter.
+        """
+        dispatch = {}
+        for method in Beaker._VALID_METHODS:
+            static = {}
+            root = self._compile_node(self._routes, method, [], static)
+            if root is not None:
+                dispatch[method] = (static, root)
+        return dispatch
+
+    def _compile_node(self, routes, method, prefix, static):
+        """
+        Compile one level of the route tree for this method.
+        Returns None if nothing below this level handles the method.
         """
-        paths = path_to_list(path)
-        routes = self._routes
-        func_route = tuple()
         func_signature = (Beaker._FUNC_KEY, method)
-        for i in range(len(paths)):
-            key = paths[i]
-            if key in routes:
-                routes = routes[key]
-                func_route += (key, )
-            elif Beaker._VAR_KEY in routes:
-                routes = routes[Beaker._VAR_KEY]
-                func_route += Beaker._VAR_KEY
-            else:
-                return None
-        if func_signature not in routes:
+        children = {}
+        var_child = None
+        endpoint = None
+        for key, value in routes.items():
+            if key == func_signature:
+                func_name, mimetype, route_vars, path = value
+                endpoint = (self._funcs[func_name], mimetype,
+                            tuple(self._resolve_filter(filter_name, var, index, path)
+                                  for index, filter_name, var in route_vars), path)
+                if None not in prefix:
+                    static['/'.join(prefix)] = endpoint
+            elif key == Beaker._VAR_KEY:
+                var_child = self._compile_node(value, method, prefix + [None], static)
+            elif not isinstance(key, tuple):
+                child = self._compile_node(value, method, prefix + [key], static)
+                if child is not None:
+                    children[key] = child
+        if not children and var_child is None and endpoint is None:
+            return None
+        return (children, var_child, endpoint)
+
+    def _resolve_filter(self, filter_name, var, index, path):
+        """
+        The compiled (index, filter function, name) entry of a URL variable.
+        """
+        if filter_name not in self._filters:
+            raise RouteError('Unknown filter {0} for <{1}> in route {2}.'.format(filter_name, var, path))
+        return (index, self._filters[filter_name], var)
+
+    def _find_route_func(self, path, method, timer=None):
+        """
+        Match a path against the compiled routes.
+        Return the tuple (func, mimetype, kwargs, route) or None, where route is the
+        path the endpoint was registered with.
+        kwargs is None if a URL variable failed its filter.
+        """
+        dispatch = self._dispatch
+        if dispatch is None:
+            # Concurrent first requests may each compile, the tables are identical.
+            dispatch = self._dispatch = self._compile_routes()
+        if method not in dispatch:
             return None
-        func_name, mimetype = routes[func_signature]
-        return (func_name, mimetype, func_route)
+        static, root = dispatch[method]
+        path = path.strip('/')
+        endpoint = static.get(path)
+        if endpoint is None:
+            parts = path.split('/')
+            endpoint = Beaker._match_node(root, parts, 0)
+            if endpoint is None:
+                if timer is not None:
+                    timer.mark('route_match')
+                return None
+        func, mimetype, route_vars, route = endpoint
+        if timer is not None:
+            timer.mark('route_match')
+            timer.route = func.__name__
+        kwargs = {}
+        if route_vars:
+            # Only trie routes have variables, and each knows where its values sit in parts.
+            try:
+                for index, filter_func, var in route_vars:
+                    kwargs[var] = filter_func(parts[index])
+            except ValueError:
+                kwargs = None
+        if timer is not None:
+            timer.mark('kwarg_filter')
+        return (func, mimetype, kwargs, route)
+
+    @staticmethod
+    def _match_node(node, paths, i):
+        """
+        Walk the compiled trie, trying exact matches before variables.
+        Returns the endpoint or None.
+        """
+        if i == len(paths):
+            return node[2]
+        children, var_child, endpoint = node
+        child = children.get(paths[i])
+        if child is not None:
+            endpoint = Beaker._match_node(child, paths, i + 1)
+            if endpoint is not None:
+                return endpoint
+        if var_child is not None:
+            return Beaker._match_node(var_child, paths, i + 1)
+        return None
 
-    def _replace_path_vars(self, path, method, func_name):
+    def _replace_path_vars(self, path):
         """
-        Populates the dictionary self._func_vars this function's URL vars and their filter type.
-        Returns a list representing this path with vars replaced with Beaker._VAR_KEY.
+        Returns a list representing this path with vars replaced with Beaker._VAR_KEY,
+        and a (path index, filter name, var) tuple for each of its URL vars.
+        Filters are looked up when the routes are compiled, so they may be added later.
+        Raises RouteError for a malformed or repeated variable.
         """
         paths = path_to_list(path)
+        route_vars = []
+        names = set()
         for i, path_part in enumerate(paths):
             var = check_var(path_part)
-            if var is not None:
-                paths[i] = Beaker._VAR_KEY
-                filter_func = str
-                if ':' in var:
-                    filter_name, var = var.split(':')
-                    if filter_name in self._filters:
-                        filter_func = self._filters[filter_name]
-                self._func_vars[func_name].append((filter_func, var))
-        return paths
+            if var is None:
+                if '<' in path_part or '>' in path_part:
+                    raise RouteError('URL variables must be a whole path segment: {0}.'.format(path))
+                continue
+            filter_name = 'str'
+            if ':' in var:
+                filter_name, var = var.split(':', 1)
+            if not var.isidentifier() or var in names:
+                raise RouteError('Bad or repeated URL variable <{0}> in {1}.'.format(var, path))
+            names.add(var)
+            paths[i] = Beaker._VAR_KEY
+            route_vars.append((i, filter_name, var))
+        return paths, tuple(route_vars)
 
     
     def _create_error_response(self, status, message=None):
@@ -306,71 +2167,612 @@ class Beaker:
         Validates Request and dispatches to appropriate handler.
         Returns a Response object with appropriate fields.
         """
+        stats = self._stats
+        timer = req.timer = RequestTimer() if stats is not None else None
+        limit = self._limit
+        if limit is not None and not self._admit(limit, timer):
+            res = self._overloaded(timer)
+        else:
+            try:
+                res = self._handle_request(req)
+            finally:
+                if limit is not None:
+                    limit.release()
+        if timer is not None:
+            stats.record(timer, res.status)
+        return res
+
+    def _handle_request(self, req):
+        """
+        Run an admitted request through the hooks and its handler, and finish its response.
+        """
         try:
-            is_valid_req = self._validate_request(req)
-            if is_valid_req is not None:
-                return self._create_error_response(400, is_valid_req)
-            if os.path.join(self._static_path, req.path) in self._static_cache:
-                static_data, mimetype = self._static_cache[self._static_path + req.path]
-                return Response(status=200, body=static_data, mimetype=mimetype)
-            elif req.path in self._static:
-                return self._handle_static_request(req)
-            else:
-                return self._handle_endpoint_request(req)
+            res = self._prepare_request(req)
+            if res is None:
+                if req.path in self._static:
+                    res = self._handle_static_request(req)
+                else:
+                    res = self._handle_endpoint_request(req)
+            return self._finish_response(req, res)
         except Exception as e:
-            #raise e
-            error_msg = 'Internal Server Error: {0}.'.format(repr(e))
-            return self._create_error_response(500, error_msg)
-    
-    def _get_kwargs(self, path, func_route, func_name):
+            return self._exception_response(e, req.timer)
+
+    async def request_async(self, req):
         """
-        Find the mapping of function args to values for this endpoint.
+        Awaitable version of request, for servers running an asyncio event loop.
+        Coroutine endpoints are awaited on the loop.
+        Plain endpoints and static file reads run in the loop's default executor.
         """
-        path_list = path_to_list(path)
-        func_vars = self._func_vars[func_name]
-        kwargs = {}
+        stats = self._stats
+        timer = req.timer = RequestTimer() if stats is not None else None
+        limit = self._limit
+        if limit is not None and not await self._admit_async(limit, timer):
+            res = self._overloaded(timer)
+        else:
+            try:
+                res = await self._handle_request_async(req)
+            finally:
+                if limit is not None:
+                    limit.release()
+        if timer is not None:
+            stats.record(timer, res.status)
+        return res
+
+    async def _handle_request_async(self, req):
+        """
+        Awaitable version of _handle_request.
+        Steps that may block, i.e. app hooks, file checks and compressing a big body,
+        run in the executor. The rest stays on the loop, where it is cheaper than a thread hop.
+        """
+        loop = asyncio.get_running_loop()
         try:
-            for (key, value) in zip(func_vars, filter(lambda e: e not in func_route, path_list)):
-                filter_func, var = key
-                kwargs[var] = filter_func(value)
-            return kwargs
-        except ValueError:
+            if self._before_request or self._static_cache.due(req.path):
+                # Hooks are app code like plain endpoints, a due static cache entry is checked with os.stat.
+                res = await loop.run_in_executor(None, self._prepare_request, req)
+            else:
+                res = self._prepare_request(req)
+            if res is None:
+                if req.path in self._static:
+                    res = await loop.run_in_executor(None, self._handle_static_request, req)
+                else:
+                    res = await self._handle_endpoint_request_async(req)
+            if self._finish_blocks(req, res):
+                return await loop.run_in_executor(None, self._finish_response, req, res)
+            return self._finish_response(req, res)
+        except Exception as e:
+            return self._exception_response(e, req.timer)
+
+    def _finish_blocks(self, req, res):
+        """
+        Whether _finish_response would hold up an event loop for res: after_request hooks
+        are app code, a Range request maps the file, and compressing a body over
+        _LOOP_COMPRESS_SIZE bytes takes a while.
+        """
+        if self._after_request or (res.status == 200 and req.header('Range') is not None):
+            return True
+        body = res.body
+        return (isinstance(body, (str, bytes)) and len(body) > Beaker._LOOP_COMPRESS_SIZE
+                and self._compress_min_size is not None and res.mimetype in self._compress_types
+                and not res._encoded and not (res._headers and 'Content-Encoding' in res._headers)
+                and self._accepted_encoding(req) is not None)
+
+    def _prepare_request(self, req):
+        """
+        The steps before a request is dispatched: before_request hooks, validation and
+        the static cache. Returns a Response if one of them answers the request, otherwise None.
+        """
+        res = None
+        if self._before_request:
+            res = self._run_before_request(req)
+        if res is None:
+            res = self._check_request(req)
+        return res
+
+    def _finish_response(self, req, res):
+        """
+        The steps every response goes through once it is made:
+        after_request hooks, conditional requests and compression.
+        The encoding is picked first, so conditional requests see the ETag that is sent.
+        """
+        if self._after_request:
+            res = self._run_after_request(req, res)
+        encoding = None
+        if self._compress_min_size is not None:
+            encoding = self._response_encoding(req, res)
+        if res._headers and res.status == 200 and req.method == 'GET':
+            res = self._check_conditional(req, res)
+            if res.status == 200 and encoding is None and 'Accept-Ranges' in res._headers:
+                range_header = req.header('Range')
+                if range_header is not None:
+                    res = self._check_range(req, res, range_header)
+        if encoding is not None and res.body is not None:
+            res = self._compress_response(req, res, encoding)
+            if res._variants is not None and not self._after_request:
+                # after_request hooks may change the body of each response, so copies are only
+                # kept without them, and the hooks run on the raw body of every hit.
+                self._response_cache.add_variant(res, encoding)
+        return res
+
+    def _check_conditional(self, req, res):
+        """
+        Answer a conditional GET with a bodyless 304 if the client's copy of res is current.
+        If-None-Match is checked against the ETag, If-Modified-Since against Last-Modified.
+        """
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return res
+        if_none_match = req.header('If-None-Match')
+        if if_none_match is not None:
+            if etag is None or not etag_matches(if_none_match, etag):
+                return res
+        else:
+            if_modified_since = req.header('If-Modified-Since')
+            if if_modified_since is None or last_modified is None:
+                return res
+            if if_modified_since != last_modified:
+                since = parse_http_date(if_modified_since)
+                modified = parse_http_date(last_modified)
+                if since is None or modified is None or modified > since:
+                    return res
+        if res.file is not None:
+            res.file.close()
+        headers = dict((name, value) for name, value in res.headers.items()
+                       if name != 'Content-Encoding')
+        return Response(status=304, body=None, mimetype=res.mimetype, headers=headers)
+
+    def _check_range(self, req, res, range_header):
+        """
+        Answer a Range request for a static file with 206 Partial Content, or with a
+        multipart/byteranges body when several ranges are asked for.
+        If-Range has to match the ETag or Last-Modified, otherwise the whole file is sent.
+        Streamed files are mapped with mmap, so only the requested bytes are read.
+        """
+        if_range = req.header('If-Range')
+        if if_range is not None and if_range != res.headers.get('ETag') \
+                and if_range != res.headers.get('Last-Modified'):
+            return res
+        if res.file is not None:
+            size = os.fstat(res.file.fileno()).st_size
+        else:
+            data = res.body.encode('utf-8') if isinstance(res.body, str) else res.body
+            size = len(data)
+        ranges = parse_range(range_header, size)
+        if ranges is None:
+            return res
+        headers = dict(res.headers)
+        if not ranges:
+            if res.file is not None:
+                res.file.close()
+            error = self._create_error_response(416, 'Requested range not satisfiable.')
+            error.headers['Content-Range'] = 'bytes */{0}'.format(size)
+            return error
+        if res.file is not None:
+            with res.file:
+                data = mmap.mmap(res.file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end - 1, size)
+            buffers = [view[start:end]]
+            mimetype = res.mimetype
+        else:
+            boundary = os.urandom(12).hex()
+            buffers = []
+            for start, end in ranges:
+                buffers.append('--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'
+                               .format(boundary, res.mimetype, start, end - 1, size).encode('ascii'))
+                buffers.append(view[start:end])
+                buffers.append(b'\r\n')
+            buffers.append('--{0}--\r\n'.format(boundary).encode('ascii'))
+            mimetype = 'multipart/byteranges; boundary={0}'.format(boundary)
+        headers['Content-Length'] = str(sum(len(buffer) for buffer in buffers))
+        if req.timer is not None:
+            req.timer.mark('range')
+        return Response(status=206, body=buffer_blocks(buffers, Beaker._BLOCK_SIZE),
+                        mimetype=mimetype, headers=headers)
+
+    def _run_before_request(self, req):
+        """
+        Call the before_request hooks, returns the first Response one of them returns.
+        """
+        for hook in self._before_request:
+            res = hook(req)
+            if res is not None:
+                return res
+        if req.timer is not None:
+            req.timer.mark('before_request')
+        return None
+
+    def _run_after_request(self, req, res):
+        """
+        Call the after_request hooks, each one gets the response returned by the last.
+        """
+        for hook in self._after_request:
+            res = hook(req, res)
+        if req.timer is not None:
+            req.timer.mark('after_request')
+        return res
+
+    def _accepted_encoding(self, req):
+        """
+        The content encoding to compress responses to req with, None if there is none.
+        """
+        if self._compress_min_size is None:
+            return None
+        return choose_encoding(req.header('Accept-Encoding'))
+
+    def _compressible(self, mimetype, size):
+        """
+        Check if a body of this mimetype and size should be compressed.
+        """
+        return (self._compress_min_size is not None and mimetype in self._compress_types
+                and size >= self._compress_min_size)
+
+    def _response_encoding(self, req, res):
+        """
+        The content encoding to compress the body of res with for the client, None to send it
+        as it is. Compressible bodies get Vary, and the ETag of one that is compressed gets
+        the encoding as a suffix, like _encoded_headers.
+        Streamed bodies, files, parts, static files and bodies compressed already are left alone.
+        """
+        body = res.body
+        if res._encoded or res.file is not None or res.mimetype not in self._compress_types:
+            return None
+        if not isinstance(body, (str, bytes)) or (res._headers and (
+                'Content-Encoding' in res._headers or 'Content-Range' in res._headers)):
             return None
+        min_size = self._compress_min_size
+        # A str is never longer than its UTF-8 encoding, so only short ones need encoding to tell.
+        if len(body) < min_size and (isinstance(body, bytes) or len(body.encode('utf-8')) < min_size):
+            return None
+        res.headers['Vary'] = 'Accept-Encoding'
+        encoding = self._accepted_encoding(req)
+        if encoding is not None and 'ETag' in res.headers:
+            res.headers['ETag'] = encoded_etag(res.headers['ETag'], encoding)
+        return encoding
+
+    def _compress_response(self, req, res, encoding):
+        """
+        Compress the body of res with the encoding _response_encoding picked.
+        """
+        body = res.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        res.body = compress(body, encoding, self._compress_level)
+        res.headers['Content-Encoding'] = encoding
+        if req.timer is not None:
+            req.timer.mark('compress')
+        return res
+
+    def _admit(self, limit, timer):
+        """
+        Wait for a slot of a ConcurrencyLimit. Returns False if the request is refused.
+        """
+        admitted = limit.acquire()
+        if timer is not None:
+            timer.mark('admission')
+        return admitted
+
+    async def _admit_async(self, limit, timer):
+        """
+        _admit without blocking the event loop.
+        """
+        admitted = await limit.acquire_async()
+        if timer is not None:
+            timer.mark('admission')
+        return admitted
+
+    def _overloaded(self, timer):
+        """
+        The 503 response for a request refused by a ConcurrencyLimit.
+        """
+        res = self._create_error_response(503, 'Server busy, try again later.')
+        res.headers['Retry-After'] = '1'
+        if timer is not None:
+            timer.mark('error_handler')
+        return res
+
+    def _exception_response(self, e, timer):
+        """
+        The response for an exception raised while handling a request.
+        A WSGI server's input stream may raise a BodyError subclass of its own for a broken
+        body, like pygi's InputError for one over max_body.
+        """
+        if isinstance(e, BodyError):
+            return self._body_error(e, timer)
+        return self._internal_error(e, timer)
+
+    def _body_error(self, e, timer):
+        """
+        The 400 or 413 response for a request body that could not be parsed.
+        """
+        res = self._create_error_response(e.status, str(e))
+        if timer is not None:
+            timer.error = True
+            timer.mark('error_handler')
+        return res
+
+    def _internal_error(self, e, timer):
+        """
+        The 500 response for an exception raised while handling a request.
+        """
+        error_msg = 'Internal Server Error: {0}.'.format(repr(e))
+        res = self._create_error_response(500, error_msg)
+        if timer is not None:
+            timer.error = True
+            timer.mark('error_handler')
+        return res
 
-    def _check_filesystem(self, file_name, mimetype=None):
+    def _check_request(self, req):
+        """
+        Validate the request and look it up in the static cache.
+        Returns a Response if that answers the request, otherwise None.
+        """
+        timer = req.timer
+        is_valid_req = self._validate_request(req)
+        if timer is not None:
+            timer.mark('validation')
+        if is_valid_req is not None:
+            res = self._create_error_response(400, is_valid_req)
+            if timer is not None:
+                timer.mark('error_handler')
+            return res
+        cached = self._static_cache.get(req.path, self._accepted_encoding(req))
+        if timer is not None:
+            timer.mark('static_cache')
+        if cached is not None:
+            if timer is not None:
+                timer.route = 'static'
+            static_data, mimetype, headers = cached
+            res = Response(status=200, body=static_data, mimetype=mimetype,
+                           headers=dict(headers) if headers else None)
+            res._encoded = True
+            return res
+        return None
+    
+    def _check_filesystem(self, file_name, mimetype=None, cache_key=None, encoding=None):
         """
         Check the filesystem for a file that might not be a registered endpoint or static resource.
+        The file is cached under cache_key, the request path, if given.
+        Compressible files are cached with a gzip copy, read from file_name.gz if that is
+        up to date, otherwise compressed once here, and with a deflate copy compressed here.
+        The copy for encoding is served.
+        Files at or above the stream threshold are returned open in Response.file, not cached.
         Returns a Response containing the resource or Not Found.
         """
-        full_path = os.path.join(os.path.realpath('.'), file_name)
+        full_path = os.path.join(self._root, file_name)
         if not os.path.isfile(full_path):
             return self._create_error_response(404, 'File not found.')
-        with open(full_path, 'rb') as static_file:
-            static_data = static_file.read()
         if mimetype is None:
             file_type = file_name.rsplit('.', 1).pop()
             if file_type in Beaker._MIMETYPES:
                 mimetype = Beaker._MIMETYPES[file_type]
             else:
                 mimetype = 'text/plain'
-        self._static_cache[file_name] = (static_data, mimetype)
-        return Response(status=200, body=static_data, mimetype=mimetype)
+        static_file = open(full_path, 'rb')
+        stat = os.fstat(static_file.fileno())
+        if stat.st_size >= self._stream_threshold:
+            headers = self._static_headers(None, stat)
+            if encoding == 'gzip' and self._compressible(mimetype, stat.st_size):
+                gzip_file = self._open_precompressed(full_path, stat)
+                if gzip_file is not None:
+                    static_file.close()
+                    return Response(status=200, body=None, mimetype=mimetype, file=gzip_file,
+                                    headers=self._encoded_headers(headers, 'gzip'))
+            return Response(status=200, body=None, mimetype=mimetype, file=static_file,
+                            headers=headers)
+        with static_file:
+            static_data = static_file.read()
+        headers = self._static_headers(static_data, stat)
+        variants = None
+        if self._compressible(mimetype, len(static_data)):
+            gzip_file = self._open_precompressed(full_path, stat)
+            if gzip_file is not None:
+                with gzip_file:
+                    gzip_data = gzip_file.read()
+            else:
+                gzip_data = compress(static_data, 'gzip', self._compress_level)
+            if len(gzip_data) < len(static_data):
+                deflate_data = compress(static_data, 'deflate', self._compress_level)
+                variants = {'gzip': (gzip_data, self._encoded_headers(headers, 'gzip')),
+                            'deflate': (deflate_data, self._encoded_headers(headers, 'deflate'))}
+                headers['Vary'] = 'Accept-Encoding'
+        self._static_cache.put(cache_key or file_name, full_path, static_data, mimetype, stat,
+                               variants, headers)
+        if encoding is not None and variants:
+            static_data, headers = variants[encoding]
+        res = Response(status=200, body=static_data, mimetype=mimetype, headers=dict(headers))
+        # A file without copies is not compressible, or no copy was smaller than it.
+        res._encoded = True
+        return res
+
+    def _static_headers(self, data, stat):
+        """
+        Validators and caching headers for a static file, computed once when it is read.
+        Cached files get an ETag hashed from their contents,
+        streamed files, where data is None, one made from their mtime and size.
+        """
+        if data is None:
+            etag = '"{0:x}-{1:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        else:
+            etag = '"{0}"'.format(hashlib.blake2b(data, digest_size=8).hexdigest())
+        headers = {'ETag': etag, 'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+                   'Accept-Ranges': 'bytes'}
+        if self._static_cache_control is not None:
+            headers['Cache-Control'] = self._static_cache_control
+        return headers
+
+    def _encoded_headers(self, headers, encoding):
+        """
+        The headers of a compressed copy of a static file, whose ETag must differ from the raw file's.
+        """
+        encoded_headers = dict(headers)
+        encoded_headers['ETag'] = encoded_etag(headers['ETag'], encoding)
+        encoded_headers['Content-Encoding'] = encoding
+        encoded_headers['Vary'] = 'Accept-Encoding'
+        return encoded_headers
+
+    def _static_dir(self):
+        """
+        The static directory, self._static_path under self._root.
+        """
+        return os.path.join(self._root, self._static_path.strip('/'))
+
+    def _open_precompressed(self, full_path, stat):
+        """
+        Open the precompressed full_path.gz next to a file, if there is one at least as new as it.
+        """
+        try:
+            gzip_file = open(full_path + '.gz', 'rb')
+        except OSError:
+            return None
+        if os.fstat(gzip_file.fileno()).st_mtime < stat.st_mtime:
+            gzip_file.close()
+            return None
+        return gzip_file
 
-    
     def _handle_endpoint_request(self, req):
         """
         Handle calling and returning data from registered endpoint.
         Returns a Response containing the data or Not Found.
         """
-        func_data = self._find_route_func(req.path, req.method)
+        func_data = self._find_route_func(req.path, req.method, req.timer)
+        if not func_data:
+            return self._handle_unrouted_request(req, self._static_index.find(req.path))
+        res, cache_key, limit = self._before_handler(req, func_data)
+        if res is not None:
+            return res
+        if limit is not None and not self._admit(limit, req.timer):
+            return self._overloaded(req.timer)
+        func, mimetype, kwargs, route = func_data
+        try:
+            res = func(req, **kwargs)
+            if asyncio.iscoroutine(res):
+                # A coroutine endpoint called outside an event loop, i.e. from a WSGI server.
+                res = asyncio.run(res)
+        finally:
+            if limit is not None:
+                limit.release()
+        return self._after_handler(req, res, mimetype, cache_key)
+
+    async def _handle_endpoint_request_async(self, req):
+        """
+        Awaitable version of _handle_endpoint_request, sharing the same routes.
+        """
+        loop = asyncio.get_running_loop()
+        func_data = self._find_route_func(req.path, req.method, req.timer)
         if not func_data:
-            file_path = os.path.join(self._static_path, req.path)
-            return self._check_filesystem(file_path)
-        func_name, mimetype, func_route = func_data
-        kwargs = self._get_kwargs(req.path, func_route, func_name)
+            if self._static_index.in_memory():
+                file_path = self._static_index.find(req.path)
+            else:
+                file_path = await loop.run_in_executor(None, self._static_index.find, req.path)
+            if file_path is None:
+                return self._handle_unrouted_request(req, None)
+            return await loop.run_in_executor(None, self._handle_unrouted_request, req, file_path)
+        res, cache_key, limit = self._before_handler(req, func_data)
+        if res is not None:
+            return res
+        if limit is not None and not await self._admit_async(limit, req.timer):
+            return self._overloaded(req.timer)
+        func, mimetype, kwargs, route = func_data
+        try:
+            if asyncio.iscoroutinefunction(func):
+                res = await func(req, **kwargs)
+            else:
+                # The response is hashed for the cache in the same thread hop as the call.
+                call = functools.partial(func, req, **kwargs)
+                return await loop.run_in_executor(None, lambda: self._after_handler(
+                        req, call(), mimetype, cache_key))
+        finally:
+            if limit is not None:
+                limit.release()
+        return self._after_handler(req, res, mimetype, cache_key)
+
+    def _handle_unrouted_request(self, req, file_path):
+        """
+        Answer a request that matched no route with the static file the index found for it,
+        at file_path, or Not Found if there is none.
+        """
+        if file_path is None:
+            res = self._create_error_response(404, 'File not found.')
+        else:
+            res = self._check_filesystem(file_path, cache_key=req.path,
+                                         encoding=self._accepted_encoding(req))
+        if req.timer is not None:
+            req.timer.mark('filesystem')
+        return res
+
+    def _before_handler(self, req, func_data):
+        """
+        The steps between matching an endpoint and calling it.
+        Returns (res, cache_key, limit): res is a Response if the request is answered without
+        calling the handler, i.e. from the response cache, cache_key the key to cache the
+        handler's response under, and limit the endpoint's ConcurrencyLimit, if any.
+        """
+        timer = req.timer
+        func, mimetype, kwargs, route = func_data
         if kwargs is None:
-            return self._create_error_response(400, 'Wrong type in URL variable.')
-        res = self._funcs[func_name](req, **kwargs)
+            res = self._create_error_response(400, 'Wrong type in URL variable.')
+            if timer is not None:
+                timer.mark('error_handler')
+            return res, None, None
+        cache_key = None
+        if self._cache_policies and func.__name__ in self._cache_policies and req.method == 'GET':
+            cache_key = self._response_cache_key(req, func.__name__, route, kwargs)
+            res = self._response_cache.get(cache_key, self._accepted_encoding(req))
+            if timer is not None:
+                timer.mark('response_cache')
+            if res is not None:
+                return res, None, None
+        limit = self._route_limits.get(func.__name__) if self._route_limits else None
+        return None, cache_key, limit
+
+    def _after_handler(self, req, res, mimetype, cache_key):
+        """
+        Finish the Response an endpoint returned, and cache it if its endpoint is cached.
+        """
+        if req.timer is not None:
+            req.timer.mark('handler')
+        res = self._endpoint_response(res, mimetype)
+        if cache_key is not None:
+            self._cache_response(cache_key, res)
+        return res
+
+    def _response_cache_key(self, req, func_name, route, kwargs):
+        """
+        The response cache key of a request to a cached endpoint, matched on route.
+        URL variables are keyed by their converted values, so '/item/07' and '/item/7'
+        share a key when the variable is an int. Only the query args the route names are used.
+        """
+        cache_args = self._cache_policies[func_name][1]
+        args = tuple((name, tuple(req.args.getlist(name))) for name in cache_args) if cache_args else ()
+        return (func_name, route, Beaker._cache_url_vars(kwargs), args)
+
+    @staticmethod
+    def _cache_url_vars(kwargs):
+        """
+        URL variables as the sorted (name, value) pairs of a response cache key.
+        Values are strings, as url_for puts them in a URL, so filters may return unhashable values.
+        """
+        return tuple(sorted((name, str(value)) for name, value in kwargs.items()))
+
+    def _cache_response(self, cache_key, res):
+        """
+        Keep a 200 response of a cached endpoint, with an ETag so repeat clients get a 304.
+        Streamed and file responses are not cached.
+        """
+        if res.status != 200 or res.file is not None or not isinstance(res.body, (str, bytes)):
+            return
+        if 'ETag' not in res.headers:
+            body = res.body.encode('utf-8') if isinstance(res.body, str) else res.body
+            res.headers['ETag'] = '"{0}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest())
+        self._response_cache.put(cache_key, res, self._cache_policies[cache_key[0]][0])
+
+    def _endpoint_response(self, res, mimetype):
+        """
+        Fill in the fields of an endpoint's Response that come from its registration.
+        """
         res.mimetype = mimetype
         if not res.status:
             res.status = 200
@@ -383,7 +2785,12 @@ class Beaker:
         Returns a Response containing the file content or Not Found.
         """
         filename, mimetype = self._static[req.path]
-        return self._check_filesystem(filename, mimetype)
+        res = self._check_filesystem(filename, mimetype, cache_key=req.path,
+                                     encoding=self._accepted_encoding(req))
+        if req.timer is not None:
+            req.timer.route = 'static'
+            req.timer.mark('static_file')
+        return res
 
     def _validate_request(self, req):
         """
@@ -393,10 +2800,11 @@ class Beaker:
         if req.method not in Beaker._VALID_METHODS:
             return 'Invalid HTTP method.'
         if req.query:
-            try:
-                req.args = {k: v for (k, v) in (var.split('=') for var in req.query.split('&'))}
-            except ValueError:
-                return 'Malformed URL Parameters.'
+            # Only the limits are checked here, req.args is parsed when it is first used.
+            if len(req.query) > self._max_query_length:
+                return 'URL parameters too long.'
+            if req.query.count('&') >= self._max_query_args:
+                return 'Too many URL parameters.'
         return None
     
     def _parse_env(self, env):
@@ -404,17 +2812,79 @@ class Beaker:
                 path=env['PATH_INFO'],
                 method=env['REQUEST_METHOD'],
                 query=env['QUERY_STRING'],
-                args={},
                 body=env['wsgi.input'],
+                environ=env,
+                body_parser=self._body_parser,
             )
         return req
 
     def _wsgi_interface(self, environ, start_response):
         req = self._parse_env(environ)
-        res = self.request(req)
-        headers = [('Content-Length', str(len(res.body))),
-                   ('Content-Type', res.mimetype)]
+        capture = self._capture
+        if capture is None:
+            res = self.request(req)
+        else:
+            entry = capture.start(req)
+            res = self.request(req)
+            if entry is not None:
+                capture.record(entry, res)
+        return self._wsgi_response(res, environ, start_response)
+
+    async def call_async(self, environ, start_response):
+        """
+        Awaitable counterpart of the WSGI interface, used by pygi's AsyncServer.
+        Takes the same arguments and returns the same body iterable.
+        """
+        req = self._parse_env(environ)
+        capture = self._capture
+        if capture is None:
+            res = await self.request_async(req)
+        else:
+            entry = capture.start(req)
+            res = await self.request_async(req)
+            if entry is not None:
+                capture.record(entry, res)
+        return self._wsgi_response(res, environ, start_response)
+
+    def _wsgi_response(self, res, environ, start_response):
+        """
+        Start the WSGI response for res and return its body iterable.
+        """
+        content_type = Beaker._CONTENT_TYPES.get(res.mimetype)
+        if content_type is None:
+            content_type = ('Content-Type', res.mimetype)
+            if len(Beaker._CONTENT_TYPES) < Beaker._MAX_CONTENT_TYPES:
+                Beaker._CONTENT_TYPES[res.mimetype] = content_type
+        if res.file is not None:
+            length = os.fstat(res.file.fileno()).st_size - res.file.tell()
+            headers = [('Content-Length', str(length)), content_type]
+            if res._headers:
+                headers.extend(res._headers.items())
+            start_response(Beaker._HTTP_CODES[res.status], headers)
+            file_wrapper = environ.get('wsgi.file_wrapper', read_blocks)
+            return file_wrapper(res.file, Beaker._BLOCK_SIZE)
+        body = res.body
+        if body is None:
+            body = b''
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            # A streamed body. Without a Content-Length the server chunks it or closes after it.
+            headers = [content_type]
+            if res._headers:
+                headers.extend(res._headers.items())
+            start_response(Beaker._HTTP_CODES[res.status], headers)
+            if hasattr(body, '__aiter__'):
+                return encode_blocks_async(body)
+            return encode_blocks(body)
+        if res.status == 304:
+            # Not Modified has no body, and no Content-Length for it.
+            headers = [content_type]
+        else:
+            headers = [('Content-Length', str(len(body))), content_type]
+        if res._headers:
+            headers.extend(res._headers.items())
         start_response(Beaker._HTTP_CODES[res.status], headers)
-        return [res.body]
+        return [body]
 
 
@@ -0,0 +1,297 @@
+"""
+Benchmarks for Beaker and pygi.
+
+Three layers, each run over route tables of several sizes:
+micro:  Beaker.request for static, variable, deep path and 404 routes
+wsgi:   the same routes through the WSGI interface, Beaker.__call__
+server: a load generator driving pygi over loopback with keep-alive clients
+
+Every result is printed as one line of JSON. Pass --output to also save the whole run,
+and --compare with a saved run to fail on regressions.
+
+    python bench_beaker.py --layer micro --sizes 10,100,1000
+    python bench_beaker.py --output before.json
+    python bench_beaker.py --compare before.json --threshold 0.1
+"""
+
+import argparse
+import io
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+
+from beaker import Beaker
+from beaker import Request
+from beaker import Response
+
+
+def build_app(size):
+    """
+    Build an app with size routes, a mix of static, variable and deep paths.
+    """
+    app = Beaker('Benchmark App')
+    for i in range(size):
+        kind = i % 3
+        if kind == 0:
+            path = '/static{0}/page'.format(i)
+        elif kind == 1:
+            path = '/item{0}/<int:item_id>'.format(i)
+        else:
+            path = '/deep{0}/a/b/c/<name>/d/<int:n>'.format(i)
+        app.register(path, 'GET')(make_handler('handler{0}'.format(i)))
+    return app
+
+
+def make_handler(name):
+    def handler(req, **kwargs):
+        return Response(body='ok', status=200)
+    handler.__name__ = name
+    return handler
+
+
+def cases(size):
+    """
+    The request paths benchmarked against a table of size routes, from its last routes.
+    """
+    last = size - 1
+    static = last - (last % 3)
+    variable = static + 1 if static + 1 < size else static - 2
+    deep = static + 2 if static + 2 < size else static - 1
+    return [
+            ('static', '/static{0}/page'.format(static)),
+            ('variable', '/item{0}/42'.format(variable)),
+            ('deep', '/deep{0}/a/b/c/bob/d/7'.format(deep)),
+            ('not_found', '/no/such/route'),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(layer, case, size, latencies, elapsed, requests):
+    """
+    Build a result dict from per-request latencies in seconds.
+    """
+    latencies = sorted(latencies)
+    return {
+            'layer': layer,
+            'case': case,
+            'routes': size,
+            'requests': requests,
+            'ops_per_sec': round(requests / elapsed, 1) if elapsed else 0.0,
+            'mean_us': round(sum(latencies) / len(latencies) * 1e6, 3) if latencies else 0.0,
+            'p50_us': round(percentile(latencies, 0.5) * 1e6, 3),
+            'p99_us': round(percentile(latencies, 0.99) * 1e6, 3),
+    }
+
+
+def time_calls(call, iterations, batches):
+    """
+    Run call iterations times in each of batches batches, timing every call.
+    Returns the latency of each call, total elapsed time and the number of calls.
+    """
+    call()
+    clock = time.perf_counter
+    latencies = []
+    record = latencies.append
+    elapsed = 0.0
+    for b in range(batches):
+        start = clock()
+        for i in range(iterations):
+            before = clock()
+            call()
+            record(clock() - before)
+        elapsed += clock() - start
+    return latencies, elapsed, iterations * batches
+
+
+def bench_micro(size, iterations, batches):
+    app = build_app(size)
+    results = []
+    for case, path in cases(size):
+        def call():
+            app.request(Request(method='GET', path=path))
+        latencies, elapsed, requests = time_calls(call, iterations, batches)
+        results.append(summarize('micro', case, size, latencies, elapsed, requests))
+    return results
+
+
+def bench_wsgi(size, iterations, batches):
+    app = build_app(size)
+    results = []
+
+    def start_response(status, headers):
+        pass
+
+    for case, path in cases(size):
+        def call():
+            environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', 'QUERY_STRING': '',
+                       'wsgi.input': io.BytesIO()}
+            for block in app(environ, start_response):
+                pass
+        latencies, elapsed, requests = time_calls(call, iterations, batches)
+        results.append(summarize('wsgi', case, size, latencies, elapsed, requests))
+    return results
+
+
+def read_response(client, buffer):
+    """
+    Read one Content-Length framed response from a keep-alive connection.
+    Returns the rest of the buffer.
+    """
+    while b'\r\n\r\n' not in buffer:
+        data = client.recv(65536)
+        if not data:
+            raise IOError('Connection closed by server.')
+        buffer += data
+    head, buffer = buffer.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, value = line.split(b':', 1)
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while len(buffer) < length:
+        data = client.recv(65536)
+        if not data:
+            raise IOError('Connection closed by server.')
+        buffer += data
+    return buffer[length:]
+
+
+def run_client(port, path, count, latencies):
+    client = socket.create_connection(('127.0.0.1', port))
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    raw = 'GET {0} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode('ascii')
+    buffer = b''
+    try:
+        for i in range(count):
+            start = time.perf_counter()
+            client.sendall(raw)
+            buffer = read_response(client, buffer)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        client.close()
+
+
+def bench_server(size, requests, clients, threads):
+    import server
+    server.LOG = False
+    app = build_app(size)
+    pygi = server.Server(0, app, host='127.0.0.1', threads=threads, max_requests=requests + 1)
+    port = pygi.server_socket.getsockname()[1]
+    serving = threading.Thread(target=pygi.serve)
+    serving.daemon = True
+    serving.start()
+    results = []
+    per_client = max(1, requests // clients)
+    try:
+        for case, path in cases(size):
+            latencies = []
+            workers = [threading.Thread(target=run_client, args=(port, path, per_client, latencies))
+                       for c in range(clients)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            results.append(summarize('server', case, size, latencies, elapsed, len(latencies)))
+    finally:
+        stop_server(pygi, serving)
+    return results
+
+
+def stop_server(pygi, serving):
+    """
+    Stop a pygi Server serving in the thread serving, and close its port.
+    """
+    pygi._running = False
+    # The accept loop only checks the flag between connections, so wake it with one.
+    socket.create_connection(pygi.server_socket.getsockname()[:2]).close()
+    serving.join(5)
+    pygi.server_socket.close()
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the results whose throughput fell more than threshold below the baseline run.
+    """
+    previous = dict(((r['layer'], r['case'], r['routes']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get((result['layer'], result['case'], result['routes']))
+        if before and before['ops_per_sec'] and \
+                result['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            regressions.append({'layer': result['layer'], 'case': result['case'],
+                                'routes': result['routes'], 'before': before['ops_per_sec'],
+                                'after': result['ops_per_sec']})
+    return regressions
+
+
+def run(layers, sizes, iterations=2000, batches=5, requests=2000, clients=4, threads=4, out=None):
+    """
+    Run the chosen layers over every route table size. Returns the list of results.
+    """
+    results = []
+    for size in sizes:
+        batch = []
+        if 'micro' in layers:
+            batch += bench_micro(size, iterations, batches)
+        if 'wsgi' in layers:
+            batch += bench_wsgi(size, iterations, batches)
+        if 'server' in layers:
+            batch += bench_server(size, requests, clients, threads)
+        for result in batch:
+            if out is not None:
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+                out.flush()
+        results += batch
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Beaker and pygi.')
+    parser.add_argument('--layer', default='all', choices=['micro', 'wsgi', 'server', 'all'])
+    parser.add_argument('--sizes', default='10,100,1000', help='Comma separated route table sizes.')
+    parser.add_argument('--iterations', type=int, default=2000, help='Calls per batch.')
+    parser.add_argument('--batches', type=int, default=5, help='Batches per micro/wsgi case.')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per server case.')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent load generator clients.')
+    parser.add_argument('--threads', type=int, default=4, help='pygi worker threads.')
+    parser.add_argument('--output', help='Save the run as JSON to this file.')
+    parser.add_argument('--compare', help='A saved run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Throughput drop, as a fraction, that counts as a regression.')
+    args = parser.parse_args(argv)
+
+    layers = ['micro', 'wsgi', 'server'] if args.layer == 'all' else [args.layer]
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(layers, sizes, args.iterations, args.batches, args.requests,
+                  args.clients, args.threads, out=sys.stdout)
+    report = {
+            'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            sys.stdout.write(json.dumps(dict(regression, regression=True), sort_keys=True) + '\n')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Replay traffic captured with Beaker.start_capture against a Beaker app.
+
+Two modes:
+inprocess: every request through Beaker.request, back to back, as fast as possible
+server:    over loopback against pygi, at the captured rate times --speed, or flat out with --speed 0
+
+Prints one line of JSON with throughput and latency percentiles, followed by one line for each
+response whose status or body differs from the captured one, up to --max-diffs.
+
+    python replay_beaker.py traffic.jsonl --app app:app
+    python replay_beaker.py traffic.jsonl.gz --app app:app --mode server --speed 4 --clients 8
+"""
+
+import argparse
+import base64
+import gzip
+import importlib
+import io
+import json
+import socket
+import sys
+import threading
+import time
+
+from beaker import Request
+from beaker import TrafficCapture
+from beaker import body_digest
+from bench_beaker import percentile
+from bench_beaker import stop_server
+
+
+def load_capture(file_name):
+    """
+    Read a capture file into a list of request records, in arrival order,
+    with arrival times counted from the first request.
+    """
+    opener = gzip.open if file_name.endswith('.gz') else open
+    with opener(file_name, 'rt', encoding='utf-8') as capture:
+        entries = [json.loads(line) for line in capture if line.strip()]
+    entries.sort(key=lambda entry: entry['t'])
+    if entries:
+        first = entries[0]['t']
+        for entry in entries:
+            entry['t'] -= first
+    return entries
+
+
+def repeat_entries(entries, rounds):
+    """
+    The entries of load_capture replayed rounds times over. Each round starts one mean
+    inter-arrival gap after the last request of the one before, so rounds keep the
+    captured spacing and never overlap. A single request has no gap, its rounds arrive at once.
+    """
+    if len(entries) < 2:
+        return [dict(entry) for r in range(rounds) for entry in entries]
+    span = entries[-1]['t']
+    period = span + span / (len(entries) - 1)
+    return [dict(entry, t=entry['t'] + r * period) for r in range(rounds) for entry in entries]
+
+
+def entry_body(entry):
+    return base64.b64decode(entry['b']) if 'b' in entry else b''
+
+
+def entry_request(entry):
+    """
+    Build the Request a captured record describes.
+    """
+    return Request(method=entry['m'], path=entry['p'], query=entry['q'] or None,
+                   body=io.BytesIO(entry_body(entry)), headers=dict(entry['h']))
+
+
+def diff(entry, status, length, digest):
+    """
+    Compare a replayed response with the captured one. Returns a dict describing
+    the difference, or None if they match. Streamed bodies only have their status compared.
+    """
+    if status == entry['s'] and (digest is None or entry['d'] is None or digest == entry['d']):
+        return None
+    return {'method': entry['m'], 'path': entry['p'], 'query': entry['q'],
+            'status': [entry['s'], status], 'length': [entry['n'], length]}
+
+
+def replay_in_process(app, entries):
+    """
+    Send every record through app.request in order.
+    Returns per-request latencies, total elapsed time and the list of diffs.
+    """
+    latencies = []
+    diffs = []
+    start = time.perf_counter()
+    for entry in entries:
+        req = entry_request(entry)
+        before = time.perf_counter()
+        res = app.request(req)
+        latencies.append(time.perf_counter() - before)
+        length, digest = TrafficCapture.summarize(res)
+        if res.file is not None:
+            res.file.close()
+        elif hasattr(res.body, 'close'):
+            res.body.close()
+        difference = diff(entry, res.status, length, digest)
+        if difference is not None:
+            diffs.append(difference)
+    return latencies, time.perf_counter() - start, diffs
+
+
+def raw_request(entry):
+    """
+    The bytes of a captured record as an HTTP/1.1 request on a keep-alive connection.
+    """
+    body = entry_body(entry)
+    target = entry['p'] + ('?' + entry['q'] if entry['q'] else '')
+    lines = ['{0} {1} HTTP/1.1'.format(entry['m'], target)]
+    for name, value in entry['h'].items():
+        if name.lower() not in ('connection', 'content-length', 'transfer-encoding'):
+            lines.append('{0}: {1}'.format(name, value))
+    if 'Host' not in entry['h']:
+        lines.append('Host: localhost')
+    if body:
+        lines.append('Content-Length: {0}'.format(len(body)))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1') + body
+
+
+def read_response(client, buffer):
+    """
+    Read one response from a keep-alive connection, framed by Content-Length or chunked.
+    Returns (status, body, whether the body was chunked, whether the server closes, rest of buffer).
+    """
+    def fill(buffer):
+        data = client.recv(65536)
+        if not data:
+            raise IOError('Connection closed by server.')
+        return buffer + data
+
+    while b'\r\n\r\n' not in buffer:
+        buffer = fill(buffer)
+    head, buffer = buffer.split(b'\r\n\r\n', 1)
+    lines = head.split(b'\r\n')
+    status = int(lines[0].split(b' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, value = line.split(b':', 1)
+        headers[name.strip().lower()] = value.strip()
+    closes = headers.get(b'connection', b'').lower() == b'close'
+    if status in (204, 304):
+        return status, b'', False, closes, buffer
+    if headers.get(b'transfer-encoding', b'').lower() == b'chunked':
+        chunks = []
+        while True:
+            while b'\r\n' not in buffer:
+                buffer = fill(buffer)
+            size_line, buffer = buffer.split(b'\r\n', 1)
+            size = int(size_line.split(b';', 1)[0], 16)
+            while len(buffer) < size + 2:
+                buffer = fill(buffer)
+            chunks.append(buffer[:size])
+            buffer = buffer[size + 2:]
+            if not size:
+                return status, b''.join(chunks), True, closes, buffer
+    length = int(headers.get(b'content-length', 0))
+    while len(buffer) < length:
+        buffer = fill(buffer)
+    return status, buffer[:length], False, closes, buffer[length:]
+
+
+def run_client(port, entries, start, speed, latencies, diffs):
+    """
+    Replay entries in order on one keep-alive connection, each at its captured arrival time
+    divided by speed, or back to back if speed is 0.
+    """
+    client = None
+    buffer = b''
+    try:
+        for entry in entries:
+            if speed:
+                delay = start + entry['t'] / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if client is None:
+                client = socket.create_connection(('127.0.0.1', port))
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                buffer = b''
+            before = time.perf_counter()
+            client.sendall(raw_request(entry))
+            status, body, chunked, closes, buffer = read_response(client, buffer)
+            latencies.append(time.perf_counter() - before)
+            digest = None if chunked else body_digest(body)
+            difference = diff(entry, status, len(body), digest)
+            if difference is not None:
+                diffs.append(difference)
+            if closes:
+                client.close()
+                client = None
+    finally:
+        if client is not None:
+            client.close()
+
+
+def replay_server(app, entries, speed=1.0, clients=4, threads=4):
+    """
+    Serve app with pygi on a loopback port and replay entries against it from clients
+    connections. Records are dealt round robin, so each connection keeps the captured order.
+    Returns per-request latencies, total elapsed time and the list of diffs.
+    """
+    import server
+    server.LOG = False
+    pygi = server.Server(0, app, host='127.0.0.1', threads=threads,
+                         max_requests=len(entries) + 1, queue_size=max(64, clients))
+    port = pygi.server_socket.getsockname()[1]
+    serving = threading.Thread(target=pygi.serve)
+    serving.daemon = True
+    serving.start()
+    latencies = []
+    diffs = []
+    start = time.perf_counter()
+    workers = [threading.Thread(target=run_client,
+                                args=(port, entries[c::clients], start, speed, latencies, diffs))
+               for c in range(clients)]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(pygi, serving)
+    return latencies, elapsed, diffs
+
+
+def report(mode, latencies, elapsed, diffs):
+    latencies = sorted(latencies)
+    return {
+            'mode': mode,
+            'requests': len(latencies),
+            'ops_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'mean_us': round(sum(latencies) / len(latencies) * 1e6, 3) if latencies else 0.0,
+            'p50_us': round(percentile(latencies, 0.5) * 1e6, 3),
+            'p90_us': round(percentile(latencies, 0.9) * 1e6, 3),
+            'p99_us': round(percentile(latencies, 0.99) * 1e6, 3),
+            'max_us': round(latencies[-1] * 1e6, 3) if latencies else 0.0,
+            'diffs': len(diffs),
+    }
+
+
+def load_app(spec):
+    """
+    Import an app given as 'module:attribute', i.e. 'app:app'.
+    """
+    module_name, _, attribute = spec.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'app')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured traffic against a Beaker app.')
+    parser.add_argument('capture', help='A file written by Beaker.start_capture.')
+    parser.add_argument('--app', default='app:app', help='The app to replay against, module:attribute.')
+    parser.add_argument('--mode', default='inprocess', choices=['inprocess', 'server'])
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Server mode rate, as a multiple of the captured rate. 0 for flat out.')
+    parser.add_argument('--clients', type=int, default=4, help='Server mode client connections.')
+    parser.add_argument('--threads', type=int, default=4, help='pygi worker threads.')
+    parser.add_argument('--repeat', type=int, default=1, help='Times to replay the capture.')
+    parser.add_argument('--max-diffs', type=int, default=20, help='Diffs printed.')
+    parser.add_argument('--fail-on-diff', action='store_true',
+                        help='Exit with status 1 if any response differs from the capture.')
+    args = parser.parse_args(argv)
+
+    app = load_app(args.app)
+    entries = load_capture(args.capture)
+    if args.repeat > 1:
+        entries = repeat_entries(entries, args.repeat)
+    if args.mode == 'inprocess':
+        latencies, elapsed, diffs = replay_in_process(app, entries)
+    else:
+        latencies, elapsed, diffs = replay_server(app, entries, args.speed, args.clients, args.threads)
+    sys.stdout.write(json.dumps(report(args.mode, latencies, elapsed, diffs), sort_keys=True) + '\n')
+    for difference in diffs[:args.max_diffs]:
+        sys.stdout.write(json.dumps(dict(difference, diff=True), sort_keys=True) + '\n')
+    if diffs and args.fail_on_diff:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,433 @@
 import socket
+import sys
 import time
 import io
+import os
+import gc
+import signal
+import traceback
 import pprint
+import threading
+import queue
+import random
+import asyncio
+import concurrent.futures
+import tempfile
+from email.utils import formatdate
+
+from beaker import BodyError
 
 CRLF = '\r\n'
 LOG = True
 
+# (second, encoded Date header line) for the last second a response was sent in.
+_date_cache = (0, b'')
+
+
+def date_header():
+    """
+    The Date header line as bytes. It only changes once a second, so it is formatted once a second.
+    """
+    global _date_cache
+    now = int(time.time())
+    second, line = _date_cache
+    if second != now:
+        line = 'Date: {0}\r\n'.format(formatdate(now, usegmt=True)).encode('ascii')
+        _date_cache = (now, line)
+    return line
+
+
+class FileWrapper:
+    """
+    pygi's wsgi.file_wrapper.
+    Iterates the file in blocks like any WSGI body, but Server.serve recognises it
+    and hands the file to the kernel with sendfile instead.
+    """
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.block_size)
+        if data:
+            return data
+        raise StopIteration
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+    def fileno(self):
+        """
+        The underlying file descriptor, or None if this is not a real file.
+        """
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+
+
+class AccessLog:
+    """
+    pygi's access log.
+    Requests only put a record on a bounded queue. A background thread formats the
+    records and writes them in batches, so a slow stream never holds up a response.
+    stream:         File to write to, stdout by default.
+    max_queue:      Records waiting for the writer. Records that arrive while it is full
+                    are dropped and counted.
+    batch_size:     Most records written at once.
+    flush_interval: Seconds the writer waits for a batch to fill before writing it.
+    sample:         Fraction of responses logged. Responses with a status of 400 or more
+                    are always logged.
+    format:         Line template, with the fields time, address, method, path,
+                    status, bytes and duration, in milliseconds.
+    """
+
+    FORMAT = '{time} {address} "{method} {path}" {status} {bytes} {duration:.3f}ms\n'
+
+    def __init__(self, stream=None, max_queue=10000, batch_size=256, flush_interval=0.1,
+                 sample=1.0, format=FORMAT):
+        self.stream = stream
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample = sample
+        self.format = format
+        self.logged = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._records = queue.Queue(max_queue)
+        self._writer = None
+        # Counters are bumped by request threads and the writer, under this lock.
+        self._counts = threading.Lock()
+
+    def log(self, method, path, status, size, duration, address):
+        """
+        Record one response. Never blocks.
+        status is the status line, i.e. '200 OK', or None if the app never set one,
+        which is always logged. duration is in seconds.
+        """
+        if self.sample < 1.0 and status and status[0] < '4' and random.random() >= self.sample:
+            with self._counts:
+                self.sampled_out += 1
+            return
+        try:
+            self._records.put_nowait((time.time(), address, method, path, status, size, duration))
+        except queue.Full:
+            with self._counts:
+                self.dropped += 1
+
+    def start(self):
+        """
+        Start the writer thread. Called by the server in every process that serves.
+        """
+        if self._writer is not None and self._writer.is_alive():
+            return
+        # A forked worker gets a fresh queue and lock, the parent's may have been locked mid-fork.
+        self._counts = threading.Lock()
+        pending = self._records
+        self._records = queue.Queue(self.max_queue)
+        while True:
+            try:
+                self._records.put_nowait(pending.get_nowait())
+            except (queue.Empty, queue.Full):
+                break
+        self._writer = threading.Thread(target=self._write, args=(self._records, ))
+        self._writer.daemon = True
+        self._writer.start()
+
+    def close(self):
+        """
+        Write every queued record and stop the writer thread.
+        """
+        if self._writer is None or not self._writer.is_alive():
+            return
+        self._records.put(None)
+        self._writer.join()
+
+    def stats(self):
+        """
+        Return a dict of log counters.
+        """
+        return {'logged': self.logged, 'dropped': self.dropped, 'sampled_out': self.sampled_out,
+                'queued': self._records.qsize()}
+
+    def _write(self, records):
+        """
+        Writer thread loop. Takes records off the queue in batches until it gets None.
+        """
+        while True:
+            batch = [records.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                lines = ''.join(self._format(record) for record in batch)
+                try:
+                    stream = self.stream or sys.stdout
+                    stream.write(lines)
+                    stream.flush()
+                    with self._counts:
+                        self.logged += len(batch)
+                except (OSError, ValueError):
+                    with self._counts:
+                        self.dropped += len(batch)
+            if stop:
+                return
+
+    def _format(self, record):
+        logged_at, address, method, path, status, size, duration = record
+        if isinstance(address, tuple):
+            address = address[0]
+        return self.format.format(
+                time=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(logged_at)),
+                address=address or '-', method=method, path=path, status=(status or '-')[:3],
+                bytes=size, duration=duration * 1000)
+
+
+class RequestError(Exception):
+    """
+    A request pygi refuses before it reaches the app, answered with status and the connection closed.
+    """
+
+    def __init__(self, status, message=''):
+        Exception.__init__(self, message or status)
+        self.status = status
+
+
+class InputError(RequestError, BodyError):
+    """
+    A broken request body found while the app reads wsgi.input, i.e. one over max_body.
+    It is also a beaker BodyError, so Beaker answers it with its status instead of a 500.
+    """
+
+
+class SocketReader:
+    """
+    Buffered reads from a connection.
+    Bytes are received with recv_into straight into one bytearray, reused for every request
+    on the connection. Bytes received past the end of one request stay buffered for the next,
+    pipelined, one. The buffered bytes are buffer[start:end].
+    """
+
+    def __init__(self, connection_socket, recv_size):
+        self.connection_socket = connection_socket
+        self.recv_size = recv_size
+        self.buffer = bytearray(recv_size)
+        # A view of the whole buffer, sliced for recv_into and for copying bytes out.
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def read_until(self, delimiter, limit, error_status=400):
+        """
+        Read up to and including delimiter.
+        Returns None if the connection closes first.
+        Raises RequestError(error_status) if more than limit bytes arrive without it.
+        """
+        search = self.start
+        while True:
+            found = self.buffer.find(delimiter, search, self.end)
+            if found - self.start > limit:
+                raise RequestError(error_status)
+            if found >= 0:
+                found += len(delimiter)
+                data = self.view[self.start:found].tobytes()
+                self.start = found
+                return data
+            if self.end - self.start > limit:
+                raise RequestError(error_status)
+            search = max(self.start, self.end - len(delimiter) + 1)
+            offset = self.start
+            if not self._fill():
+                return None
+            # _fill may have moved the buffered bytes to the front.
+            search -= offset - self.start
+
+    def read(self, size):
+        """
+        Read at most size bytes, at least one unless the connection is closed.
+        Large reads with nothing buffered go straight from the socket to the caller.
+        """
+        if self.start == self.end:
+            if size >= self.recv_size:
+                return self.connection_socket.recv(size)
+            if not self._fill():
+                return b''
+        end = min(self.end, self.start + size)
+        data = self.view[self.start:end].tobytes()
+        self.start = end
+        return data
+
+    def _fill(self):
+        """
+        Receive into the free end of the buffer. Buffered bytes are moved to the front first
+        if the end is full, and the buffer only grows when it is full of one request's head.
+        Returns the number of bytes received, 0 when the connection is closed.
+        """
+        buffered = self.end - self.start
+        if not buffered:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if self.start:
+                self.buffer[:buffered] = self.buffer[self.start:self.end]
+            else:
+                grown = bytearray(2 * len(self.buffer))
+                grown[:buffered] = self.buffer
+                self.buffer = grown
+                self.view = memoryview(grown)
+            self.start, self.end = 0, buffered
+        received = self.connection_socket.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+
+class InputStream:
+    """
+    pygi's wsgi.input.
+    The request body is read from the connection only as the app asks for it. It is bounded
+    by Content-Length, or decoded from chunked transfer encoding and bounded by max_size.
+    """
+
+    # Largest chunk size line or trailer accepted in a chunked body.
+    _MAX_LINE = 4096
+
+    def __init__(self, reader, length=0, chunked=False, max_size=None, send_continue=None):
+        self.reader = reader
+        self.chunked = chunked
+        self.max_size = max_size
+        # Bytes left in the body, or in the current chunk of a chunked body.
+        self.remaining = length
+        self.received = 0
+        self.done = not chunked and not length
+        # Called before the first read, i.e. to answer 'Expect: 100-continue'.
+        self._send_continue = send_continue
+        self._pushback = b''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                data = self._read_some(self.reader.recv_size)
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        chunks = []
+        while size > 0:
+            data = self._read_some(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def readline(self, size=-1):
+        line = b''
+        while size is None or size < 0 or len(line) < size:
+            want = self.reader.recv_size if size is None or size < 0 else size - len(line)
+            data = self._read_some(want)
+            if not data:
+                break
+            newline = data.find(b'\n')
+            if newline >= 0:
+                self._pushback = data[newline + 1:] + self._pushback
+                line += data[:newline + 1]
+                break
+            line += data
+        return line
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if line:
+            return line
+        raise StopIteration
+
+    def drain(self, limit):
+        """
+        Read and drop what the app left of the body, so the next request can be read.
+        Returns False if more than limit bytes were left or the body was bad,
+        the connection can't be reused then.
+        """
+        drained = len(self._pushback)
+        self._pushback = b''
+        try:
+            while drained <= limit:
+                data = self._read_some(self.reader.recv_size)
+                if not data:
+                    return True
+                drained += len(data)
+        except RequestError:
+            pass
+        return False
+
+    def _read_some(self, size):
+        """
+        Read at most size bytes of body, b'' at its end.
+        """
+        if self._pushback:
+            data, self._pushback = self._pushback[:size], self._pushback[size:]
+            return data
+        if self.done:
+            return b''
+        if self._send_continue is not None:
+            self._send_continue()
+            self._send_continue = None
+        if self.chunked and self.remaining == 0:
+            self._next_chunk()
+            if self.done:
+                return b''
+        data = self.reader.read(min(size, self.remaining))
+        if not data:
+            raise InputError(400, 'Connection closed in request body.')
+        self.remaining -= len(data)
+        self.received += len(data)
+        if self.max_size is not None and self.received > self.max_size:
+            raise InputError(413, 'Request body too large.')
+        if self.remaining == 0:
+            if self.chunked:
+                if self.reader.read_until(b'\r\n', 2) != b'\r\n':
+                    raise InputError(400, 'Malformed chunk.')
+            else:
+                self.done = True
+        return data
+
+    def _next_chunk(self):
+        """
+        Read the next chunk size line, and the trailers after the last chunk.
+        """
+        line = self.reader.read_until(b'\r\n', InputStream._MAX_LINE)
+        if line is None:
+            raise InputError(400, 'Connection closed in request body.')
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise InputError(400, 'Malformed chunk size.')
+        if size > 0:
+            self.remaining = size
+            return
+        while True:
+            trailer = self.reader.read_until(b'\r\n', InputStream._MAX_LINE)
+            if trailer is None or trailer == b'\r\n':
+                break
+        self.done = True
+
+
 class Server:
 
 
@@ -18,12 +440,109 @@ class Server:
     parse_request and create_response_str exists to marshall to and from these structures.
     """
 
-    def __init__(self, port, app, host=''):
+    # Seconds a pre-forked worker waits in accept before checking for shutdown.
+    _DRAIN_POLL = 0.5
+
+    # Bytes read from a socket at a time.
+    _RECV_SIZE = 64 * 1024
+
+    # Unread request body the server will read past to reuse a connection.
+    _MAX_DRAIN = 64 * 1024
+
+    # Most entries kept in each of the encoded status line and header line caches.
+    _MAX_CACHED_LINES = 1024
+
+    # Headers whose values repeat across responses, so their encoded lines are worth caching.
+    # Per-response ones like ETag, Last-Modified or Content-Range would only fill the cache.
+    _CACHED_HEADERS = frozenset(['content-type', 'cache-control', 'vary', 'content-encoding',
+                                 'accept-ranges', 'retry-after', 'x-content-type-options'])
+
+    _HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+    # Most buffers one sendmsg call takes, more fail with EMSGSIZE.
+    try:
+        _IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        _IOV_MAX = -1
+    if _IOV_MAX <= 0:
+        _IOV_MAX = 1024
+
+    # Raw header names to their title case form, and title case names to WSGI environ keys.
+    # Clients send the same few headers, so each is only converted once.
+    _HEADER_NAMES = {}
+    _ENVIRON_KEYS = {}
+
+    # Statuses whose responses have no body, so they need no Content-Length or chunking.
+    _BODYLESS = ('204', '304')
+
+    _ERRORS = {
+            400: '400 Bad Request',
+            413: '413 Payload Too Large',
+            431: '431 Request Header Fields Too Large',
+            503: '503 Service Unavailable'
+    }
+
+    def __init__(self, port, app, host='', threads=0, queue_size=64, backlog=128, processes=0,
+                 keep_alive_timeout=5.0, max_requests=100, max_head=64 * 1024,
+                 max_body=100 * 1024 * 1024, queue_timeout=None, access_log=None):
+        """
+        processes:  Worker processes forked by a master that only supervises them.
+                    With 0, this process serves requests itself.
+        threads:    Worker threads handling connections. With 0, connections are handled
+                    one at a time on the accepting thread.
+        queue_size: Accepted connections waiting for a worker. While the queue is full the
+                    server stops accepting, and new clients wait in the listen backlog.
+        backlog:    Listen backlog of the server socket.
+        keep_alive_timeout: Seconds an idle persistent connection is kept open.
+                            Without threads every connection is closed after one response.
+        max_requests:       Requests served on one connection before it is closed.
+        max_head:   Largest request line and headers accepted, in bytes.
+        max_body:   Largest request body accepted, in bytes. None for no limit.
+        queue_timeout: Seconds a connection may wait in the queue for a worker. Connections
+                       that wait longer, or arrive while the queue is full, get a 503 and
+                       are closed. None blocks accepting while the queue is full.
+        access_log: An AccessLog every response is recorded in. Defaults to one writing to
+                    stdout while LOG is set.
+        """
         self.port = port
         self.app = app
         self.host = host
+        self.threads = threads
+        self.queue_size = queue_size
+        self.backlog = backlog
+        self.processes = processes
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_requests = max_requests
+        self.max_head = max_head
+        self.max_body = max_body
+        self.queue_timeout = queue_timeout
+        if access_log is None and LOG:
+            access_log = AccessLog()
+        self.access_log = access_log
+        # Connections refused with a 503 because the queue was full or too slow.
+        self.shed = 0
         self.server_name = 'pygi'
+        # Encoded status lines and header lines, keyed by what they were built from.
+        self._status_lines = {}
+        self._header_lines = {}
+        self._running = False
+        # Idle connections are only kept open when they don't block the only serving thread.
+        self._persistent = bool(threads)
+        self._workers = set()
         self.server_socket = self._create_server_socket()
+        # The environ keys that are the same for every request, copied for each one.
+        self._base_environ = {
+                'SERVER_NAME': self.host or 'localhost',
+                'SERVER_PORT': str(self.server_socket.getsockname()[1]),
+                'SCRIPT_NAME': '',
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': bool(threads),
+                'wsgi.multiprocess': bool(processes),
+                'wsgi.run_once': False,
+                'wsgi.file_wrapper': FileWrapper,
+        }
 
     def _create_server_socket(self):
         """
@@ -32,99 +551,666 @@ class Server:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(1)
+        server_socket.listen(self.backlog)
         return server_socket
 
     def serve(self):
         """
         Server forever.
         """
-        print "Serving at {0}:{1}. Waiting for requests.".format(socket.gethostname(), self.port)
+        if LOG:
+            print("Serving at {0}:{1}. Waiting for requests.".format(socket.gethostname(), self.port))
+        self._freeze_app()
+        if self.processes:
+            self._serve_prefork()
+        else:
+            self._running = True
+            self._serve_forever()
+
+    def _freeze_app(self):
+        """
+        Build anything the app builds lazily, i.e. Beaker's routes, before serving.
+        A bad route then fails at startup rather than on a request.
+        """
+        freeze = getattr(self.app, 'freeze', None)
+        if freeze is not None:
+            freeze()
+
+    def _serve_forever(self):
+        """
+        Accept loop. Runs until self._running is cleared, then finishes queued connections.
+        A prefork worker inherits the flag set by the master, so a stop signal that arrived
+        before the loop started is not lost.
+        """
+        if self.access_log is not None:
+            self.access_log.start()
+        if self.threads:
+            connections = queue.Queue(self.queue_size)
+            workers = []
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._worker, args=(connections, ))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        while self._running:
+            try:
+                connection_socket, address = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            if self.threads and self.queue_timeout is None:
+                # Blocks while every worker is busy and the queue is full.
+                connections.put((connection_socket, address, None))
+            elif self.threads:
+                try:
+                    connections.put_nowait((connection_socket, address, time.monotonic()))
+                except queue.Full:
+                    self._shed(connection_socket)
+            else:
+                self._serve_connection(connection_socket, address)
+        if self.threads:
+            for worker in workers:
+                connections.put(None)
+            for worker in workers:
+                worker.join()
+        if self.access_log is not None:
+            self.access_log.close()
+
+    def _worker(self, connections):
+        """
+        Worker thread loop, handles connections from the accept queue until it gets None.
+        """
         while True:
-            connection_socket, address = self.server_socket.accept()
-            data = connection_socket.recv(1024)
-            #print "LEN: {0}".format(len(data))
-            req = self._parse_request(data)
-            environ = self._create_environ(req)
+            connection = connections.get()
+            if connection is None:
+                return
+            connection_socket, address, queued = connection
+            if queued is not None and time.monotonic() - queued > self.queue_timeout:
+                self._shed(connection_socket)
+                continue
+            self._serve_connection(connection_socket, address)
+
+    def _shed(self, connection_socket):
+        """
+        Refuse a connection the workers can't get to in time with a 503, without reading it.
+        """
+        self.shed += 1
+        try:
+            connection_socket.sendall(self._error_response(503))
+            connection_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        finally:
+            connection_socket.close()
+
+    def _serve_prefork(self):
+        """
+        Master process loop. Forks the workers, replaces any that die,
+        and on SIGTERM or SIGINT lets them drain and waits for them to exit.
+        """
+        # serve has built everything the app builds lazily. Keep the garbage collector from
+        # touching it, so the pages stay shared copy-on-write with the workers.
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for i in range(self.processes):
+            self._spawn_worker()
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self._workers.discard(pid)
+            if self._running:
+                if LOG:
+                    print("Worker {0} exited with status {1}, restarting.".format(pid, status))
+                self._spawn_worker()
+        self.server_socket.close()
+
+    def _spawn_worker(self):
+        """
+        Fork a worker process that accepts on the shared server socket.
+        """
+        # Hold off SIGTERM until the master has recorded the worker and the worker has its
+        # own handlers. Otherwise a stop arriving mid-fork misses the new worker and the
+        # master waits for it forever.
+        stop_signals = (signal.SIGTERM, signal.SIGINT)
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+        pid = os.fork()
+        if pid:
+            self._workers.add(pid)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+            return pid
+        exit_code = 0
+        try:
+            self._workers = set()
+            signal.signal(signal.SIGTERM, self._stop)
+            # Ctrl-C reaches the whole process group, let the master decide.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+            # Accept with a timeout, so a draining worker notices the stop flag.
+            self.server_socket.settimeout(Server._DRAIN_POLL)
+            self._serve_forever()
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _stop(self, signum, frame):
+        """
+        Signal handler. Stops accepting, and in the master tells every worker to drain.
+        """
+        self._running = False
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _serve_connection(self, connection_socket, address):
+        """
+        Handle one connection, making sure a failure never takes down the serving thread.
+        """
+        try:
+            self._handle_connection(connection_socket, address)
+        except Exception as e:
             if LOG:
-                print req['method'], req['path']
-            res_data = self.app(environ, self._start_response_on_socket(connection_socket))
-            for res in res_data:
-                connection_socket.send(res)
+                print("Error handling {0}: {1}".format(address, repr(e)))
             connection_socket.close()
 
-    def _start_response_on_socket(self, connection_socket):
-        def start_response(status, headers):
-            http_headers = [
-                    "HTTP/1.0 {0}".format(status),
-                    "Server: {0}".format(self.server_name),
-                    "Date: {0}".format(time.strftime('%a, %d %b %Y %H:%M:%S %Z'))
-            ]
-            for (header, value) in headers:
-                http_headers.append('{0}: {1}'.format(header, value))
-            response = "{0}{1}{2}".format(CRLF.join(http_headers), CRLF, CRLF)
-            connection_socket.send(response)
+    def _handle_connection(self, connection_socket, address):
+        """
+        Serve requests from one connection until the client closes it, it sits idle for
+        keep_alive_timeout, or it has made max_requests. Pipelined requests are answered in order.
+        """
+        connection_socket.settimeout(self.keep_alive_timeout)
+        reader = SocketReader(connection_socket, Server._RECV_SIZE)
+        served = 0
+        try:
+            while True:
+                try:
+                    head = reader.read_until(b'\r\n\r\n', self.max_head, error_status=431)
+                    if head is None:
+                        break
+                    head = head.lstrip(b'\r\n')
+                    if not head:
+                        continue
+                    req = self._parse_request(head.decode('iso-8859-1'))
+                    req['body'] = self._body_stream(reader, req, connection_socket)
+                    served += 1
+                    keep_alive = self._respond(connection_socket, req, self._keep_alive(req, served),
+                                               address)
+                    if not keep_alive or not req['body'].drain(Server._MAX_DRAIN):
+                        break
+                except socket.timeout:
+                    break
+                except RequestError as e:
+                    connection_socket.sendall(self._error_response(e.status))
+                    break
+        finally:
+            connection_socket.close()
+
+    def _body_stream(self, reader, req, connection_socket):
+        """
+        Build the wsgi.input stream for a request's body.
+        """
+        headers = req['headers']
+        send_continue = None
+        if headers.get('Expect', '').lower() == '100-continue' and req['version'] == 'HTTP/1.1':
+            send_continue = lambda: connection_socket.sendall(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            return InputStream(reader, chunked=True, max_size=self.max_body,
+                               send_continue=send_continue)
+        length = self._content_length(req)
+        return InputStream(reader, length=length, send_continue=send_continue)
+
+    def _content_length(self, req):
+        """
+        The request's Content-Length, checked against max_body.
+        """
+        try:
+            length = int(req['headers'].get('Content-Length', 0))
+        except ValueError:
+            raise RequestError(400, 'Malformed Content-Length.')
+        if length < 0:
+            raise RequestError(400, 'Malformed Content-Length.')
+        if self.max_body is not None and length > self.max_body:
+            raise RequestError(413, 'Request body too large.')
+        return length
+
+    def _error_response(self, status):
+        """
+        A complete response for a request refused before it reached the app.
+        """
+        return "HTTP/1.0 {0}{1}Server: {2}{1}Content-Length: 0{1}Connection: close{1}{1}".format(
+                Server._ERRORS[status], CRLF, self.server_name).encode('iso-8859-1')
+
+    def _keep_alive(self, req, served):
+        """
+        Whether the connection may stay open after answering req.
+        HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only when asked to.
+        """
+        if not self._running or not self._persistent or served >= self.max_requests:
+            return False
+        connection = req['headers'].get('Connection', '').lower()
+        if req['version'] == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def _respond(self, connection_socket, req, keep_alive, address=None):
+        """
+        Call the app for req and write its response, then record it in the access log.
+        Returns whether the connection stays open afterwards.
+        """
+        start = time.perf_counter()
+        environ = self._create_environ(req)
+        response = {'version': req['version'], 'keep_alive': keep_alive, 'head': None,
+                    'status': None}
+        res_data = self.app(environ, self._start_response(response))
+        sent = 0
+        try:
+            if (isinstance(res_data, FileWrapper) and res_data.fileno() is not None
+                    and not response['chunked']):
+                self._send(connection_socket, self._frame(response, b''))
+                # socket.sendfile uses os.sendfile, the file never passes through Python.
+                sent = connection_socket.sendfile(res_data.filelike)
+            elif isinstance(res_data, (list, tuple)):
+                # The whole body is already here, head and body go out in one write.
+                buffers = []
+                for data in res_data:
+                    if data:
+                        sent += len(data)
+                        buffers += self._frame(response, data)
+                self._send(connection_socket, buffers + self._frame(response, b'', last=True))
+            else:
+                for data in res_data:
+                    if data:
+                        sent += len(data)
+                        self._send(connection_socket, self._frame(response, data))
+                self._send(connection_socket, self._frame(response, b'', last=True))
+        finally:
+            if hasattr(res_data, 'close'):
+                res_data.close()
+        if self.access_log is not None:
+            self.access_log.log(req['method'], req['path'], response['status'], sent,
+                                time.perf_counter() - start, address)
+        return response['keep_alive']
+
+    def _send(self, connection_socket, buffers):
+        """
+        Write a list of buffers. sendmsg gathers them into one system call without joining them,
+        up to _IOV_MAX buffers at a time.
+        """
+        if not buffers:
+            return
+        if not Server._HAS_SENDMSG:
+            connection_socket.sendall(b''.join(buffers))
+            return
+        while True:
+            sent = connection_socket.sendmsg(buffers[:Server._IOV_MAX])
+            i = 0
+            while i < len(buffers) and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            if i == len(buffers):
+                return
+            buffers = [memoryview(buffers[i])[sent:]] + buffers[i + 1:]
+
+    def _start_response(self, response):
+        """
+        WSGI start_response for one response. The head is kept in response['head']
+        and goes out with the first piece of body.
+        """
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['head'] = self._format_headers(status, headers, response)
         return start_response
 
+    def _format_headers(self, status, headers, response):
+        """
+        Build the status line and header block of a response, as bytes.
+        Responses without a Content-Length are chunked for HTTP/1.1 clients,
+        and end the connection for HTTP/1.0 ones. 204 and 304 responses never have a body.
+        Status lines and the headers in _CACHED_HEADERS are encoded once and cached.
+        """
+        http11 = response['version'] == 'HTTP/1.1'
+        lines = [self._status_line(http11, status), date_header()]
+        has_length = status[:3] in Server._BODYLESS
+        header_lines = self._header_lines
+        for header in headers:
+            line = header_lines.get(header)
+            if line is None:
+                name, value = header
+                line = '{0}: {1}\r\n'.format(name, value).encode('iso-8859-1')
+                name = name.lower()
+                if name == 'content-length':
+                    has_length = True
+                elif (name in Server._CACHED_HEADERS and 'boundary=' not in value
+                      and len(header_lines) < Server._MAX_CACHED_LINES):
+                    # A multipart Content-Type has a boundary of its own.
+                    header_lines[header] = line
+            lines.append(line)
+        response['chunked'] = not has_length and http11
+        if not has_length and not http11:
+            response['keep_alive'] = False
+        if response['chunked']:
+            lines.append(b'Transfer-Encoding: chunked\r\n')
+        if not response['keep_alive']:
+            lines.append(b'Connection: close\r\n')
+        elif not http11:
+            lines.append(b'Connection: keep-alive\r\n')
+        lines.append(b'\r\n')
+        return b''.join(lines)
+
+    def _status_line(self, http11, status):
+        """
+        The encoded status line followed by the Server header, cached by status.
+        """
+        line = self._status_lines.get((http11, status))
+        if line is None:
+            line = "{0} {1}\r\nServer: {2}\r\n".format(
+                    'HTTP/1.1' if http11 else 'HTTP/1.0', status, self.server_name).encode('iso-8859-1')
+            if len(self._status_lines) < Server._MAX_CACHED_LINES:
+                self._status_lines[(http11, status)] = line
+        return line
+
+    def _frame(self, response, data, last=False):
+        """
+        Frame a piece of response body for the wire, chunking it if needed.
+        Returns a list of buffers, starting with the head if it has not been sent yet.
+        last adds the final chunk.
+        """
+        buffers = []
+        head = response['head']
+        if head is not None:
+            response['head'] = None
+            buffers.append(head)
+        if response['chunked']:
+            if data:
+                buffers += [b'%x\r\n' % len(data), data, b'\r\n']
+            if last:
+                buffers.append(b'0\r\n\r\n')
+        elif data:
+            buffers.append(data)
+        return buffers
+
     def _parse_request(self, request):
         """
-        Marshall a raw HTTP request into a dict.
+        Marshall a raw HTTP request head into a dict.
+        Header names are normalised to title case, i.e. 'Content-Length'.
+
+        Raises RequestError for a malformed head.
 
         Returns dict with keys:
         method  -> str
         path    -> str
         version -> str
         headers -> dict
-        body    -> str
-        """
-        parsed_request = {}
-        request = request.split(CRLF)
-        initial_line = request[0].split()
-        parsed_request['method'] = initial_line[0]
-        parsed_request['path'] = initial_line[1]
-        parsed_request['version'] = initial_line[2]
+        """
+        lines = request.split(CRLF)
+        initial_line = lines[0].split()
+        if len(initial_line) != 3:
+            raise RequestError(400, 'Malformed request line.')
+        header_names = Server._HEADER_NAMES
         headers = {}
-        body_i = 0
-        for i in range(1, len(request)):
-            if request[i] == '':
-                body_i = i + 1
+        for i in range(1, len(lines)):
+            line = lines[i]
+            if not line:
                 break
-            header, value = [e.strip() for e in request[i].split(':', 1)]
-            headers[header] = value
-        parsed_request['headers'] = headers
-        body = request[body_i].strip()
-        parsed_request['body'] = request[body_i].strip()
-        return parsed_request
+            name, colon, value = line.partition(':')
+            if not colon:
+                raise RequestError(400, 'Malformed header.')
+            title = header_names.get(name)
+            if title is None:
+                title = name.strip().title()
+                if len(header_names) < Server._MAX_CACHED_LINES:
+                    header_names[name] = title
+            headers[title] = value.strip()
+        return {'method': initial_line[0], 'path': initial_line[1], 'version': initial_line[2],
+                'headers': headers}
 
 
     def _create_environ(self, req):
         """
         Convert a request dict into a WSGI environ dict.
         """
-        environ = {}
-        args = ''
-        path = req['path']
-        if '?' in path:
-            path, args = path.split('?')
+        environ = self._base_environ.copy()
+        path, _, query = req['path'].partition('?')
         environ['PATH_INFO'] = path
-        environ['QUERY_STRING'] = args
+        environ['QUERY_STRING'] = query
         environ['REQUEST_METHOD'] = req['method']
-        if 'Content-Type' in req['headers']:
-            environ['CONTENT_TYPE'] = req['headers']['Content-Type']
-        if 'Content-Length' in req['headers']:
-            environ['CONTENT_LENGTH'] = req['headers']['Content-Length']
-        if 'Content-Type' in req['headers']:
-            environ['CONTENT_TYPE'] = req['headers']['Content-Type']
-        if 'body' in req:
-            environ['wsgi.input'] = io.StringIO(u'{0}'.format(req['body']))
+        environ['SERVER_PROTOCOL'] = req['version']
+        environ_keys = Server._ENVIRON_KEYS
+        for name, value in req['headers'].items():
+            key = environ_keys.get(name)
+            if key is None:
+                key = name.upper().replace('-', '_')
+                if key != 'CONTENT_TYPE' and key != 'CONTENT_LENGTH':
+                    key = 'HTTP_' + key
+                if len(environ_keys) < Server._MAX_CACHED_LINES:
+                    environ_keys[name] = key
+            environ[key] = value
+        environ['wsgi.input'] = req['body']
         return environ
 
 
-def app(environ, start_response):
-    start_response(200, [])
-    return ['OK']
+class AsyncServer(Server):
+    """
+    pygi on an asyncio event loop.
+
+    Every connection is a task rather than a thread, so idle and slow clients cost
+    almost nothing. Apps with a call_async method, like Beaker, are awaited on the loop.
+    Plain WSGI apps run in the loop's executor.
+    threads sets the size of that executor, processes is not supported.
+    """
+
+    # Request bodies bigger than this are spooled to a temporary file as they arrive.
+    _SPOOL_SIZE = 1024 * 1024
+
+    def serve(self):
+        """
+        Serve forever.
+        """
+        if LOG:
+            print("Serving at {0}:{1}. Waiting for requests.".format(socket.gethostname(), self.port))
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        """
+        Serve forever on the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        self._freeze_app()
+        self._running = True
+        self._persistent = True
+        if self.threads:
+            loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(self.threads))
+        if self.access_log is not None:
+            self.access_log.start()
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self._handle_stream, sock=self.server_socket,
+                                            limit=self.max_head)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.access_log is not None:
+                self.access_log.close()
+
+    async def _handle_stream(self, reader, writer):
+        """
+        Handle one connection, making sure a failure never takes down the loop.
+        """
+        try:
+            await self._handle_connection_async(reader, writer)
+        except Exception as e:
+            if LOG:
+                print("Error handling {0}: {1}".format(writer.get_extra_info('peername'), repr(e)))
+        finally:
+            writer.close()
+
+    async def _handle_connection_async(self, reader, writer):
+        """
+        Serve requests from one stream, with the same keep-alive rules as Server.
+        The body is read, up to max_body, before the app is called, so that
+        wsgi.input never blocks the event loop.
+        """
+        served = 0
+        address = writer.get_extra_info('peername')
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keep_alive_timeout)
+                head = head.lstrip(b'\r\n')
+                if len(head) > self.max_head:
+                    raise RequestError(431)
+                if not head:
+                    continue
+                req = self._parse_request(head[:-4].decode('iso-8859-1'))
+                req['body'] = await self._read_body_async(reader, writer, req)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                break
+            except asyncio.LimitOverrunError:
+                writer.write(self._error_response(431))
+                break
+            except RequestError as e:
+                writer.write(self._error_response(e.status))
+                break
+            served += 1
+            try:
+                keep_alive = await self._respond_async(writer, req, self._keep_alive(req, served), address)
+            finally:
+                req['body'].close()
+            if not keep_alive:
+                break
+
+    async def _read_body_async(self, reader, writer, req):
+        """
+        Read a request's whole body, of Content-Length bytes or chunked, into a file object.
+        Bodies of up to _SPOOL_SIZE bytes are kept in memory, bigger ones are written to
+        a temporary file as they arrive, so a large upload never sits whole in memory.
+        """
+        headers = req['headers']
+        if headers.get('Expect', '').lower() == '100-continue' and req['version'] == 'HTTP/1.1':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' not in headers.get('Transfer-Encoding', '').lower():
+            length = self._content_length(req)
+            if length <= AsyncServer._SPOOL_SIZE:
+                return io.BytesIO(await reader.readexactly(length) if length else b'')
+            body = tempfile.SpooledTemporaryFile(AsyncServer._SPOOL_SIZE)
+            try:
+                await self._spool(reader, body, length)
+            except BaseException:
+                body.close()
+                raise
+            body.seek(0)
+            return body
+        body = tempfile.SpooledTemporaryFile(AsyncServer._SPOOL_SIZE)
+        try:
+            await self._read_chunks_async(reader, body)
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body
+
+    async def _spool(self, reader, body, size):
+        """
+        Copy size bytes from reader to body, a piece at a time.
+        """
+        while size:
+            data = await reader.readexactly(min(size, Server._RECV_SIZE))
+            body.write(data)
+            size -= len(data)
+
+    async def _read_chunks_async(self, reader, body):
+        """
+        Copy a chunked body from reader to body, and skip its trailers.
+        """
+        received = 0
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise RequestError(400, 'Malformed chunk size.')
+            if size == 0:
+                break
+            received += size
+            if self.max_body is not None and received > self.max_body:
+                raise RequestError(413, 'Request body too large.')
+            await self._spool(reader, body, size)
+            if await reader.readexactly(2) != b'\r\n':
+                raise RequestError(400, 'Malformed chunk.')
+        while (await reader.readuntil(b'\r\n')) != b'\r\n':
+            pass
+
+    async def _respond_async(self, writer, req, keep_alive, address=None):
+        """
+        Call the app for req and write its response, then record it in the access log.
+        Returns whether the connection stays open afterwards.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        environ = self._create_environ(req)
+        response = {'version': req['version'], 'keep_alive': keep_alive, 'head': None,
+                    'status': None}
+        start_response = self._start_response(response)
+        call_async = getattr(self.app, 'call_async', None)
+        if call_async is not None:
+            res_data = await call_async(environ, start_response)
+        else:
+            res_data = await loop.run_in_executor(None, self.app, environ, start_response)
+        sent = 0
+        try:
+            if (isinstance(res_data, FileWrapper) and res_data.fileno() is not None
+                    and not response['chunked']):
+                writer.writelines(self._frame(response, b''))
+                await writer.drain()
+                sent = await loop.sendfile(writer.transport, res_data.filelike)
+            elif hasattr(res_data, '__aiter__'):
+                async for data in res_data:
+                    if data:
+                        sent += len(data)
+                        writer.writelines(self._frame(response, data))
+                        await writer.drain()
+                writer.writelines(self._frame(response, b'', last=True))
+            elif isinstance(res_data, (list, tuple)):
+                for data in res_data:
+                    if data:
+                        sent += len(data)
+                        writer.writelines(self._frame(response, data))
+                writer.writelines(self._frame(response, b'', last=True))
+            else:
+                # A generator may block while producing a block, so step it in the executor.
+                blocks = iter(res_data)
+                while True:
+                    data = await loop.run_in_executor(None, next, blocks, None)
+                    if data is None:
+                        break
+                    if data:
+                        sent += len(data)
+                        writer.writelines(self._frame(response, data))
+                        await writer.drain()
+                writer.writelines(self._frame(response, b'', last=True))
+        finally:
+            if hasattr(res_data, 'aclose'):
+                await res_data.aclose()
+            elif hasattr(res_data, 'close'):
+                res_data.close()
+        await writer.drain()
+        if self.access_log is not None:
+            self.access_log.log(req['method'], req['path'], response['status'], sent,
+                                time.perf_counter() - start, address)
+        return response['keep_alive']
+
+if __name__ == '__main__':
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [b'OK']
 
-server = Server(5000, app)
-server.serve()
+    server = Server(5000, app)
+    server.serve()
 
 
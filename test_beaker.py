@@ -41,6 +41,56 @@ def assert_res(res, status=None, body=None):
                 body[:200], res.status)
         assert res.body == body, msg
 
+def wsgi_call(wsgi_app, path, method='GET', query='', environ=None):
+    """
+    Call a WSGI app directly, return (status, headers, body).
+    """
+    import io
+    env = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'QUERY_STRING': query,
+           'wsgi.input': io.BytesIO()}
+    env.update(environ or {})
+    started = {}
+    def start_response(status, headers):
+        started['status'] = status
+        started['headers'] = dict(headers)
+    result = wsgi_app(env, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+def serve_in_thread(wsgi_app, **kwargs):
+    """
+    Start a pygi Server for wsgi_app on a free loopback port, return the port.
+    """
+    import threading
+    import server
+    server.LOG = False
+    server_class = kwargs.pop('server_class', server.Server)
+    pygi = server_class(0, wsgi_app, host='127.0.0.1', **kwargs)
+    thread = threading.Thread(target=pygi.serve)
+    thread.daemon = True
+    thread.start()
+    return pygi.server_socket.getsockname()[1]
+
+def http_get(port, path):
+    """
+    Send a GET over loopback and return the raw response bytes.
+    """
+    import socket
+    client = socket.create_connection(('127.0.0.1', port))
+    client.sendall('GET {0} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(path).encode('ascii'))
+    chunks = []
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    client.close()
+    return b''.join(chunks)
+
 app = Beaker('Test App')
 
 @app.get('/simple/endpoint')
@@ -77,6 +127,14 @@ def list_me(req, var):
     text = '/'.join(var + [str(type(var))])
     return Response(body=text, status=200)
 
+@app.get('/branch/<a>/left')
+def branch_var(req, a):
+    return Response(body='var ' + a, status=200)
+
+@app.get('/branch/exact/right')
+def branch_exact(req):
+    return Response(body='exact', status=200)
+
 @app.error(404)
 def four(error):
     return Response(status=404, body='Hit the 404 handler.')
@@ -156,6 +214,1235 @@ def test_no_such_path():
     res = app.request(req)
     assert_res(res, 404)
 
+@tester.test
+def test_var_equals_literal():
+    req = Request(path="/vars/rat/rat", method="GET")
+    res = app.request(req)
+    assert_res(res, 200, 'rat rat')
+
+@tester.test
+def test_route_backtracking():
+    req = Request(path="/branch/exact/left", method="GET")
+    res = app.request(req)
+    assert_res(res, 200, 'var exact')
+    req = Request(path="/branch/exact/right", method="GET")
+    res = app.request(req)
+    assert_res(res, 200, 'exact')
+
+@tester.test
+def test_bad_filter_value():
+    req = Request(path="/integer/six", method="GET")
+    res = app.request(req)
+    assert_res(res, 400)
+
+@tester.test
+def test_route_added_after_dispatch():
+    late_app = Beaker('Late App')
+    late_app.get('/first')(lambda req: Response(body='first', status=200))
+    assert_res(late_app.request(Request(path='/first', method='GET')), 200, 'first')
+    @late_app.get('/second/<int:n>')
+    def second(req, n):
+        return Response(body=str(n + 1), status=200)
+    assert_res(late_app.request(Request(path='/second/1', method='GET')), 200, '2')
+
+@tester.test
+def test_route_validation():
+    strict = Beaker('Strict App')
+    strict.get('/bad/<nope:var>')(lambda req, var: Response(body=var, status=200))
+    try:
+        strict.freeze()
+        assert False, 'Unknown filter accepted.'
+    except RouteError:
+        pass
+    strict.add_filter('nope', lambda var: var.upper())
+    strict.freeze()
+    assert_res(strict.request(Request(path='/bad/x', method='GET')), 200, 'X')
+
+    @strict.get('/item/<int:item_id>')
+    def item(req, item_id):
+        return Response(body=str(item_id), status=200)
+
+    def other(req, name):
+        return Response(body=name, status=200)
+    for path in ('/item/<name>', '/item/x<name>', '/pair/<name>/<name>'):
+        try:
+            strict.get(path)(other)
+            assert False, 'Route {0} accepted.'.format(path)
+        except RouteError:
+            pass
+    strict.get('/item/<int:item_id>', mimetype='text/html')(item)
+
+@tester.test
+def test_var_matches_literal():
+    literal_app = Beaker('Literal App')
+
+    @literal_app.get('/a/<x>/b/<y>')
+    def both(req, x, y):
+        return Response(body='{0} {1}'.format(x, y), status=200)
+    assert_res(literal_app.request(Request(path='/a/b/b/a', method='GET')), 200, 'b a')
+
+@tester.test
+def test_route_table_round_trip():
+    import json
+    table = json.loads(json.dumps(app.route_table()))
+    assert ['GET', '/vars/<a>/rat', 'one_var', 'text/plain'] in table, 'Route missing from table.'
+    reloaded = Beaker('Reloaded App')
+    reloaded.add_filter('list', lambda var: var.split(','))
+    reloaded.load_route_table(table, app._funcs)
+    reloaded.freeze()
+    assert reloaded.route_table() == table, 'Table changed after reloading.'
+    assert_res(reloaded.request(Request(path='/vars/large/rat', method='GET')), 200, 'large rat')
+
+@tester.test
+def test_static_cache_hit():
+    cache_app = Beaker('Cache App')
+    cache_app.static('beaker.py')
+    req = Request(path="/static/beaker.py", method="GET")
+    first = cache_app.request(req)
+    second = cache_app.request(req)
+    assert_res(second, 200, first.body)
+    stats = cache_app._static_cache.stats()
+    assert stats['hits'] == 1, 'Expected a cache hit, got {0}.'.format(stats)
+    assert stats['bytes'] == len(first.body), 'Wrong cached size.'
+
+@tester.test
+def test_static_cache_revalidate():
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', dir='.', suffix='.txt', delete=False) as tmp:
+        tmp.write('old')
+    try:
+        cache_app = Beaker('Revalidate App')
+        cache_app.set_static_cache(StaticCache(revalidate=0))
+        cache_app.static_page('/page', os.path.basename(tmp.name), mimetype='text/plain')
+        req = Request(path="/page", method="GET")
+        assert_res(cache_app.request(req), 200, b'old')
+        with open(tmp.name, 'w') as changed:
+            changed.write('newer')
+        assert_res(cache_app.request(req), 200, b'newer')
+    finally:
+        os.remove(tmp.name)
+
+@tester.test
+def test_static_cache_eviction():
+    cache = StaticCache(max_bytes=10)
+    stat = os.stat('beaker.py')
+    cache.put('/a', 'beaker.py', b'123456', 'text/plain', stat)
+    cache.put('/b', 'beaker.py', b'7890', 'text/plain', stat)
+    assert cache.get('/a') is not None, 'Expected /a to be cached.'
+    cache.put('/c', 'beaker.py', b'abcd', 'text/plain', stat)
+    assert '/b' not in cache, 'Least recently used entry not evicted.'
+    assert '/a' in cache and '/c' in cache, 'Wrong entry evicted.'
+    cache.put('/big', 'beaker.py', b'x' * 11, 'text/plain', stat)
+    assert '/big' not in cache, 'Cached an entry larger than the budget.'
+    assert cache.stats()['evictions'] == 1, 'Wrong eviction count.'
+
+@tester.test
+def test_static_index():
+    import tempfile
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'static'))
+    os.mkdir(os.path.join(root, 'static', 'css'))
+    with open(os.path.join(root, 'static', 'css', 'site.css'), 'w') as css:
+        css.write('body {}')
+    try:
+        index_app = Beaker('Index App')
+        index_app.set_root(root)
+        index_app.freeze()
+        assert_res(index_app.request(Request(path="/css/site.css", method="GET")), 200, b'body {}')
+        for path in ('/../static/css/site.css', '/css/../css/site.css', '/etc/passwd', '/css//site.css'):
+            assert_res(index_app.request(Request(path=path, method="GET")), 404)
+        # Unknown paths are answered from the index, without touching the filesystem.
+        checked = []
+        isfile = os.path.isfile
+        os.path.isfile = lambda path: checked.append(path) or isfile(path)
+        try:
+            assert_res(index_app.request(Request(path="/no/such/file.css", method="GET")), 404)
+        finally:
+            os.path.isfile = isfile
+        assert not checked, 'Unknown path checked on disk: {0}.'.format(checked)
+        with open(os.path.join(root, 'static', 'new.txt'), 'w') as new:
+            new.write('new')
+        assert_res(index_app.request(Request(path="/new.txt", method="GET")), 404)
+        index_app.refresh_static_index()
+        assert_res(index_app.request(Request(path="/new.txt", method="GET")), 200, b'new')
+        stats = index_app._static_index.stats()
+        assert stats['complete'] and stats['files'] == 2, 'Wrong index stats {0}.'.format(stats)
+
+        # Lookups racing a rebuild see the old index or the new one, never half of each.
+        import threading
+        index = index_app._static_index
+        errors = []
+        def lookups():
+            try:
+                for i in range(5000):
+                    index.find('/css/site.css')
+            except Exception as e:
+                errors.append(e)
+        finder = threading.Thread(target=lookups)
+        finder.start()
+        while finder.is_alive():
+            index.clear()
+            index.refresh()
+        assert not errors, 'Lookup failed during a rebuild: {0!r}'.format(errors[:1])
+    finally:
+        import shutil
+        shutil.rmtree(root)
+
+@tester.test
+def test_static_negative_cache():
+    import tempfile
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'static'))
+    with open(os.path.join(root, 'static', 'a.txt'), 'w') as a:
+        a.write('a')
+    try:
+        index_app = Beaker('Negative App')
+        index_app.set_root(root)
+        index_app.set_static_index(StaticIndex(refresh=None, max_files=0, max_missing=2))
+        assert_res(index_app.request(Request(path="/a.txt", method="GET")), 200, b'a')
+        for path in ('/x', '/y', '/z'):
+            assert_res(index_app.request(Request(path=path, method="GET")), 404)
+        stats = index_app._static_index.stats()
+        assert not stats['complete'], 'Directory over max_files was indexed.'
+        assert stats['missing'] == 2, 'Negative cache not bounded: {0}.'.format(stats)
+        with open(os.path.join(root, 'static', 'z'), 'w') as z:
+            z.write('z')
+        # '/z' is still known missing until the index is refreshed.
+        assert_res(index_app.request(Request(path="/z", method="GET")), 404)
+        index_app.refresh_static_index()
+        assert_res(index_app.request(Request(path="/z", method="GET")), 200, b'z')
+    finally:
+        import shutil
+        shutil.rmtree(root)
+
+@tester.test
+def test_stream_large_static():
+    stream_app = Beaker('Stream App')
+    stream_app.set_stream_threshold(1024)
+    stream_app.static('beaker.py')
+    with open('beaker.py', 'rb') as beaker_file:
+        beaker_source = beaker_file.read()
+    res = stream_app.request(Request(path='/static/beaker.py', method='GET'))
+    assert res.file is not None, 'Large file was not streamed.'
+    res.file.close()
+    assert len(stream_app._static_cache) == 0, 'Streamed file was cached.'
+    status, headers, body = wsgi_call(stream_app, '/static/beaker.py')
+    assert body == beaker_source, 'Streamed body differs from the file.'
+    assert headers['Content-Length'] == str(len(beaker_source)), 'Wrong Content-Length.'
+
+@tester.test
+def test_server_sendfile():
+    stream_app = Beaker('Sendfile App')
+    stream_app.set_stream_threshold(1024)
+    stream_app.static('beaker.py')
+    with open('beaker.py', 'rb') as beaker_file:
+        beaker_source = beaker_file.read()
+    port = serve_in_thread(stream_app)
+    response = http_get(port, '/static/beaker.py')
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.0 200'), 'Bad status line: {0}'.format(head[:40])
+    assert body == beaker_source, 'Sent file differs from the file.'
+
+def compress_app():
+    compress = Beaker('Compress App')
+
+    @compress.get('/page', mimetype='text/html')
+    def page(req):
+        return Response(body='<p>hello</p>' * 200, status=200)
+
+    @compress.get('/small', mimetype='text/html')
+    def small(req):
+        return Response(body='<p>hi</p>', status=200)
+    return compress
+
+@tester.test
+def test_choose_encoding():
+    from beaker import choose_encoding
+    assert choose_encoding('gzip, deflate, br') == 'gzip', 'gzip not preferred.'
+    assert choose_encoding('deflate') == 'deflate', 'deflate not chosen.'
+    assert choose_encoding('gzip;q=0, deflate;q=0.5') == 'deflate', 'q=0 not refused.'
+    assert choose_encoding('*') == 'gzip', 'Wildcard not accepted.'
+    assert choose_encoding('identity') is None and choose_encoding(None) is None, 'Chose an encoding.'
+
+@tester.test
+def test_compress_dynamic():
+    import gzip
+    import zlib
+    compress = compress_app()
+    plain = ('<p>hello</p>' * 200).encode('utf-8')
+    status, headers, body = wsgi_call(compress, '/page', environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+    assert headers.get('Content-Encoding') == 'gzip', 'Response not gzipped: {0}'.format(headers)
+    assert headers['Vary'] == 'Accept-Encoding', 'Missing Vary header.'
+    assert gzip.decompress(body) == plain, 'Bad gzip body.'
+    assert headers['Content-Length'] == str(len(body)), 'Content-Length of the raw body.'
+    status, headers, body = wsgi_call(compress, '/page', environ={'HTTP_ACCEPT_ENCODING': 'deflate'})
+    assert zlib.decompress(body) == plain, 'Bad deflate body.'
+    status, headers, body = wsgi_call(compress, '/page')
+    assert body == plain and 'Content-Encoding' not in headers, 'Compressed without Accept-Encoding.'
+    status, headers, body = wsgi_call(compress, '/small', environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+    assert 'Content-Encoding' not in headers, 'Compressed a body under the threshold.'
+
+    @compress.get('/tagged', mimetype='text/html')
+    def tagged(req):
+        return Response(body='<p>hello</p>' * 200, status=200, headers={'ETag': '"abc"'})
+    status, headers, body = wsgi_call(compress, '/tagged', environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+    assert headers['ETag'] == '"abc-gzip"', 'Compressed body kept the raw ETag: {0}'.format(headers)
+    status, headers, body = wsgi_call(compress, '/tagged', environ={'HTTP_ACCEPT_ENCODING': 'gzip',
+                                                                   'HTTP_IF_NONE_MATCH': '"abc-gzip"'})
+    assert status.startswith('304') and headers['ETag'] == '"abc-gzip"', 'Compressed copy not validated.'
+    status, headers, body = wsgi_call(compress, '/tagged', environ={'HTTP_IF_NONE_MATCH': '"abc-gzip"'})
+    assert status.startswith('200') and headers['ETag'] == '"abc"', 'Raw body validated by the gzip ETag.'
+    compress.set_compression(None)
+    status, headers, body = wsgi_call(compress, '/page', environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+    assert body == plain, 'Compressed with compression off.'
+
+@tester.test
+def test_compress_static():
+    import gzip
+    import zlib
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', dir='.', suffix='.css', delete=False) as tmp:
+        tmp.write('body { color: red; }\n' * 200)
+    try:
+        with open(tmp.name, 'rb') as css_file:
+            css = css_file.read()
+        static_app = Beaker('Compress Static App')
+        static_app.static_page('/site.css', os.path.basename(tmp.name), mimetype='text/css')
+        accept = {'HTTP_ACCEPT_ENCODING': 'gzip'}
+        for i in range(2):
+            status, headers, body = wsgi_call(static_app, '/site.css', environ=accept)
+            assert headers.get('Content-Encoding') == 'gzip', 'Static file not gzipped.'
+            assert gzip.decompress(body) == css, 'Bad gzip static body.'
+        status, headers, body = wsgi_call(static_app, '/site.css')
+        assert body == css, 'Raw static body not served.'
+        assert static_app._static_cache.stats()['hits'] == 2, 'Compressed copy not cached.'
+        etags = set([headers['ETag']])
+        for i in range(2):
+            status, headers, body = wsgi_call(static_app, '/site.css', environ={'HTTP_ACCEPT_ENCODING': 'deflate'})
+            assert headers.get('Content-Encoding') == 'deflate' and zlib.decompress(body) == css, 'Bad deflate static body.'
+            etags.add(headers['ETag'])
+        status, headers, body = wsgi_call(static_app, '/site.css', environ=accept)
+        etags.add(headers['ETag'])
+        assert len(etags) == 3, 'Encodings of a static file share an ETag: {0}'.format(etags)
+        assert 'deflate' in static_app._static_cache._entries['/site.css'][7], 'Deflate copy not cached.'
+
+        # Random bytes don't compress, so they are sent as they are and never gzipped per request.
+        noise = os.urandom(4096)
+        with open(tmp.name, 'wb') as css_file:
+            css_file.write(noise)
+        static_app._static_cache.clear()
+        compressed = []
+        static_app._compress_response = lambda req, res, encoding: compressed.append(res)
+        for i in range(2):
+            status, headers, body = wsgi_call(static_app, '/site.css', environ=accept)
+            assert body == noise and 'Content-Encoding' not in headers, 'Incompressible file compressed.'
+        assert not compressed, 'Incompressible static file compressed on every request.'
+
+        # A precompressed file next to the original is served as it is.
+        with open(tmp.name + '.gz', 'wb') as gz_file:
+            gz_file.write(gzip.compress(b'precompressed'))
+        static_app._static_cache.clear()
+        status, headers, body = wsgi_call(static_app, '/site.css', environ=accept)
+        assert gzip.decompress(body) == b'precompressed', 'Precompressed file not served.'
+        static_app.set_stream_threshold(1)
+        status, headers, body = wsgi_call(static_app, '/site.css', environ=accept)
+        assert gzip.decompress(body) == b'precompressed', 'Precompressed file not streamed.'
+        assert headers['Content-Length'] == str(len(body)), 'Wrong streamed Content-Length.'
+    finally:
+        os.remove(tmp.name)
+        if os.path.exists(tmp.name + '.gz'):
+            os.remove(tmp.name + '.gz')
+
+@tester.test
+def test_server_request_headers():
+    import gzip
+    port = serve_in_thread(compress_app(), threads=1)
+    response = http_exchange(port, b'GET /page HTTP/1.1\r\nAccept-Encoding: gzip\r\nConnection: close\r\n\r\n')
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert b'Content-Encoding: gzip' in head, 'Accept-Encoding not passed to the app.'
+    assert gzip.decompress(body) == ('<p>hello</p>' * 200).encode('utf-8'), 'Bad gzip body.'
+
+@tester.test
+def test_conditional_get():
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', dir='.', suffix='.txt', delete=False) as tmp:
+        tmp.write('cached page')
+    try:
+        cond_app = Beaker('Conditional App')
+        cond_app.static_page('/page', os.path.basename(tmp.name), mimetype='text/plain')
+        status, headers, body = wsgi_call(cond_app, '/page')
+        etag, last_modified = headers['ETag'], headers['Last-Modified']
+        assert etag.startswith('"') and last_modified.endswith('GMT'), 'Missing validators: {0}'.format(headers)
+        assert headers['Cache-Control'] == 'no-cache', 'Missing Cache-Control.'
+        for environ in ({'HTTP_IF_NONE_MATCH': etag}, {'HTTP_IF_NONE_MATCH': '"x", W/' + etag},
+                        {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            status, headers, body = wsgi_call(cond_app, '/page', environ=environ)
+            assert status.startswith('304') and body == b'', 'Expected 304 for {0}.'.format(environ)
+            assert headers['ETag'] == etag and 'Content-Length' not in headers, 'Bad 304 headers.'
+        for environ in ({'HTTP_IF_NONE_MATCH': '"other"'},
+                        {'HTTP_IF_MODIFIED_SINCE': 'Sun, 06 Nov 1994 08:49:37 GMT'},
+                        {'HTTP_IF_NONE_MATCH': '"other"', 'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            status, headers, body = wsgi_call(cond_app, '/page', environ=environ)
+            assert status.startswith('200') and body == b'cached page', 'Expected 200 for {0}.'.format(environ)
+        cond_app.set_stream_threshold(1)
+        status, headers, body = wsgi_call(cond_app, '/page')
+        status, headers, body = wsgi_call(cond_app, '/page', environ={'HTTP_IF_NONE_MATCH': headers['ETag']})
+        assert status.startswith('304'), 'Streamed file not validated.'
+    finally:
+        os.remove(tmp.name)
+
+@tester.test
+def test_server_not_modified():
+    port = serve_in_thread(app, threads=1)
+    status, headers, body = wsgi_call(app, '/static/beaker.py')
+    raw = ('GET /static/beaker.py HTTP/1.1\r\nIf-None-Match: {0}\r\n\r\n'
+           'GET /simple/endpoint HTTP/1.1\r\nConnection: close\r\n\r\n').format(headers['ETag'])
+    response = http_exchange(port, raw.encode('ascii'))
+    first, second = response.split(b'\r\n\r\n', 1)
+    assert first.startswith(b'HTTP/1.1 304'), 'Expected 304: {0}'.format(first)
+    assert b'Transfer-Encoding' not in first and b'Content-Length' not in first, '304 framed with a body.'
+    assert second.startswith(b'HTTP/1.1 200') and second.endswith(b'simple endpoint'), 'Connection broken after 304.'
+
+@tester.test
+def test_range_requests():
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', dir='.', suffix='.txt', delete=False) as tmp:
+        tmp.write('0123456789abcdefghij')
+    try:
+        range_app = Beaker('Range App')
+        range_app.static_page('/page', os.path.basename(tmp.name), mimetype='text/plain')
+        status, headers, body = wsgi_call(range_app, '/page')
+        assert headers['Accept-Ranges'] == 'bytes', 'Missing Accept-Ranges.'
+        etag = headers['ETag']
+        # Cached files are sliced in memory, streamed ones through mmap.
+        for threshold in (None, 1):
+            if threshold is not None:
+                range_app.set_stream_threshold(threshold)
+            for spec, part, content_range in (('bytes=0-3', b'0123', 'bytes 0-3/20'),
+                                              ('bytes=-4', b'ghij', 'bytes 16-19/20'),
+                                              ('bytes=18-', b'ij', 'bytes 18-19/20'),
+                                              ('bytes=15-99', b'fghij', 'bytes 15-19/20')):
+                status, headers, body = wsgi_call(range_app, '/page', environ={'HTTP_RANGE': spec})
+                assert status.startswith('206') and body == part, 'Wrong slice for {0}: {1}'.format(spec, body)
+                assert headers['Content-Range'] == content_range, 'Wrong Content-Range for {0}.'.format(spec)
+                assert headers['Content-Length'] == str(len(part)), 'Wrong Content-Length for {0}.'.format(spec)
+            status, headers, body = wsgi_call(range_app, '/page', environ={'HTTP_RANGE': 'bytes=0-1,10-11'})
+            boundary = headers['Content-Type'].split('boundary=')[1]
+            assert status.startswith('206') and headers['Content-Type'].startswith('multipart/byteranges')
+            assert body == ('--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/20\r\n\r\n01\r\n'
+                            '--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 10-11/20\r\n\r\nab\r\n'
+                            '--{0}--\r\n').format(boundary).encode('ascii'), 'Wrong multipart body.'
+            assert headers['Content-Length'] == str(len(body)), 'Wrong multipart Content-Length.'
+            status, headers, body = wsgi_call(range_app, '/page', environ={'HTTP_RANGE': 'bytes=20-'})
+            assert status.startswith('416') and headers['Content-Range'] == 'bytes */20', 'Expected 416.'
+            # Invalid, overlapping or stale ranges get the whole file.
+            for environ in ({'HTTP_RANGE': 'bytes=5-2'}, {'HTTP_RANGE': 'lines=0-1'},
+                            {'HTTP_RANGE': 'bytes=0-5,3-8'},
+                            {'HTTP_RANGE': 'bytes=0-3', 'HTTP_IF_RANGE': '"stale"'}):
+                status, headers, body = wsgi_call(range_app, '/page', environ=environ)
+                assert status.startswith('200') and body == b'0123456789abcdefghij', \
+                        'Expected whole file for {0}.'.format(environ)
+        status, headers, body = wsgi_call(range_app, '/page')
+        status, headers, body = wsgi_call(range_app, '/page', environ={'HTTP_RANGE': 'bytes=0-3',
+                                                                       'HTTP_IF_RANGE': headers['ETag']})
+        assert status.startswith('206') and body == b'0123', 'If-Range with current ETag not honoured.'
+    finally:
+        os.remove(tmp.name)
+
+@tester.test
+def test_concurrency_limits():
+    import threading
+    limited = Beaker('Limited App')
+    release = threading.Event()
+
+    @limited.get('/slow')
+    def slow(req):
+        release.wait(5)
+        return Response(body='slow', status=200)
+
+    @limited.get('/fast')
+    def fast(req):
+        return Response(body='fast', status=200)
+
+    try:
+        limited.set_route_limit('missing', 1)
+        assert False, 'Limit set on a missing endpoint.'
+    except RouteError:
+        pass
+    route_limit = limited.set_route_limit('slow', 1, max_queue=1, queue_timeout=0.05)
+    results = []
+    def call(path):
+        results.append(limited.request(Request(path=path, method='GET')))
+    first = threading.Thread(target=call, args=('/slow', ))
+    first.start()
+    while route_limit.in_flight == 0:
+        release.wait(0.001)
+    res = limited.request(Request(path='/slow', method='GET'))
+    assert res.status == 503 and res.headers['Retry-After'] == '1', 'Queued request not timed out.'
+    assert_res(limited.request(Request(path='/fast', method='GET')), 200, 'fast')
+    release.set()
+    first.join(5)
+    assert_res(results[0], 200, 'slow')
+    assert route_limit.stats()['timed_out'] == 1 and route_limit.in_flight == 0, 'Bad counters.'
+
+    release.clear()
+    app_limit = limited.set_concurrency_limit(1)
+    first = threading.Thread(target=call, args=('/slow', ))
+    first.start()
+    while app_limit.in_flight == 0:
+        release.wait(0.001)
+    res = limited.request(Request(path='/fast', method='GET'))
+    assert res.status == 503, 'Request over the app limit admitted.'
+    release.set()
+    first.join(5)
+    assert app_limit.stats()['rejected'] == 1, 'Rejection not counted.'
+
+@tester.test
+def test_async_concurrency_limit():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    limited = stats_app()
+    app_limit = limited.set_concurrency_limit(1, max_queue=100)
+
+    async def burst(count):
+        # Fewer executor threads than queued requests, which the sync handlers still need.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(2))
+        requests = [limited.request_async(Request(path='/item/{0}'.format(i), method='GET'))
+                    for i in range(count)]
+        return await asyncio.wait_for(asyncio.gather(*requests), 5)
+
+    results = asyncio.run(burst(20))
+    assert [res.body for res in results] == [str(i) for i in range(20)], 'Queued requests not served.'
+    assert app_limit.stats()['admitted'] == 20 and app_limit.in_flight == 0, 'Bad counters.'
+
+    timed = limited.set_concurrency_limit(1, max_queue=1, queue_timeout=0.05)
+
+    async def timeout():
+        assert await timed.acquire_async(), 'Free slot refused.'
+        assert not await timed.acquire_async(), 'Queued wait did not time out.'
+        timed.release()
+
+    asyncio.run(timeout())
+    assert timed.stats() == {'in_flight': 0, 'waiting': 0, 'admitted': 1, 'rejected': 0, 'timed_out': 1}, \
+        'Bad counters: {0}'.format(timed.stats())
+
+@tester.test
+def test_server_queue_timeout():
+    import threading
+    import server
+    busy = Beaker('Busy App')
+    release = threading.Event()
+
+    @busy.get('/slow')
+    def slow(req):
+        release.wait(5)
+        return Response(body='slow', status=200)
+
+    port = serve_in_thread(busy, threads=1, queue_size=1, queue_timeout=0.05)
+    first = []
+    client = threading.Thread(target=lambda: first.append(http_get(port, '/slow')))
+    client.start()
+    import time
+    time.sleep(0.1)
+    queued = []
+    waiter = threading.Thread(target=lambda: queued.append(http_get(port, '/slow')))
+    waiter.start()
+    time.sleep(0.1)
+    overflow = http_get(port, '/slow')
+    assert overflow.startswith(b'HTTP/1.0 503'), 'Connection over a full queue not shed: {0}'.format(overflow[:40])
+    release.set()
+    client.join(5)
+    waiter.join(5)
+    assert first and first[0].endswith(b'slow'), 'Running request failed.'
+    assert queued and queued[0].startswith(b'HTTP/1.0 503'), 'Connection queued too long not shed.'
+
+@tester.test
+def test_access_log():
+    import io
+    import server
+    stream = io.StringIO()
+    log = server.AccessLog(stream=stream, max_queue=2, flush_interval=0)
+    log.log('GET', '/a', '200 OK', 10, 0.0015, ('127.0.0.1', 5000))
+    log.log('POST', '/b', '404 NOT FOUND', 0, 0.002, ('127.0.0.1', 5001))
+    log.log('GET', '/c', '200 OK', 1, 0.001, ('127.0.0.1', 5002))
+    assert log.stats()['dropped'] == 1, 'Record over max_queue not dropped.'
+    assert stream.getvalue() == '', 'Record written on the request thread.'
+    log.start()
+    log.close()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2 and lines[0].endswith(' 127.0.0.1 "GET /a" 200 10 1.500ms'), \
+            'Wrong log lines {0}.'.format(lines)
+    assert lines[1].endswith(' 127.0.0.1 "POST /b" 404 0 2.000ms'), 'Wrong log line {0}.'.format(lines[1])
+    assert log.stats()['logged'] == 2, 'Wrong logged count.'
+    sampled = server.AccessLog(stream=io.StringIO(), sample=0.0, format='{status}\n')
+    sampled.log('GET', '/a', '200 OK', 0, 0.0, None)
+    sampled.log('GET', '/a', '500 INTERNAL SERVER ERROR', 0, 0.0, None)
+    sampled.log('GET', '/a', None, 0, 0.0, None)
+    sampled.start()
+    sampled.close()
+    assert sampled.stream.getvalue() == '500\n-\n', 'Errors must be logged whatever the sample rate.'
+    assert sampled.stats()['sampled_out'] == 1, 'Wrong sampled out count.'
+    import threading
+    counted = server.AccessLog(stream=io.StringIO(), max_queue=1, sample=0.5)
+    def hammer():
+        for i in range(2000):
+            counted.log('GET', '/a', '200 OK', 0, 0.0, None)
+    threads = [threading.Thread(target=hammer) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counts = counted.stats()
+    assert counts['sampled_out'] + counts['dropped'] + counts['queued'] == 8000, 'Counts lost: {0}.'.format(counts)
+
+@tester.test
+def test_server_access_log():
+    import io
+    import time
+    import server
+    stream = io.StringIO()
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(app, threads=1, server_class=server_class,
+                               access_log=server.AccessLog(stream=stream, flush_interval=0))
+        body = http_get(port, '/simple/endpoint').split(b'\r\n\r\n', 1)[1]
+        http_get(port, '/no/such/path')
+        deadline = time.monotonic() + 5
+        while stream.getvalue().count('\n') < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        lines = stream.getvalue().splitlines()
+        stream.seek(0)
+        stream.truncate()
+        assert ' 127.0.0.1 "GET /simple/endpoint" 200 {0} '.format(len(body)) in lines[0], \
+                'Wrong access log line {0}.'.format(lines)
+        assert '"GET /no/such/path" 404 ' in lines[1], 'Wrong access log line {0}.'.format(lines)
+
+@tester.test
+def test_threaded_server():
+    import threading
+    thread_app = Beaker('Thread App')
+    release = threading.Event()
+
+    @thread_app.get('/slow')
+    def slow(req):
+        release.wait(5)
+        return Response(body='slow', status=200)
+
+    @thread_app.get('/fast')
+    def fast(req):
+        return Response(body='fast', status=200)
+
+    port = serve_in_thread(thread_app, threads=2)
+    slow_result = []
+    slow_client = threading.Thread(target=lambda: slow_result.append(http_get(port, '/slow')))
+    slow_client.start()
+    fast_response = http_get(port, '/fast')
+    assert not slow_result, 'Slow request finished before it was released.'
+    release.set()
+    slow_client.join(5)
+    assert fast_response.endswith(b'fast'), 'Fast request blocked behind slow one.'
+    assert slow_result and slow_result[0].endswith(b'slow'), 'Slow request failed.'
+
+@tester.test
+def test_static_cache_threads():
+    import threading
+    cache = StaticCache(max_bytes=1000)
+    stat = os.stat('beaker.py')
+    def hammer(n):
+        for i in range(200):
+            key = '/{0}/{1}'.format(n, i % 20)
+            if cache.get(key) is None:
+                cache.put(key, 'beaker.py', b'x' * 30, 'text/plain', stat)
+    threads = [threading.Thread(target=hammer, args=(n, )) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['bytes'] == stats['entries'] * 30, 'Cache size out of sync: {0}'.format(stats)
+    assert stats['bytes'] <= 1000, 'Cache over budget: {0}'.format(stats)
+
+@tester.test
+def test_prefork_server():
+    import signal
+    import socket
+    import server
+    server.LOG = False
+    fork_app = Beaker('Prefork App')
+
+    @fork_app.get('/pid')
+    def pid(req):
+        return Response(body=str(os.getpid()), status=200)
+
+    pygi = server.Server(0, fork_app, host='127.0.0.1', processes=2)
+    port = pygi.server_socket.getsockname()[1]
+    master = os.fork()
+    if master == 0:
+        try:
+            pygi._serve_prefork()
+        finally:
+            os._exit(0)
+    pygi.server_socket.close()
+    try:
+        first_worker = int(http_get(port, '/pid').split(b'\r\n\r\n', 1)[1])
+        assert first_worker != master, 'Request was served by the master.'
+        os.kill(first_worker, signal.SIGKILL)
+        workers = set(int(http_get(port, '/pid').split(b'\r\n\r\n', 1)[1]) for i in range(10))
+        assert first_worker not in workers, 'Killed worker still serving.'
+    finally:
+        os.kill(master, signal.SIGTERM)
+        pid, status = os.waitpid(master, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, 'Master did not shut down cleanly.'
+
+@tester.test
+def test_async_endpoint():
+    import asyncio
+    async_app = Beaker('Async App')
+
+    @async_app.get('/async/<int:n>')
+    async def doubled(req, n):
+        await asyncio.sleep(0)
+        return Response(body=str(n * 2), status=200)
+
+    @async_app.get('/sync')
+    def plain(req):
+        return Response(body='sync', status=200)
+
+    req = Request(path='/async/4', method='GET')
+    assert_res(asyncio.run(async_app.request_async(req)), 200, '8')
+    req = Request(path='/sync', method='GET')
+    assert_res(asyncio.run(async_app.request_async(req)), 200, 'sync')
+    req = Request(path='/async/5', method='GET')
+    assert_res(async_app.request(req), 200, '10')
+
+@tester.test
+def test_async_offloads_blocking_steps():
+    import asyncio
+    import threading
+    threads = {}
+
+    class Recording(Beaker):
+        def _compress_response(self, req, res, encoding):
+            threads['compress'] = threading.current_thread()
+            return Beaker._compress_response(self, req, res, encoding)
+    offload = Recording('Offload App')
+
+    @offload.get('/big', mimetype='application/json')
+    async def big(req):
+        return Response(body='[' + '1,' * 100000 + '1]', status=200)
+
+    @offload.before_request
+    def hook(req):
+        threads['hook'] = threading.current_thread()
+
+    async def run():
+        threads['loop'] = threading.current_thread()
+        req = Request(path='/big', method='GET', headers={'Accept-Encoding': 'gzip'})
+        return await offload.request_async(req)
+    res = asyncio.run(run())
+    assert res.headers.get('Content-Encoding') == 'gzip', 'Big body not compressed.'
+    assert threads['compress'] is not threads['loop'], 'Big body compressed on the event loop.'
+    assert threads['hook'] is not threads['loop'], 'before_request hook run on the event loop.'
+
+@tester.test
+def test_async_server():
+    import asyncio
+    import threading
+    import server
+    aio_app = Beaker('Async Server App')
+    release = threading.Event()
+
+    @aio_app.get('/wait')
+    async def wait(req):
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+        return Response(body='waited', status=200)
+
+    @aio_app.get('/now')
+    def now(req):
+        return Response(body='now', status=200)
+
+    port = serve_in_thread(aio_app, server_class=server.AsyncServer)
+    waiting = []
+    clients = [threading.Thread(target=lambda: waiting.append(http_get(port, '/wait')))
+               for i in range(20)]
+    for client in clients:
+        client.start()
+    now_response = http_get(port, '/now')
+    assert not waiting, 'Waiting requests finished before they were released.'
+    release.set()
+    for client in clients:
+        client.join(5)
+    assert now_response.endswith(b'now'), 'Request blocked behind waiting ones.'
+    assert len(waiting) == 20 and all(r.endswith(b'waited') for r in waiting), 'Waiting requests failed.'
+
+def http_exchange(port, raw):
+    """
+    Send raw request bytes over loopback and return everything until the server closes.
+    """
+    import socket
+    client = socket.create_connection(('127.0.0.1', port))
+    client.settimeout(5)
+    client.sendall(raw)
+    chunks = []
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    client.close()
+    return b''.join(chunks)
+
+def chunked_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello ', b'', b'world']
+
+@tester.test
+def test_keep_alive_pipelining():
+    import server
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(app, threads=2, server_class=server_class)
+        raw = (b'GET /simple/endpoint HTTP/1.1\r\nHost: a\r\n\r\n'
+               b'GET /vars/large/rat HTTP/1.1\r\nHost: a\r\n\r\n'
+               b'GET /integer/3 HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+        response = http_exchange(port, raw)
+        assert response.count(b'HTTP/1.1 200 OK') == 3, 'Expected three responses: {0}'.format(response)
+        assert response.count(b'Connection: close') == 1, 'Connection closed early.'
+        order = [response.find(b'simple endpoint'), response.find(b'large rat'), response.find(b"<class 'int'>")]
+        assert -1 not in order and order == sorted(order), 'Responses out of order.'
+
+@tester.test
+def test_socket_reader():
+    import server
+
+    class TrickleSocket:
+        """
+        Hands out the data a few bytes per recv, like a slow client.
+        """
+        def __init__(self, data, step):
+            self.data = data
+            self.step = step
+
+        def recv_into(self, buffer):
+            size = min(self.step, len(buffer), len(self.data))
+            buffer[:size] = self.data[:size]
+            self.data = self.data[size:]
+            return size
+
+        def recv(self, size):
+            data, self.data = self.data[:size], self.data[size:]
+            return data
+
+    long_header = 'X-Long: ' + 'a' * 40
+    raw = ('GET /a HTTP/1.1\r\n{0}\r\n\r\nGET /b HTTP/1.1\r\n\r\nbody'.format(long_header)).encode('ascii')
+    for step in (1, 3, 7, len(raw)):
+        reader = server.SocketReader(TrickleSocket(raw, step), 16)
+        first = reader.read_until(b'\r\n\r\n', 1024)
+        assert first == 'GET /a HTTP/1.1\r\n{0}\r\n\r\n'.format(long_header).encode('ascii'), \
+                'Wrong first head {0!r} with step {1}.'.format(first, step)
+        assert reader.read_until(b'\r\n\r\n', 1024) == b'GET /b HTTP/1.1\r\n\r\n', 'Wrong pipelined head.'
+        body = b''
+        while True:
+            data = reader.read(3)
+            if not data:
+                break
+            assert len(data) <= 3, 'Read more than asked for.'
+            body += data
+        assert body == b'body', 'Wrong body bytes {0!r}.'.format(body)
+        assert reader.read_until(b'\r\n\r\n', 1024) is None, 'Expected None at end of stream.'
+        assert len(reader.buffer) <= 128, 'Buffer grew past the longest head.'
+    reader = server.SocketReader(TrickleSocket(raw, 5), 16)
+    try:
+        reader.read_until(b'\r\n\r\n', 20, error_status=431)
+        assert False, 'Head over the limit accepted.'
+    except server.RequestError as e:
+        assert e.status == 431, 'Wrong error status.'
+
+@tester.test
+def test_large_response():
+    import hashlib
+    import server
+    payload = bytes(bytearray(range(256))) * (32 * 1024)
+    def big_app(environ, start_response):
+        start_response('200 OK', [('Content-Length', str(len(payload)))])
+        return [payload]
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(big_app, threads=1, server_class=server_class)
+        body = http_get(port, '/').split(b'\r\n\r\n', 1)[1]
+        assert hashlib.md5(body).digest() == hashlib.md5(payload).digest(), \
+                'Large body truncated or corrupted, got {0} bytes.'.format(len(body))
+
+@tester.test
+def test_keep_alive_http10_and_limit():
+    port = serve_in_thread(app, threads=1, max_requests=2)
+    raw = b'GET /simple/endpoint HTTP/1.0\r\nConnection: keep-alive\r\n\r\n' * 3
+    response = http_exchange(port, raw)
+    assert response.count(b'HTTP/1.0 200') == 2, 'max_requests not enforced: {0}'.format(response)
+    assert b'Connection: keep-alive' in response, 'HTTP/1.0 keep-alive not acknowledged.'
+    port = serve_in_thread(app)
+    response = http_exchange(port, raw)
+    assert response.count(b'HTTP/1.0 200') == 1, 'Serial server kept the connection open.'
+
+@tester.test
+def test_chunked_response():
+    port = serve_in_thread(chunked_app, threads=1)
+    response = http_exchange(port, b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert b'Transfer-Encoding: chunked' in head, 'Response not chunked.'
+    assert body == b'6\r\nhello \r\n5\r\nworld\r\n0\r\n\r\n', 'Bad chunking: {0}'.format(body)
+
+@tester.test
+def test_response_head():
+    import server
+    port = serve_in_thread(app, threads=1)
+    raw = b'GET /simple/endpoint HTTP/1.1\r\nHost: a\r\n\r\n' * 2 + b'GET /simple/endpoint HTTP/1.1\r\nConnection: close\r\n\r\n'
+    responses = http_exchange(port, raw).split(b'HTTP/1.1 200 OK\r\n')[1:]
+    assert len(responses) == 3, 'Expected three responses.'
+    for response in responses:
+        head, body = response.split(b'\r\n\r\n', 1)
+        headers = dict(line.split(b': ', 1) for line in head.split(b'\r\n'))
+        assert headers[b'Date'].endswith(b' GMT'), 'Date not in GMT: {0}'.format(headers[b'Date'])
+        assert int(headers[b'Content-Length']) == len(body), 'Content-Length does not match the body.'
+
+    class PartialSocket:
+        def __init__(self):
+            self.data = b''
+        def sendmsg(self, buffers):
+            data = b''.join(bytes(b) for b in buffers)[:3]
+            self.data += data
+            return len(data)
+    sock = PartialSocket()
+    server.Server._send(None, sock, [b'head', b'', b'body', b'!'])
+    assert sock.data == b'headbody!', 'Partial writes lost data: {0}'.format(sock.data)
+
+    def many_pieces(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'%d,' % i for i in range(2000)]
+    port = serve_in_thread(many_pieces, threads=1)
+    response = http_exchange(port, b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+    assert response.startswith(b'HTTP/1.1 200 OK'), 'Bad response: {0}'.format(response[:100])
+    chunks = response.split(b'\r\n\r\n', 1)[1].split(b'\r\n')[1::2]
+    assert b''.join(chunks) == b''.join(b'%d,' % i for i in range(2000)), 'List body over IOV_MAX buffers lost.'
+
+    pygi = server.Server(0, app, host='127.0.0.1')
+    pygi.server_socket.close()
+    for i in range(10):
+        headers = [('Content-Type', 'text/plain'), ('ETag', '"{0}"'.format(i)),
+                   ('Content-Type', 'multipart/byteranges; boundary={0}'.format(i))]
+        head = pygi._format_headers('200 OK', headers, {'version': 'HTTP/1.1', 'keep_alive': True})
+        assert 'ETag: "{0}"\r\n'.format(i).encode('ascii') in head, 'Header line missing.'
+    assert list(pygi._header_lines) == [('Content-Type', 'text/plain')], 'Per-response header lines cached.'
+
+def upload_app():
+    upload = Beaker('Upload App')
+
+    @upload.post('/upload')
+    def receive(req):
+        import hashlib
+        data = req.body.read()
+        return Response(body='{0} {1}'.format(len(data), hashlib.md5(data).hexdigest()), status=200)
+    return upload
+
+@tester.test
+def test_large_binary_upload():
+    import hashlib
+    import server
+    # Bigger than AsyncServer spools to a temporary file.
+    payload = bytes(bytearray(range(256))) * (server.AsyncServer._SPOOL_SIZE // 256 + 1024)
+    expected = '{0} {1}'.format(len(payload), hashlib.md5(payload).hexdigest()).encode('ascii')
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(upload_app(), threads=1, server_class=server_class)
+        head = 'POST /upload HTTP/1.1\r\nContent-Length: {0}\r\n\r\n'.format(len(payload))
+        close = b'GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n'
+        response = http_exchange(port, head.encode('ascii') + payload + close)
+        assert expected in response, 'Upload truncated or corrupted: {0}'.format(response[:300])
+        assert response.count(b'HTTP/1.1 ') == 2, 'Pipelined request after the body was lost.'
+        chunked = b''.join(b'%x\r\n' % len(payload[i:i + 5000]) + payload[i:i + 5000] + b'\r\n'
+                           for i in range(0, len(payload), 5000))
+        head = b'POST /upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n'
+        response = http_exchange(port, head + chunked + b'0\r\n\r\n')
+        assert expected in response, 'Chunked upload decoded wrong: {0}'.format(response[:300])
+
+@tester.test
+def test_traffic_capture_replay():
+    import io
+    import json
+    import tempfile
+    import replay_beaker
+    capture_app = upload_app()
+    hits = []
+
+    @capture_app.get('/count')
+    def count(req):
+        hits.append(1)
+        return Response(body='hits {0} {1}'.format(len(hits), req.args.get('x')), status=200)
+
+    with tempfile.NamedTemporaryFile(suffix='.jsonl.gz', delete=False) as tmp:
+        file_name = tmp.name
+    try:
+        capture = capture_app.start_capture(file_name)
+        payload = b'\x00\x01binary'
+        wsgi_call(capture_app, '/upload', method='POST', environ={
+                'wsgi.input': io.BytesIO(payload), 'CONTENT_LENGTH': str(len(payload))})
+        wsgi_call(capture_app, '/count', query='x=1')
+        wsgi_call(capture_app, '/missing', environ={'HTTP_ACCEPT': 'text/html', 'HTTP_COOKIE': 'session=secret',
+                                                    'HTTP_AUTHORIZATION': 'Bearer secret'})
+        wsgi_call(capture_app, '/upload', method='POST', environ={
+                'wsgi.input': io.BytesIO(b'5\r\nhello\r\n0\r\n\r\n'), 'HTTP_TRANSFER_ENCODING': 'chunked'})
+        capture_app.stop_capture()
+        assert capture.stats() == {'captured': 3, 'skipped': 1, 'dropped': 0}, \
+                'Wrong capture stats {0}.'.format(capture.stats())
+        entries = replay_beaker.load_capture(file_name)
+        assert [(e['m'], e['p'], e['q'], e['s']) for e in entries] == \
+                [('POST', '/upload', '', 200), ('GET', '/count', 'x=1', 200), ('GET', '/missing', '', 404)], \
+                'Wrong captured requests {0}.'.format(entries)
+        assert entries[0]['t'] == 0 and entries[2]['h']['Accept'] == 'text/html', 'Wrong captured fields.'
+        assert 'secret' not in json.dumps(entries), 'Credentials captured: {0}.'.format(entries[2]['h'])
+        # The app's body was read for the capture, and still reached the endpoint.
+        assert replay_beaker.entry_body(entries[0]) == payload, 'Body not captured.'
+        hits[:] = []
+        latencies, elapsed, diffs = replay_beaker.replay_in_process(capture_app, entries)
+        assert len(latencies) == 3 and not diffs, 'Unexpected diffs {0}.'.format(diffs)
+        latencies, elapsed, diffs = replay_beaker.replay_in_process(capture_app, entries)
+        assert [d['path'] for d in diffs] == ['/count'], 'Changed response not reported: {0}.'.format(diffs)
+        hits[:] = []
+        latencies, elapsed, diffs = replay_beaker.replay_server(capture_app, entries, speed=0, clients=1, threads=1)
+        assert len(latencies) == 3 and not diffs, 'Unexpected loopback diffs {0}.'.format(diffs)
+        capture_app.start_capture(file_name, keep_credentials=True)
+        wsgi_call(capture_app, '/missing', environ={'HTTP_COOKIE': 'session=secret'})
+        capture_app.stop_capture()
+        entries = replay_beaker.load_capture(file_name)
+        assert entries[0]['h']['Cookie'] == 'session=secret', 'Credentials not kept: {0}.'.format(entries)
+        spaced = [{'t': 0.0}, {'t': 1.0}, {'t': 3.0}]
+        assert [e['t'] for e in replay_beaker.repeat_entries(spaced, 2)] == [0.0, 1.0, 3.0, 4.5, 5.5, 7.5], \
+                'Repeated rounds overlap.'
+    finally:
+        os.remove(file_name)
+
+def multipart_body(boundary, fields, files):
+    parts = []
+    for name, value in fields:
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'.format(
+                boundary, name, value).encode('utf-8'))
+    for name, filename, data in files:
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, filename).encode('utf-8')
+                     + data + b'\r\n')
+    return b''.join(parts) + '--{0}--\r\n'.format(boundary).encode('utf-8')
+
+def form_app():
+    forms = Beaker('Form App')
+    forms.set_body_parser(BodyParser(spool_size=1024, max_json_size=64))
+
+    @forms.post('/form')
+    def form(req):
+        import hashlib
+        upload = req.files.get('upload')
+        digest = hashlib.md5(upload.read()).hexdigest() if upload else None
+        rolled = upload.file._rolled if upload else None
+        return Response(body='{0} {1} {2} {3}'.format(sorted(req.form.lists()), digest,
+                        upload and upload.filename, rolled), status=200)
+
+    @forms.post('/json')
+    def json_body(req):
+        return Response(body=repr(req.json), status=200)
+    return forms
+
+@tester.test
+def test_body_parsing():
+    import io
+    import hashlib
+    forms = form_app()
+    payload = bytes(bytearray(range(256))) * 64
+    body = multipart_body('xyz', [('a', '1'), ('a', 'two words'), ('b', '--xyz')], [('upload', 'f.bin', payload)])
+    environ = {'CONTENT_TYPE': 'multipart/form-data; boundary="xyz"', 'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body + b'trailing bytes past the body')}
+    status, headers, res_body = wsgi_call(forms, '/form', method='POST', environ=environ)
+    expected = "[('a', ['1', 'two words']), ('b', ['--xyz'])] {0} f.bin True".format(hashlib.md5(payload).hexdigest())
+    assert res_body.decode('utf-8') == expected, 'Bad multipart parse: {0}'.format(res_body)
+
+    body = b'a=1&b=x+y&a=2'
+    environ = {'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body)}
+    status, headers, res_body = wsgi_call(forms, '/form', method='POST', environ=environ)
+    assert res_body == b"[('a', ['1', '2']), ('b', ['x y'])] None None None", 'Bad urlencoded parse: {0}'.format(res_body)
+
+    for body, expected_status, expected in ((b'{"a": [1, 2]}', '200', b"{'a': [1, 2]}"),
+                                            (b'{"a": ', '400', None), (b'[' + b'1,' * 40 + b'1]', '413', None)):
+        environ = {'CONTENT_TYPE': 'application/json; charset=utf-8', 'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        status, headers, res_body = wsgi_call(forms, '/json', method='POST', environ=environ)
+        assert status.startswith(expected_status), 'Expected {0}, got {1}.'.format(expected_status, status)
+        assert expected is None or res_body == expected, 'Bad JSON parse: {0}'.format(res_body)
+
+    truncated = multipart_body('xyz', [('a', '1')], [])[:-10]
+    environ = {'CONTENT_TYPE': 'multipart/form-data; boundary=xyz', 'CONTENT_LENGTH': str(len(truncated)),
+               'wsgi.input': io.BytesIO(truncated)}
+    status, headers, res_body = wsgi_call(forms, '/form', method='POST', environ=environ)
+    assert status.startswith('400'), 'Truncated multipart body accepted.'
+
+    class ClientError(Exception):
+        status = 400
+
+    @forms.get('/client')
+    def client(req):
+        raise ClientError('upstream said 400')
+    status, headers, res_body = wsgi_call(forms, '/client')
+    assert status.startswith('500'), 'Exception with a status taken for a body error: {0}'.format(status)
+
+@tester.test
+def test_server_multipart_upload():
+    import hashlib
+    import server
+    payload = bytes(bytearray(range(256))) * 2048
+    body = multipart_body('b0undary', [('a', '1')], [('upload', 'big.bin', payload)])
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(form_app(), threads=1, server_class=server_class)
+        head = ('POST /form HTTP/1.1\r\nContent-Type: multipart/form-data; boundary=b0undary\r\n'
+                'Content-Length: {0}\r\nConnection: close\r\n\r\n').format(len(body)).encode('ascii')
+        response = http_exchange(port, head + body)
+        assert hashlib.md5(payload).hexdigest().encode('ascii') in response, 'Upload lost: {0}'.format(response[-200:])
+
+@tester.test
+def test_request_limits():
+    import server
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(upload_app(), threads=1, max_head=1024, max_body=100,
+                               server_class=server_class)
+        response = http_exchange(port, b'POST /upload HTTP/1.1\r\nContent-Length: 101\r\n\r\n')
+        assert response.startswith(b'HTTP/1.0 413'), 'Big body accepted: {0}'.format(response[:80])
+        response = http_exchange(port, b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * 2048 + b'\r\n\r\n')
+        assert response.startswith(b'HTTP/1.0 431'), 'Big head accepted: {0}'.format(response[:80])
+        response = http_exchange(port, b'NONSENSE\r\n\r\n')
+        assert response.startswith(b'HTTP/1.0 400'), 'Bad request line accepted.'
+        chunk = b'32\r\n' + b'a' * 50 + b'\r\n'
+        response = http_exchange(port, b'POST /upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                       + chunk * 3 + b'0\r\n\r\n')
+        status_line = response.split(b'\r\n', 1)[0]
+        assert b' 413 ' in status_line and b'Error(' not in response, \
+            'Big chunked body not refused: {0}'.format(response[:200])
+
+def streaming_app(closed):
+    stream = Beaker('Streaming App')
+
+    @stream.get('/rows/<int:n>', mimetype='text/csv')
+    def rows(req, n):
+        def generate():
+            try:
+                for i in range(n):
+                    yield '{0},{1}\n'.format(i, i * i)
+            finally:
+                closed.append(True)
+        return Response(body=generate(), status=200)
+
+    @stream.get('/arows/<int:n>')
+    def async_rows(req, n):
+        async def generate():
+            for i in range(n):
+                yield 'row {0}\n'.format(i)
+        return Response(body=generate(), status=200)
+    return stream
+
+@tester.test
+def test_streamed_body_wsgi():
+    closed = []
+    status, headers, body = wsgi_call(streaming_app(closed), '/rows/3')
+    assert body == b'0,0\n1,1\n2,4\n', 'Wrong streamed body: {0}'.format(body)
+    assert 'Content-Length' not in headers, 'Streamed body has a Content-Length.'
+    assert headers['Content-Type'] == 'text/csv', 'Wrong mimetype.'
+    assert closed, 'Body generator was not closed.'
+
+@tester.test
+def test_streamed_body_server():
+    import server
+    expected = ''.join('{0},{1}\n'.format(i, i * i) for i in range(1000)).encode('ascii')
+    for server_class in (server.Server, server.AsyncServer):
+        port = serve_in_thread(streaming_app([]), threads=1, server_class=server_class)
+        response = http_exchange(port, b'GET /rows/1000 HTTP/1.0\r\n\r\n')
+        head, body = response.split(b'\r\n\r\n', 1)
+        assert b'Connection: close' in head, 'HTTP/1.0 stream not close-delimited.'
+        assert body == expected, 'Streamed body differs.'
+        response = http_exchange(port, b'GET /rows/5 HTTP/1.1\r\nConnection: close\r\n\r\n')
+        assert b'Transfer-Encoding: chunked' in response, 'HTTP/1.1 stream not chunked.'
+        assert response.endswith(b'0\r\n\r\n'), 'Chunked stream not terminated.'
+    response = http_exchange(port, b'GET /arows/2 HTTP/1.0\r\n\r\n')
+    assert response.endswith(b'row 0\nrow 1\n'), 'Async generator body not streamed.'
+
+@tester.test
+def test_benchmark_smoke():
+    import bench_beaker
+    results = bench_beaker.run(['micro', 'wsgi', 'server'], [10], iterations=5, batches=1,
+                               requests=4, clients=2, threads=1)
+    assert len(results) == 12, 'Expected 4 cases for each of 3 layers.'
+    for result in results:
+        assert result['ops_per_sec'] > 0, 'No throughput for {0}.'.format(result)
+    slower = [dict(result, ops_per_sec=result['ops_per_sec'] * 10) for result in results]
+    regressions = bench_beaker.compare(results, {'results': slower}, 0.1)
+    assert len(regressions) == len(results), 'Regressions not detected.'
+
+def stats_app():
+    stats = Beaker('Stats App')
+
+    @stats.get('/item/<int:n>')
+    def item(req, n):
+        return Response(body=str(n), status=200)
+
+    @stats.get('/broken')
+    def broken(req):
+        raise RuntimeError('broken')
+    return stats
+
+@tester.test
+def test_request_hooks():
+    hooked = stats_app()
+    seen = []
+
+    @hooked.before_request
+    def block(req):
+        seen.append(req.path)
+        if req.path == '/blocked':
+            return Response(body='blocked', status=400)
+
+    @hooked.after_request
+    def tag(req, res):
+        res.body = res.body + '!'
+        return res
+
+    @hooked.get('/moved/<int:n>')
+    def moved(req, n):
+        return hooked.redirect(hooked.url_for('item', n=n), req)
+
+    assert_res(hooked.request(Request(path='/item/1', method='GET')), 200, '1!')
+    assert_res(hooked.request(Request(path='/blocked', method='GET')), 400, 'blocked!')
+    assert seen == ['/item/1', '/blocked'], 'before_request not called for every request.'
+    assert_res(hooked.request(Request(path='/moved/2', method='GET')), 200, '2!')
+    assert seen[2:] == ['/moved/2'], 'Hooks run again for a redirect.'
+
+@tester.test
+def test_request_stats():
+    import json
+    timed = stats_app()
+    timed.enable_stats('/_stats')
+    for i in range(3):
+        timed.request(Request(path='/item/{0}'.format(i), method='GET'))
+    timed.request(Request(path='/broken', method='GET'))
+    timed.request(Request(path='/item/x', method='GET'))
+    res = timed.request(Request(path='/_stats', method='GET'))
+    assert_res(res, 200)
+    assert res.mimetype == 'application/json', 'Stats not served as JSON.'
+    stats = json.loads(res.body)
+    assert stats['requests'] == 5, 'Wrong request count: {0}'.format(stats['requests'])
+    item = stats['routes']['item']
+    assert item['count'] == 4 and item['statuses'] == {'200': 3, '400': 1}, 'Wrong item stats.'
+    assert sum(item['histogram'].values()) == 4, 'Histogram does not add up.'
+    assert stats['routes']['broken']['errors'] == 1, 'Exception not counted.'
+    for stage in ('validation', 'static_cache', 'route_match', 'kwarg_filter', 'handler', 'error_handler'):
+        assert stage in stats['stages'], 'Stage {0} not timed.'.format(stage)
+    timed.disable_stats()
+    req = Request(path='/item/1', method='GET')
+    timed.request(req)
+    assert req.timer is None, 'Timer created with stats disabled.'
+    assert_res(timed.request(Request(path='/_stats', method='GET')), 404)
+
 @tester.test
 def test_paths():
     path_a = '/this/is/a/path'
@@ -170,9 +1457,174 @@ def test_url_for():
 
 @tester.test
 def test_invalid_url_query():
-    req = Request(path="/simple/endpoint", query='a=g&g', method="GET")
+    limited = Beaker('Limited App')
+    limited.get('/q')(lambda req: Response(body='ok', status=200))
+    limited.set_query_limits(max_args=3, max_length=20)
+    assert_res(limited.request(Request(path='/q', query='a=1&b=2&c=3', method='GET')), 200)
+    assert_res(limited.request(Request(path='/q', query='a=1&b=2&c=3&d=4', method='GET')), 400)
+    assert_res(limited.request(Request(path='/q', query='a=' + 'x' * 30, method='GET')), 400)
+
+@tester.test
+def test_query_parsing():
+    req = Request(path="/simple/endpoint", query='a=g&g&x=b=c&s=%2Fhi+there&r=1&r=2', method="GET")
     res = app.request(req)
-    assert_res(res, 400)
+    assert_res(res, 200)
+    assert req.args['g'] == '', 'Bare flag not parsed.'
+    assert req.args['x'] == 'b=c', 'Value with = not parsed.'
+    assert req.args['s'] == '/hi there', 'Value not percent-decoded.'
+    assert req.args['r'] == '2' and req.args.getlist('r') == ['1', '2'], 'Repeated key lost.'
+    lazy = Request(path="/simple/endpoint", query='a=1', method="GET")
+    app.request(lazy)
+    assert lazy._args is None, 'Query parsed without being used.'
+
+@tester.test
+def test_multidict():
+    from beaker import MultiDict
+    args = MultiDict([('r', '1'), ('r', '2'), ('a', '1')])
+    copied = args.copy()
+    assert isinstance(copied, MultiDict) and copied.getlist('r') == ['1', '2'], 'Copy lost values.'
+    args.update({'r': '3'}, b='4')
+    assert args.getlist('r') == ['3'] and args.getlist('b') == ['4'], 'update out of sync: {0}.'.format(args.lists())
+    args.update(MultiDict([('c', '5'), ('c', '6')]))
+    assert args['c'] == '6' and args.getlist('c') == ['5', '6'], 'MultiDict update lost values.'
+    assert args.setdefault('d', '7') == '7' and args.setdefault('d', '8') == '7', 'Wrong setdefault.'
+    assert args.getlist('d') == ['7'], 'setdefault out of sync.'
+    assert args.pop('a') == '1' and args.getlist('a') == [], 'pop out of sync.'
+    del args['b']
+    assert args.getlist('b') == [], 'del out of sync.'
+    merged = args | {'r': '9'}
+    args |= {'e': '1'}
+    assert merged.getlist('r') == ['9'] and args.getlist('r') == ['3'] and args.getlist('e') == ['1'], \
+            'Merge out of sync.'
+    while args:
+        key, value = args.popitem()
+        assert args.getlist(key) == [], 'popitem out of sync.'
+    assert copied.getlist('r') == ['1', '2'], 'Copy shares values with the original.'
+
+@tester.test
+def test_response_cache():
+    import time
+    cached_app = Beaker('Cached App')
+    calls = []
+
+    @cached_app.get('/report/<int:year>', cache=True, cache_args=('format', ))
+    def report(req, year):
+        calls.append(year)
+        return Response(body='{0} {1}'.format(year, req.args.get('format')), status=200)
+
+    @cached_app.get('/short', cache=True, cache_ttl=0.05)
+    def short(req):
+        calls.append('short')
+        return Response(body='short', status=200)
+
+    assert_res(cached_app.request(Request(path='/report/2020', method='GET')), 200, '2020 None')
+    assert_res(cached_app.request(Request(path='/report/02020', query='other=1', method='GET')), 200, '2020 None')
+    assert calls == [2020], 'Handler ran on a cache hit: {0}'.format(calls)
+    assert_res(cached_app.request(Request(path='/report/2020', query='format=csv', method='GET')), 200, '2020 csv')
+    assert len(calls) == 2, 'Cache ignored a keyed query arg.'
+
+    res = cached_app.request(Request(path='/report/2020', method='GET'))
+    etag = res.headers['ETag']
+    res = cached_app.request(Request(path='/report/2020', method='GET', headers={'If-None-Match': etag}))
+    assert res.status == 304, 'Cached response not validated by its ETag.'
+
+    cached_app.invalidate_cache('report', year=2020)
+    cached_app.request(Request(path='/report/2020', method='GET'))
+    assert len(calls) == 3, 'Invalidated response was served.'
+    cached_app.invalidate_cache('report')
+    assert len(cached_app._response_cache) == 0, 'Endpoint not invalidated.'
+
+    @cached_app.get('/both', cache=True)
+    @cached_app.get('/both/<a>/<b>', cache=True)
+    def both(req, a='x', b='y'):
+        return Response(body=a + b, status=200)
+
+    assert_res(cached_app.request(Request(path='/both/1/2', method='GET')), 200, '12')
+    assert_res(cached_app.request(Request(path='/both', method='GET')), 200, 'xy')
+    assert_res(cached_app.request(Request(path='/both/1/2', method='GET')), 200, '12')
+    cached_app.invalidate_cache('both', a='1', b='2')
+    assert len(cached_app._response_cache) == 1, 'Wrong route invalidated.'
+
+    compressed = []
+
+    class Counting(Beaker):
+        def _compress_response(self, req, res, encoding):
+            compressed.append(encoding)
+            return Beaker._compress_response(self, req, res, encoding)
+    counting = Counting('Counting App')
+
+    @counting.get('/page', mimetype='text/html', cache=True)
+    def page(req):
+        return Response(body='<p>cached</p>' * 200, status=200)
+
+    import gzip
+    for encoding in ('gzip', 'gzip', 'deflate', 'deflate', None):
+        res = counting.request(Request(path='/page', method='GET', headers={'Accept-Encoding': encoding or 'identity'}))
+        assert res.headers.get('Content-Encoding') == encoding, 'Wrong copy: {0}'.format(res.headers)
+    assert compressed == ['gzip', 'deflate'], 'Cached response compressed again: {0}'.format(compressed)
+    res = counting.request(Request(path='/page', method='GET', headers={'Accept-Encoding': 'gzip'}))
+    assert gzip.decompress(res.body) == b'<p>cached</p>' * 200 and res.headers['ETag'].endswith('-gzip"'), \
+        'Bad cached gzip copy.'
+
+    cached_app.request(Request(path='/short', method='GET'))
+    time.sleep(0.1)
+    cached_app.request(Request(path='/short', method='GET'))
+    assert calls.count('short') == 2, 'Expired response was served.'
+
+    cache = ResponseCache(max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.put((key, '/', ()), Response(status=200, body=key))
+    assert ('a', '/', ()) not in cache and cache.stats()['evictions'] == 1, 'Least recently used not evicted.'
+
+@tester.test
+def test_request_allocations():
+    import io
+    import tracemalloc
+    import server
+    lean_app = Beaker('Lean App')
+
+    @lean_app.get('/item/<int:n>')
+    def item(req, n):
+        return Response(body='ok', status=200)
+
+    @lean_app.get('/eager/<int:n>')
+    def eager(req, n):
+        req.args, req.headers
+        return Response(body='ok', status=200)
+
+    pygi = server.Server(0, lean_app, host='127.0.0.1')
+    pygi.server_socket.close()
+    def start_response(status, headers):
+        pass
+    def serve_one(path):
+        head = 'GET {0}?a=1 HTTP/1.1\r\nHost: localhost\r\nAccept: */*\r\nAccept-Encoding: gzip\r\n\r\n'.format(path)
+        req = pygi._parse_request(head)
+        req['body'] = io.BytesIO()
+        for block in lean_app(pygi._create_environ(req), start_response):
+            pass
+    def measure(path):
+        for i in range(100):
+            serve_one(path)
+        tracemalloc.start()
+        try:
+            serve_one(path)
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(100):
+                serve_one(path)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return current - before, peak - before
+    lean_leak, lean_peak = measure('/item/5')
+    eager_leak, eager_peak = measure('/eager/5')
+    # A hundred requests keep less than one request needs, so nothing grows per request,
+    # and leaving the query and headers unparsed costs less than parsing them.
+    assert lean_leak < lean_peak, 'Requests leaked {0} bytes, one peaks at {1}.'.format(lean_leak, lean_peak)
+    assert lean_peak < eager_peak, 'Lazy request peaked at {0} bytes, parsed one at {1}.'.format(
+            lean_peak, eager_peak)
+    assert not hasattr(Request('GET', '/'), '__dict__'), 'Request has a __dict__.'
+    assert not hasattr(Response(200, 'ok'), '__dict__'), 'Response has a __dict__.'
 
 @tester.test
 def test_invalid_url_query2():